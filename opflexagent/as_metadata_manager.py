@@ -10,20 +10,29 @@
 #    License for the specific language governing permissions and limitations
 #    under the License.
 
+import collections
+import errno
 import functools
+import glob
+import grp
 import hashlib
 import multiprocessing
 import netaddr
 import os
 import os.path
+import pwd
 import pyinotify
 import Queue
 import signal
 import subprocess
 import sys
+import threading
 import time
 import uuid
 
+from neutron.agent.common import ovs_lib
+from neutron.agent.linux import ip_lib
+from neutron.agent.linux import utils as agent_utils
 from neutron.common import config as common_config
 from neutron.common import utils
 from neutron.conf.agent import common as config
@@ -32,6 +41,12 @@ from neutron.plugins.ml2.drivers.openvswitch.agent.common import (  # noqa
 from oslo_config import cfg
 from oslo_log import log as logging
 from oslo_serialization import jsonutils
+from six.moves import xmlrpc_client
+
+try:
+    from supervisor import xmlrpc as supervisor_xmlrpc
+except ImportError:
+    supervisor_xmlrpc = None
 
 from opflexagent import config as oscfg  # noqa
 
@@ -57,12 +72,18 @@ AS_FILE_EXTENSION = "as"
 AS_FILE_NAME_FORMAT = "%s." + AS_FILE_EXTENSION
 AS_MAPPING_DIR = "/var/lib/opflex-agent-ovs/services"
 EOQ = 'STOP'
+RESCAN = 'RESCAN'
 MD_DIR = "/var/lib/neutron/opflex_agent"
 MD_DIR_OWNER = "neutron:neutron"
 MD_SUP_FILE_NAME = "metadata.conf"
+MD_SUP_PID_FILE_NAME = "md-svc-supervisor.pid"
+MD_SUP_STOP_TIMEOUT = 30
+MD_SUP_STOP_POLL_INTERVAL = 0.5
+MD_SUP_SOCKET = MD_DIR + "/md-svc-supervisor.sock"
+MD_SUP_UPDATE_DELAY = 1.0
+MD_PROXY_CONSOLIDATED = "consolidated"
 SVC_IP_DEFAULT = "169.254.1.2"
 SVC_IP_BASE = 0xA9FEF003
-SVC_IP_SIZE = 1000
 SVC_IP_CIDR = 16
 SVC_NEXTHOP = "169.254.1.1"
 SVC_NS = "of-svc"
@@ -100,30 +121,109 @@ def write_jsonfile(name, data):
         LOG.warn("Exception in writing file: %s" % str(e))
 
 
+def replace_jsonfile(name, data):
+    """Atomically replace the file, so readers never see a partial write"""
+    tmpname = "%s.tmp" % name
+    try:
+        with open(tmpname, "w") as f:
+            jsonutils.dump(data, f)
+        os.rename(tmpname, name)
+        return True
+    except Exception as e:
+        LOG.warn("Exception in writing file: %s" % str(e))
+    return False
+
+
+def remove_file(name):
+    try:
+        os.remove(name)
+    except OSError as e:
+        if e.errno != errno.ENOENT:
+            LOG.warn("Exception in deleting file: %s" % str(e))
+
+
+class SupervisorUpdater(object):
+    """Coalesce supervisor program changes into a single update.
+
+    The first change scheduled starts a timer, the changes scheduled
+    before it fires are applied by the same reread/update.
+    """
+
+    def __init__(self, mgr, delay=MD_SUP_UPDATE_DELAY):
+        self.mgr = mgr
+        self.delay = delay
+        self.lock = threading.Lock()
+        self.timer = None
+        self.scheduled = 0
+        self.updates = 0
+
+    def schedule(self):
+        with self.lock:
+            self.scheduled += 1
+            if self.timer is None:
+                self.timer = threading.Timer(self.delay, self._update)
+                self.timer.daemon = True
+                self.timer.start()
+
+    def _update(self):
+        with self.lock:
+            self.timer = None
+        self.updates += 1
+        LOG.debug("SupervisorUpdater: update %d for %d changes" % (
+            self.updates, self.scheduled))
+        self.mgr.update_supervisor()
+
+    def cancel(self):
+        with self.lock:
+            timer, self.timer = self.timer, None
+        if timer is not None:
+            timer.cancel()
+
+
 class AddressPool(object):
+    """Allocator of the addresses base to base + size - 1.
+
+    One byte per address tells if it is in use, the lowest free address
+    is always handed out first.
+    """
     def __init__(self, base, size):
         self.base = base
         self.size = size
-        self.ips = {}
-        for i in xrange(size):
-            self.ips[self.base + i] = True
+        self.used = bytearray(size)
+
+    def _offset(self, ip):
+        offset = ip - self.base
+        if offset < 0 or offset >= self.size:
+            raise ValueError("%s is not in the address pool" %
+                             netaddr.IPAddress(ip))
+        return offset
 
     def reserve(self, ip):
-        del self.ips[ip]
+        self.used[self._offset(ip)] = 1
+
+    def release(self, ip):
+        self.used[self._offset(ip)] = 0
 
     def get_addr(self):
-        for i in self.ips:
-            self.reserve(i)
-            return i
-        return None
+        offset = self.used.find(b'\x00')
+        if offset < 0:
+            return None
+        self.used[offset] = 1
+        return self.base + offset
 
 
 class FileProcessor(object):
-    def __init__(self, watchdir, extensions, eventq, processfn):
+    def __init__(self, watchdir, extensions, eventq, processfn,
+                 resetfn=None, quiet_period=0, max_latency=0):
         self.watchdir = watchdir
         self.extensions = extensions
         self.eventq = eventq
         self.processfn = processfn
+        self.resetfn = resetfn
+        self.quiet_period = quiet_period
+        self.max_latency = max_latency
+        self.events_received = 0
+        self.batches_processed = 0
 
     def scanfiles(self, files):
         LOG.debug("FileProcessor: processing files: %s" % files)
@@ -137,40 +237,90 @@ class FileProcessor(object):
 
     def scan(self):
         LOG.debug("FileProcessor: initial scan")
+        if self.resetfn:
+            self.resetfn()
         files = []
         for filename in os.listdir(self.watchdir):
             files.append(("update", filename))
         self.scanfiles(files)
         return
 
+    def get_events(self):
+        """Wait for events and return them as a batch.
+
+        The events already queued are batched. With a quiet period, the
+        batch also takes the events which keep coming until none is
+        received for that long, or until max_latency seconds have passed
+        since the first one.
+        """
+        events = [self.eventq.get()]
+        deadline = time.time() + self.max_latency
+        while events[-1] != EOQ:
+            try:
+                if self.quiet_period:
+                    timeout = self.quiet_period
+                    if self.max_latency:
+                        timeout = min(timeout, deadline - time.time())
+                        if timeout <= 0:
+                            break
+                    event = self.eventq.get(timeout=timeout)
+                else:
+                    event = self.eventq.get_nowait()
+            except Queue.Empty:
+                break
+            events.append(event)
+        return events
+
+    def get_batch(self):
+        """Wait for events and return the files they changed.
+
+        Returns the (action, filename) list with only the last action of
+        each file, whether a full scan was requested and whether the
+        processor was stopped.
+        """
+        files = collections.OrderedDict()
+        rescan = False
+        stopped = False
+        for event in self.get_events():
+            LOG.debug("FileProcessor: event: %s" % event)
+            if event == EOQ:
+                stopped = True
+                break
+            self.events_received += 1
+
+            if event == RESCAN:
+                # the full scan covers any event in this batch
+                rescan = True
+                continue
+
+            action = "update"
+            if event.maskname == "IN_DELETE" or \
+               event.maskname == "IN_MOVED_FROM":
+                action = "delete"
+            files.pop(event.pathname, None)
+            files[event.pathname] = action
+        files = [(action, filename) for filename, action in files.items()]
+        return files, rescan, stopped
+
     def run(self):
         self.scan()
         try:
             connected = True
             while connected:
-                files = []
-                event = self.eventq.get()
-                while event is not None:
-                    # drain all events in queue and batch them
-                    LOG.debug("FileProcessor: event: %s" % event)
-                    if event == EOQ:
-                        connected = False
-                        event = None
-                        break
-
-                    action = "update"
-                    if event.maskname == "IN_DELETE" or \
-                       event.maskname == "IN_MOVED_FROM":
-                        action = "delete"
-                    files.append((action, event.pathname))
-
-                    try:
-                        event = self.eventq.get_nowait()
-                    except Queue.Empty as e:
-                        event = None
-                if files:
+                files, rescan, stopped = self.get_batch()
+                connected = not stopped
+                if rescan:
+                    self.scan()
+                elif files:
                     # process the batch
                     self.scanfiles(files)
+                else:
+                    continue
+                self.batches_processed += 1
+                LOG.debug("FileProcessor: %(events)d events received, "
+                          "%(batches)d batches processed" %
+                          {'events': self.events_received,
+                           'batches': self.batches_processed})
         except KeyboardInterrupt:
             pass
         except Exception as e:
@@ -200,19 +350,32 @@ class EventHandler(pyinotify.ProcessEvent):
 
 
 class FileWatcher(object):
-    def __init__(self, watchdir, extensions, name="Not Specified"):
+    def __init__(self, watchdir, extensions, name="Not Specified",
+                 threaded=None):
         self.name = name
         self.watchdir = watchdir
         self.extensions = extensions.split(',')
-        self.eventq = multiprocessing.Queue()
+        if threaded is None:
+            threaded = cfg.CONF.OPFLEX.file_watcher_mode == "thread"
+        if threaded:
+            self.eventq = Queue.Queue()
+        else:
+            self.eventq = multiprocessing.Queue()
 
         fp = FileProcessor(
             self.watchdir,
             self.extensions,
             self.eventq,
-            functools.partial(self.process))
+            functools.partial(self.process),
+            functools.partial(self.reset),
+            quiet_period=cfg.CONF.OPFLEX.file_watcher_quiet_period,
+            max_latency=cfg.CONF.OPFLEX.file_watcher_max_latency)
         fprun = functools.partial(fp.run)
-        self.processor = multiprocessing.Process(target=fprun)
+        if threaded:
+            self.processor = threading.Thread(target=fprun)
+            self.processor.daemon = True
+        else:
+            self.processor = multiprocessing.Process(target=fprun)
         LOG.debug("FileWatcher: %s: starting" % self.name)
         self.processor.start()
 
@@ -226,19 +389,34 @@ class FileWatcher(object):
         LOG.debug("FileWatcher: %s: process: %s" % (
             self.name, files))
 
+    def reset(self):
+        # Override in child class, called before every full scan of
+        # watchdir to drop any state built from the files
+        LOG.debug("FileWatcher: %s: reset" % self.name)
+
+    def rescan(self, signum, frame):
+        LOG.debug("FileWatcher: %s: rescan requested" % self.name)
+        self.eventq.put(RESCAN)
+
     def terminate(self, signum, frame):
         self.eventq.put(EOQ)
         if signum is not None:
             sys.exit(0)
 
+    def watch(self, wm):
+        handler = EventHandler(watcher=self, extensions=self.extensions)
+        wm.add_watch(self.watchdir, handler.events, proc_fun=handler,
+                     rec=False)
+        return handler
+
     def run(self):
         signal.signal(signal.SIGINT, self.terminate)
         signal.signal(signal.SIGTERM, self.terminate)
+        signal.signal(signal.SIGHUP, self.rescan)
 
         wm = pyinotify.WatchManager()
-        handler = EventHandler(watcher=self, extensions=self.extensions)
+        handler = self.watch(wm)
         notifier = pyinotify.Notifier(wm, handler)
-        wm.add_watch(self.watchdir, handler.events, rec=False)
         try:
             LOG.debug("FileWatcher: %s: notifier waiting ..." % self.name)
             notifier.loop()
@@ -251,6 +429,46 @@ class FileWatcher(object):
         return True
 
 
+class MultiWatcher(object):
+    """Runs several file watchers from a single inotify event loop.
+
+    Each watcher keeps its own queue and processing thread, all the
+    watched directories share the notifier of this process.
+    """
+    def __init__(self, watchers):
+        self.watchers = watchers
+
+    def rescan(self, signum, frame):
+        for watcher in self.watchers:
+            watcher.rescan(signum, frame)
+
+    def terminate(self, signum, frame):
+        for watcher in self.watchers:
+            watcher.terminate(None, None)
+        if signum is not None:
+            sys.exit(0)
+
+    def run(self):
+        signal.signal(signal.SIGINT, self.terminate)
+        signal.signal(signal.SIGTERM, self.terminate)
+        signal.signal(signal.SIGHUP, self.rescan)
+
+        wm = pyinotify.WatchManager()
+        notifier = pyinotify.Notifier(wm)
+        for watcher in self.watchers:
+            watcher.watch(wm)
+        try:
+            LOG.debug("MultiWatcher: notifier waiting ...")
+            notifier.loop()
+        finally:
+            LOG.debug("MultiWatcher: notifier returned")
+            self.terminate(None, None)
+
+        for watcher in self.watchers:
+            watcher.processor.join()
+        return True
+
+
 class TmpWatcher(FileWatcher):
     """Class for integration testing"""
     def __init__(self):
@@ -296,15 +514,41 @@ class EpWatcher(FileWatcher):
         }
     }
 
+    The EP files are parsed only when they change: the contribution of each
+    file is kept in memory and applied to the aggregated maps, the whole
+    directory is only read at startup and on SIGHUP.
     """
-    def __init__(self):
+    def __init__(self, threaded=None):
         self.svcfile = "%s/%s" % (MD_DIR, STATE_FILENAME_SVC)
         self.netsfile = "%s/%s" % (MD_DIR, STATE_FILENAME_NETS)
+        # last instance_networks content written, to skip the unchanged ones
+        self.written_nets = None
+        self.nets_writes = 0
+        self.nets_writes_skipped = 0
+        self.ip_pool = AddressPool(SVC_IP_BASE,
+                                   cfg.CONF.OPFLEX.anycast_svc_pool_size)
+        # next-hop IPs reserved in ip_pool
+        self.pool_ips = set()
+        self.reset()
 
         epfiledir = cfg.CONF.OPFLEX.epg_mapping_dir
         epextensions = EP_FILE_EXTENSION
         super(EpWatcher, self).__init__(
-            epfiledir, epextensions, name="ep-watcher")
+            epfiledir, epextensions, name="ep-watcher", threaded=threaded)
+
+    def reset(self):
+        # EP file name -> contribution of that file
+        self.eps = {}
+        # domain uuid -> [domain name, domain tenant, number of EPs]
+        self.domains = {}
+        # domain uuid -> number of EPs with a neutron network
+        self.net_refs = {}
+        # domain uuid -> IP -> EP file name -> neutron network
+        self.ip_owners = {}
+        # instance_networks aggregate, kept in sync with ip_owners
+        self.nets = {}
+        # EP files disabling the metadata optimization
+        self.md_opt_disabled = set()
 
     def gen_domain_uuid(self, tenant, name):
         fqname = '%s|%s' % (tenant, name)
@@ -312,84 +556,172 @@ class EpWatcher(FileWatcher):
         fquuid = str(uuid.UUID(fqhash))
         return fquuid
 
-    def process(self, files):
-        LOG.debug("EP files: %s" % files)
+    def parse_ep(self, ep):
+        """Get the contribution of an EP to the state files"""
+        contrib = {
+            'metadata-optimization': ep.get(
+                'neutron-metadata-optimization', True),
+            'domain-uuid': None,
+            'neutron-network': None,
+            'ips': [],
+        }
+        domain_name = ep.get('domain-name')
+        domain_tenant = ep.get('domain-policy-space')
+        if domain_name is None or domain_tenant is None:
+            return contrib
+        contrib['domain-uuid'] = self.gen_domain_uuid(
+            domain_tenant, domain_name)
+        contrib['domain-name'] = domain_name
+        contrib['domain-policy-space'] = domain_tenant
+        contrib['neutron-network'] = ep.get('neutron-network')
+        contrib['ips'] = ep.get('anycast-return-ip') or []
+        return contrib
+
+    def _set_nets_ip(self, domain_uuid, ip):
+        owners = self.ip_owners[domain_uuid][ip]
+        if owners:
+            # pick a stable owner when several EPs claim the same IP
+            self.nets[domain_uuid][ip] = owners[min(owners)]
+        else:
+            del self.ip_owners[domain_uuid][ip]
+            del self.nets[domain_uuid][ip]
+
+    def add_ep(self, filename, contrib):
+        self.eps[filename] = contrib
+        if contrib['metadata-optimization'] is False:
+            # as it is a global property, False wins
+            self.md_opt_disabled.add(filename)
+
+        domain_uuid = contrib['domain-uuid']
+        if domain_uuid is None:
+            return
+        domain = self.domains.setdefault(
+            domain_uuid,
+            [contrib['domain-name'], contrib['domain-policy-space'], 0])
+        domain[2] += 1
 
-        curr_metadata_optimization = True
-        curr_svc = read_jsonfile(self.svcfile)
-        ip_pool = AddressPool(SVC_IP_BASE, SVC_IP_SIZE)
-        for domain_uuid in curr_svc:
-            thisip = netaddr.IPAddress(curr_svc[domain_uuid]['next-hop-ip'])
-            ip_pool.reserve(int(thisip))
+        nnetwork = contrib['neutron-network']
+        if nnetwork is None:
+            return
+        self.net_refs[domain_uuid] = self.net_refs.get(domain_uuid, 0) + 1
+        self.nets.setdefault(domain_uuid, {})
+        ip_owners = self.ip_owners.setdefault(domain_uuid, {})
+        for ip in set(contrib['ips']):
+            ip_owners.setdefault(ip, {})[filename] = nnetwork
+            self._set_nets_ip(domain_uuid, ip)
+
+    def remove_ep(self, filename):
+        contrib = self.eps.pop(filename, None)
+        if contrib is None:
+            return
+        self.md_opt_disabled.discard(filename)
 
-        new_svc = {}
-        new_nets = {}
-        updated = False
+        domain_uuid = contrib['domain-uuid']
+        if domain_uuid is None:
+            return
+        domain = self.domains[domain_uuid]
+        domain[2] -= 1
+        if not domain[2]:
+            del self.domains[domain_uuid]
+
+        if contrib['neutron-network'] is None:
+            return
+        for ip in set(contrib['ips']):
+            self.ip_owners[domain_uuid][ip].pop(filename, None)
+            self._set_nets_ip(domain_uuid, ip)
+        self.net_refs[domain_uuid] -= 1
+        if not self.net_refs[domain_uuid]:
+            del self.net_refs[domain_uuid]
+            del self.ip_owners[domain_uuid]
+            del self.nets[domain_uuid]
+
+    def process(self, files):
+        LOG.debug("EP files: %s" % files)
 
         epfiledir = cfg.CONF.OPFLEX.epg_mapping_dir
-        for filename in os.listdir(epfiledir):
-            if not filename.endswith(EP_FILE_EXTENSION):
+        for (action, filename) in files:
+            filename = os.path.basename(filename)
+            self.remove_ep(filename)
+            if action == "delete":
                 continue
-
-            filename = "%s/%s" % (epfiledir, filename)
-            ep = read_jsonfile(filename)
+            fqfn = "%s/%s" % (epfiledir, filename)
+            if not os.path.exists(fqfn):
+                continue
+            ep = read_jsonfile(fqfn)
             if ep:
-                metadata_optimization = ep.get(
-                    'neutron-metadata-optimization',
-                    curr_metadata_optimization)
-                if metadata_optimization is False:
-                    # as it is a global property, False wins
-                    curr_metadata_optimization = False
-
-                domain_name = ep.get('domain-name')
-                domain_tenant = ep.get('domain-policy-space')
-                if domain_name is None or domain_tenant is None:
-                    continue
+                self.add_ep(filename, self.parse_ep(ep))
 
-                domain_uuid = self.gen_domain_uuid(domain_tenant, domain_name)
-                if domain_uuid and domain_uuid not in new_svc:
-                    if domain_uuid not in curr_svc:
-                        updated = True
-                        as_uuid = domain_uuid
-                        as_addr = netaddr.IPAddress(ip_pool.get_addr())
-                        as_addr = str(as_addr)
-                        new_svc[domain_uuid] = {
-                            'domain-name': domain_name,
-                            'domain-policy-space': domain_tenant,
-                            'next-hop-ip': as_addr,
-                            'uuid': as_uuid,
-                        }
-                    else:
-                        new_svc[domain_uuid] = curr_svc[domain_uuid]
-                        del curr_svc[domain_uuid]
-
-                nnetwork = ep.get('neutron-network')
-                if nnetwork is None:
-                    continue
-
-                ips = ep.get('anycast-return-ip')
-                if ips is None:
-                    ips = []
+        curr_svc = read_jsonfile(self.svcfile)
+        # the services file is the reference for the allocated IPs
+        self.sync_pool(curr_svc)
 
-                if domain_uuid not in new_nets:
-                    new_nets[domain_uuid] = {}
-                for ip in ips:
-                    new_nets[domain_uuid][ip] = nnetwork
+        new_svc = {}
+        updated = False
 
-        if curr_svc:
+        if self.md_opt_disabled:
+            # No service is published, so no anycast IP is taken for it
             updated = True
+            domains = []
+        else:
+            domains = sorted(self.domains)
+
+        for domain_uuid in domains:
+            if domain_uuid not in curr_svc:
+                addr = self.ip_pool.get_addr()
+                if addr is None:
+                    LOG.error("No anycast service IP left for domain %s" %
+                              domain_uuid)
+                    continue
+                updated = True
+                domain_name, domain_tenant, _refs = self.domains[domain_uuid]
+                as_addr = str(netaddr.IPAddress(addr))
+                new_svc[domain_uuid] = {
+                    'domain-name': domain_name,
+                    'domain-policy-space': domain_tenant,
+                    'next-hop-ip': as_addr,
+                    'uuid': domain_uuid,
+                }
+            else:
+                new_svc[domain_uuid] = curr_svc[domain_uuid]
+                del curr_svc[domain_uuid]
 
-        if curr_metadata_optimization is False:
+        if curr_svc:
             updated = True
-            new_svc = {}
 
         if updated:
-            write_jsonfile(self.svcfile, new_svc)
-        write_jsonfile(self.netsfile, new_nets)
+            replace_jsonfile(self.svcfile, new_svc)
+        self.sync_pool(new_svc)
+        self.write_nets()
+
+    def sync_pool(self, svc):
+        ips = set(int(netaddr.IPAddress(s['next-hop-ip']))
+                  for s in svc.values())
+        for ip in self.pool_ips - ips:
+            self.ip_pool.release(ip)
+        for ip in ips - self.pool_ips:
+            try:
+                self.ip_pool.reserve(ip)
+            except ValueError as e:
+                LOG.warn("EpWatcher: %s" % str(e))
+                ips.discard(ip)
+        self.pool_ips = ips
+
+    def write_nets(self):
+        nets = jsonutils.dumps(self.nets, sort_keys=True)
+        if nets == self.written_nets:
+            self.nets_writes_skipped += 1
+        elif replace_jsonfile(self.netsfile, self.nets):
+            self.written_nets = nets
+            self.nets_writes += 1
+        LOG.debug("EpWatcher: %(netsfile)s: %(writes)d writes, "
+                  "%(skipped)d unchanged writes skipped" %
+                  {'netsfile': self.netsfile,
+                   'writes': self.nets_writes,
+                   'skipped': self.nets_writes_skipped})
 
 
 class StateWatcher(FileWatcher):
-    def __init__(self):
+    def __init__(self, threaded=None):
         root_helper = cfg.CONF.AGENT.root_helper
         self.mgr = AsMetadataManager(LOG, root_helper)
         self.svcfile = "%s/%s" % (MD_DIR, STATE_FILENAME_SVC)
@@ -398,69 +730,89 @@ class StateWatcher(FileWatcher):
         stfiledir = MD_DIR
         stextensions = STATE_FILE_EXTENSION
         super(StateWatcher, self).__init__(
-            stfiledir, stextensions, name="state-watcher")
+            stfiledir, stextensions, name="state-watcher", threaded=threaded)
 
     def terminate(self, signum, frame):
         self.mgr.ensure_terminated()
         super(StateWatcher, self).terminate(signum, frame)
 
+    def reset(self):
+        # Rebuild the model of the applied services from the files left
+        # by a previous run, the next process() diffs the allocations
+        # against it.
+        self.services = {}
+        self.proxies = {}
+        self.ips_synced = False
+        asfiledir = cfg.CONF.OPFLEX.as_mapping_dir
+        for filename in self.list_files(asfiledir, AS_FILE_EXTENSION):
+            filename = "%s/%s" % (asfiledir, filename)
+            asvc = read_jsonfile(filename)
+            if asvc and "uuid" in asvc:
+                self.services[asvc["uuid"]] = (filename, asvc)
+        for filename in self.list_files(MD_DIR, PROXY_FILE_EXTENSION):
+            domain_uuid = filename[:-len(PROXY_FILE_EXTENSION) - 1]
+            try:
+                with open("%s/%s" % (MD_DIR, filename), "r") as f:
+                    self.proxies[domain_uuid] = f.read()
+            except Exception as e:
+                LOG.warn("StateWatcher: Exception in reading file: %s" %
+                         str(e))
+
+    def list_files(self, dirname, extension):
+        try:
+            return [filename for filename in os.listdir(dirname)
+                    if filename.endswith('.' + extension)]
+        except OSError as e:
+            LOG.warn("StateWatcher: Exception in listing %s: %s" % (
+                dirname, str(e)))
+            return []
+
     def process(self, files):
         LOG.debug("State Event: %s" % files)
 
         curr_alloc = read_jsonfile(self.svcfile)
 
+        old_ips = set(asvc["service-mapping"][0]["next-hop-ip"]
+                      for _f, asvc in self.services.values())
+        new_ips = set(alloc["next-hop-ip"] for alloc in curr_alloc.values())
+
+        for domain_uuid in set(self.services) - set(curr_alloc):
+            self.as_del(domain_uuid)
+        for domain_uuid, alloc in curr_alloc.items():
+            asvc = self.as_service(alloc)
+            if self.services.get(domain_uuid, (None, None))[1] != asvc:
+                self.as_write(asvc)
+
+        proxies = {}
+        if not self.mgr.consolidated_proxy:
+            # the consolidated proxy picks up the domains by itself
+            proxies = dict((domain_uuid, self.proxyconfig(alloc))
+                           for domain_uuid, alloc in curr_alloc.items())
         updated = False
-        asfiledir = cfg.CONF.OPFLEX.as_mapping_dir
-        for filename in os.listdir(asfiledir):
-            if not filename.endswith(AS_FILE_EXTENSION):
-                continue
-
-            filename = "%s/%s" % (asfiledir, filename)
-            asvc = read_jsonfile(filename)
-            if asvc:
-                domain_uuid = asvc["uuid"]
-                if domain_uuid not in curr_alloc:
-                    updated = True
-                    self.as_del(filename, asvc)
-                else:
-                    if not self.as_equal(asvc, curr_alloc[domain_uuid]):
-                        updated = True
-                        self.as_write(curr_alloc[domain_uuid])
-                    del curr_alloc[domain_uuid]
-
-        for domain_uuid in curr_alloc:
+        for domain_uuid in set(self.proxies) - set(proxies):
             updated = True
-            self.as_create(curr_alloc[domain_uuid])
+            self.proxy_del(domain_uuid)
+        for domain_uuid, proxystr in proxies.items():
+            if self.proxies.get(domain_uuid) != proxystr:
+                updated = True
+                self.proxy_write(domain_uuid, proxystr)
+
+        if not self.ips_synced:
+            # after a (re)scan, make sure all the allocated IPs are there
+            add_ips = new_ips
+            self.ips_synced = True
+        else:
+            add_ips = new_ips - old_ips
+        del_ips = old_ips - new_ips
+        if add_ips or del_ips:
+            self.mgr.update_ips(add_ips=sorted(add_ips),
+                                del_ips=sorted(del_ips))
 
         if updated:
-            self.mgr.update_supervisor()
-
-    def as_equal(self, asvc, alloc):
-        for idx in ["uuid", "domain-name", "domain-policy-space"]:
-            if asvc[idx] != alloc[idx]:
-                return False
-        if asvc["service-mapping"][0]["next-hop-ip"] != \
-           alloc["next-hop-ip"]:
-                return False
-        return True
-
-    def as_del(self, filename, asvc):
-        try:
-            self.mgr.del_ip(asvc["service-mapping"]["next-hop-ip"])
-        except Exception as e:
-            LOG.warn("EPwatcher: Exception in deleting IP: %s" %
-                     str(e))
+            self.mgr.schedule_update_supervisor()
 
-        proxyfilename = PROXY_FILE_NAME_FORMAT % asvc["uuid"]
-        proxyfilename = "%s/%s" % (MD_DIR, proxyfilename)
-        try:
-            os.remove(filename)
-            os.remove(proxyfilename)
-        except Exception as e:
-            LOG.warn("EPwatcher: Exception in deleting file: %s" % str(e))
-
-    def as_create(self, alloc):
-        asvc = {
+    def as_service(self, alloc):
+        return {
             "uuid": alloc["uuid"],
             "interface-name": SVC_OVS_PORT,
             "service-mac": self.svc_ovsport_mac,
@@ -475,31 +827,36 @@ class StateWatcher(FileWatcher):
             ],
         }
 
-        try:
-            self.mgr.add_ip(alloc["next-hop-ip"])
-        except Exception as e:
-            LOG.warn("EPwatcher: Exception in adding IP: %s" %
-                     str(e))
+    def as_del(self, domain_uuid):
+        remove_file(self.services.pop(domain_uuid)[0])
 
+    def as_write(self, asvc):
         asfilename = AS_FILE_NAME_FORMAT % asvc["uuid"]
         asfilename = "%s/%s" % (AS_MAPPING_DIR, asfilename)
-        try:
-            with open(asfilename, "w") as f:
-                jsonutils.dump(asvc, f)
-        except Exception as e:
-            LOG.warn("EPwatcher: Exception in writing services file: %s" %
-                     str(e))
-
-        proxyfilename = PROXY_FILE_NAME_FORMAT % asvc["uuid"]
+        old = self.services.get(asvc["uuid"])
+        if old and old[0] != asfilename:
+            remove_file(old[0])
+        if replace_jsonfile(asfilename, asvc):
+            self.services[asvc["uuid"]] = (asfilename, asvc)
+        else:
+            self.services.pop(asvc["uuid"], None)
+
+    def proxy_del(self, domain_uuid):
+        del self.proxies[domain_uuid]
+        proxyfilename = PROXY_FILE_NAME_FORMAT % domain_uuid
+        remove_file("%s/%s" % (MD_DIR, proxyfilename))
+
+    def proxy_write(self, domain_uuid, proxystr):
+        proxyfilename = PROXY_FILE_NAME_FORMAT % domain_uuid
         proxyfilename = "%s/%s" % (MD_DIR, proxyfilename)
-        proxystr = self.proxyconfig(alloc)
         try:
             with open(proxyfilename, "w") as f:
                 f.write(proxystr)
-            pidfile = PID_FILE_NAME_FORMAT % asvc["uuid"]
-            self.mgr.sh("rm -f %s" % pidfile)
+            remove_file(PID_FILE_NAME_FORMAT % domain_uuid)
+            self.proxies[domain_uuid] = proxystr
         except Exception as e:
-            LOG.warn("EPwatcher: Exception in writing proxy file: %s" %
+            self.proxies.pop(domain_uuid, None)
+            LOG.warn("StateWatcher: Exception in writing proxy file: %s" %
                      str(e))
 
     def proxyconfig(self, alloc):
@@ -540,19 +897,19 @@ class SnatConnTrackHandler(object):
         try:
             with open(snatfilename, "w") as f:
                 f.write(conn_track_str)
-            pidfile = PID_FILE_NAME_FORMAT % netns
-            self.mgr.sh("rm -f %s" % pidfile)
-            self.mgr.update_supervisor()
+            remove_file(PID_FILE_NAME_FORMAT % netns)
+            self.mgr.schedule_update_supervisor()
         except Exception as e:
             LOG.warn("ConnTrack: Exception in writing snat file: %s" %
                      str(e))
 
-    def conn_track_del(self, netns):
+    def conn_track_del(self, netns, update_supervisor=True):
         snatfilename = SNAT_FILE_NAME_FORMAT % netns
         snatfilename = "%s/%s" % (MD_DIR, snatfilename)
         try:
             os.remove(snatfilename)
-            self.mgr.update_supervisor()
+            if update_supervisor:
+                self.mgr.schedule_update_supervisor()
         except Exception as e:
             LOG.warn("ConnTrack: Exception in deleting file: %s" % str(e))
 
@@ -579,13 +936,22 @@ class AsMetadataManager(object):
         self.root_helper = root_helper
         self.name = "AsMetadataManager"
         self.md_filename = "%s/%s" % (MD_DIR, MD_SUP_FILE_NAME)
+        self.md_pidfile = "%s/%s" % (MD_DIR, MD_SUP_PID_FILE_NAME)
+        self.supervisor_updater = SupervisorUpdater(self)
         self.integ_bridge = cfg.CONF.OPFLEX.fabric_bridge
+        self.consolidated_proxy = (cfg.CONF.OPFLEX.metadata_proxy_mode ==
+                                   MD_PROXY_CONSOLIDATED)
         self.initialized = False
 
     def init_all(self):
+        start = time.time()
         self.init_host(self.integ_bridge)
+        LOG.info("%s: host initialized in %.3f seconds" % (
+            self.name, time.time() - start))
         self.init_supervisor()
         self.start_supervisor()
+        LOG.info("%s: initialized in %.3f seconds" % (
+            self.name, time.time() - start))
         return
 
     def ensure_initialized(self):
@@ -602,6 +968,8 @@ class AsMetadataManager(object):
         if self.initialized:
             try:
                 self.initialized = False
+                # supervisord is stopped, a pending update is moot
+                self.supervisor_updater.cancel()
                 self.clean_files()
                 self.stop_supervisor()
             except Exception as e:
@@ -647,65 +1015,160 @@ class AsMetadataManager(object):
         self.stop_supervisor()
         self.sh("supervisord -c %s" % self.md_filename)
 
+    def supervisor_rpc(self):
+        transport = supervisor_xmlrpc.SupervisorTransport(
+            None, None, "unix://%s" % MD_SUP_SOCKET)
+        return xmlrpc_client.ServerProxy("http://127.0.0.1",
+                                         transport=transport)
+
+    def rpc_update_supervisor(self):
+        # Same as "supervisorctl update"
+        supervisor = self.supervisor_rpc().supervisor
+        added, changed, removed = supervisor.reloadConfig()[0]
+        for name in removed + changed:
+            try:
+                supervisor.stopProcessGroup(name)
+            except xmlrpc_client.Fault as e:
+                LOG.debug("%s: stopping %s: %s" % (self.name, name, e))
+            supervisor.removeProcessGroup(name)
+        for name in changed + added:
+            supervisor.addProcessGroup(name)
+        LOG.debug("%s: supervisor updated: added %s, changed %s, "
+                  "removed %s" % (self.name, added, changed, removed))
+
     def update_supervisor(self):
+        if supervisor_xmlrpc is not None:
+            try:
+                self.rpc_update_supervisor()
+                return
+            except Exception as e:
+                LOG.warn("%s: Exception in updating supervisor over "
+                         "XML-RPC: %s" % (self.name, str(e)))
         self.sh("supervisorctl -c %s reread" % self.md_filename)
         self.sh("supervisorctl -c %s update" % self.md_filename)
 
+    def schedule_update_supervisor(self):
+        self.supervisor_updater.schedule()
+
     def reload_supervisor(self):
         self.sh("supervisorctl -c %s reload" % self.md_filename)
 
-    def stop_supervisor(self):
+    def supervisor_pid(self):
+        """Get the pid of the running supervisord, None if not running"""
+        try:
+            with open(self.md_pidfile, "r") as f:
+                pid = int(f.read().strip())
+        except (IOError, ValueError):
+            return None
+        try:
+            os.kill(pid, 0)
+        except OSError as e:
+            if e.errno == errno.ESRCH:
+                return None
+        return pid
+
+    def stop_supervisor(self, timeout=MD_SUP_STOP_TIMEOUT):
+        if self.supervisor_pid() is None:
+            return
         self.sh("supervisorctl -c %s shutdown" % self.md_filename)
-        time.sleep(30)
+        deadline = time.time() + timeout
+        while self.supervisor_pid() is not None:
+            if time.time() > deadline:
+                LOG.warn("%s: supervisord still running after %s seconds" %
+                         (self.name, timeout))
+                return
+            time.sleep(MD_SUP_STOP_POLL_INTERVAL)
+
+    def svc_ns_port(self):
+        # Each ip_lib device operation runs a root helper ip command
+        return ip_lib.IPDevice(SVC_NS_PORT, namespace=SVC_NS)
 
     def add_default_route(self, nexthop):
-        self.sh("ip netns exec %s ip route add default via %s" %
-                (SVC_NS, nexthop))
+        self.svc_ns_port().route.add_gateway(nexthop)
+
+    def update_ips(self, add_ips=(), del_ips=()):
+        """Add and delete service IPs in a single ip batch run.
+
+        All the changes go to one root helper "ip -netns of-svc -batch"
+        process. Adding uses "address replace", which is a no-op for an
+        address already there, so the current addresses are not dumped
+        first. With -force, a failed command doesn't stop the others.
+        """
+        cmds = []
+        for ipaddr in del_ips:
+            cmds.append("address del %s/%s dev %s" % (
+                ipaddr, SVC_IP_CIDR, SVC_NS_PORT))
+        for ipaddr in add_ips:
+            cmds.append("address replace %s/%s dev %s" % (
+                ipaddr, SVC_IP_CIDR, SVC_NS_PORT))
+        if not cmds:
+            return
+        try:
+            agent_utils.execute(
+                ['ip', '-netns', SVC_NS, '-force', '-batch', '-'],
+                process_input="\n".join(cmds) + "\n", run_as_root=True)
+        except Exception as e:
+            LOG.warn("%s: Exception in updating IPs %s: %s" % (
+                self.name, cmds, str(e)))
 
     def add_ip(self, ipaddr):
-        self.sh("ip netns exec %s ip addr add %s/%s dev %s" %
-                (SVC_NS, ipaddr, SVC_IP_CIDR, SVC_NS_PORT))
+        self.update_ips(add_ips=[ipaddr])
 
     def del_ip(self, ipaddr):
-        self.sh("ip netns exec %s ip addr del %s/%s dev %s" %
-                (SVC_NS, ipaddr, SVC_IP_CIDR, SVC_NS_PORT))
+        self.update_ips(del_ips=[ipaddr])
 
     def get_asport_mac(self):
-        return self.sh(
-            "ip netns exec %s ip link show %s | "
-            "gawk -e '/link\/ether/ {print $2}'" %
-            (SVC_NS, SVC_NS_PORT))
+        return self.svc_ns_port().link.address or ''
+
+    def ensure_dir(self, dirname):
+        if not os.path.isdir(dirname):
+            try:
+                os.makedirs(dirname)
+            except OSError:
+                self.sh("mkdir -p %s" % dirname)
+        st = os.stat(dirname)
+        owner = "%s:%s" % (pwd.getpwuid(st.st_uid).pw_name,
+                           grp.getgrgid(st.st_gid).gr_name)
+        if owner != MD_DIR_OWNER:
+            self.sh("chown %s %s" % (MD_DIR_OWNER, dirname))
 
     def init_host(self, integ_br):
         # Create required directories
-        self.sh("mkdir -p %s" % PID_DIR)
-        self.sh("rm -f %s/*.pid" % PID_DIR)
-        self.sh("chown %s %s" % (MD_DIR_OWNER, PID_DIR))
-        self.sh("chown %s %s/.." % (MD_DIR_OWNER, PID_DIR))
-        self.sh("mkdir -p %s" % MD_DIR)
-        self.sh("chown %s %s" % (MD_DIR_OWNER, MD_DIR))
-
-        # Create namespace, if needed
-        ns = self.sh("ip netns | grep %s ; true" % SVC_NS)
-        if not ns:
-            self.sh("ip netns add %s" % SVC_NS)
-
-        # Create ports, if needed
-        port = self.sh("ip link show %s 2>&1 | grep qdisc ; true" %
-                       SVC_OVS_PORT)
-        if not port:
-            self.sh("ip link add %s type veth peer name %s" %
-                    (SVC_NS_PORT, SVC_OVS_PORT))
-            self.sh("ip link set dev %s up" % SVC_OVS_PORT)
-            self.sh("ip link set %s netns %s" % (SVC_NS_PORT, SVC_NS))
-            self.sh("ip netns exec %s ip link set dev %s up" %
-                    (SVC_NS, SVC_NS_PORT))
-            self.add_ip(SVC_IP_DEFAULT)
-            self.add_default_route(SVC_NEXTHOP)
+        self.ensure_dir(PID_DIR)
+        for pidfile in glob.glob("%s/*.pid" % PID_DIR):
+            remove_file(pidfile)
+        self.ensure_dir(os.path.dirname(PID_DIR))
+        self.ensure_dir(MD_DIR)
+
+        # Create namespace, if needed, through privsep
+        ip = ip_lib.IPWrapper()
+        if not ip.netns.exists(SVC_NS):
+            ip.netns.add(SVC_NS)
+
+        # Create ports, if needed. The veth pair and the service port are
+        # set up by one root helper "ip -batch" run in each namespace,
+        # instead of one ip command per step.
+        if not os.path.exists("/sys/class/net/%s" % SVC_OVS_PORT):
+            agent_utils.execute(
+                ['ip', '-batch', '-'],
+                process_input="\n".join([
+                    "link add %s type veth peer name %s netns %s" % (
+                        SVC_OVS_PORT, SVC_NS_PORT, SVC_NS),
+                    "link set %s up" % SVC_OVS_PORT, ""]),
+                run_as_root=True)
+            agent_utils.execute(
+                ['ip', '-netns', SVC_NS, '-batch', '-'],
+                process_input="\n".join([
+                    "link set %s up" % SVC_NS_PORT,
+                    "address replace %s/%s dev %s" % (
+                        SVC_IP_DEFAULT, SVC_IP_CIDR, SVC_NS_PORT),
+                    "route replace default via %s" % SVC_NEXTHOP, ""]),
+                run_as_root=True)
+            # The offloads are set with ethtool
             self.sh("ethtool --offload %s tx off" % SVC_OVS_PORT)
             self.sh("ip netns exec %s ethtool --offload %s tx off" %
                     (SVC_NS, SVC_NS_PORT))
-        self.sh("ovs-vsctl add-port %s %s" % (integ_br, SVC_OVS_PORT))
+        ovs_lib.OVSBridge(integ_br).add_port(SVC_OVS_PORT)
 
     def init_supervisor(self):
         def conf(*fnames):
@@ -724,16 +1187,18 @@ class AsMetadataManager(object):
             "supervisor.rpcinterface:make_main_rpcinterface",
             "",
             "[unix_http_server]",
-            "file = /var/lib/neutron/opflex_agent/md-svc-supervisor.sock",
+            "file = %s" % MD_SUP_SOCKET,
+            # the watchers running as neutron update supervisor over it
+            "chmod = 0770",
+            "chown = %s" % MD_DIR_OWNER,
             "",
             "[supervisorctl]",
-            "serverurl = "
-            "unix:///var/lib/neutron/opflex_agent/md-svc-supervisor.sock",
+            "serverurl = unix://%s" % MD_SUP_SOCKET,
             "prompt = md-svc",
             "",
             "[supervisord]",
             "identifier = md-svc-supervisor",
-            "pidfile = /var/lib/neutron/opflex_agent/md-svc-supervisor.pid",
+            "pidfile = %s" % self.md_pidfile,
             "logfile = /var/log/neutron/metadata-supervisor.log",
             "logfile_maxbytes = 10MB",
             "logfile_backups = 3",
@@ -762,35 +1227,59 @@ class AsMetadataManager(object):
             "stderr_logfile=NONE",
             "user=neutron",
             "",
-            "[program:opflex-ep-watcher]",
-            "command=/usr/bin/opflex-ep-watcher " +
-            conf('/usr/share/neutron/neutron-dist.conf',
-                 '/etc/neutron/neutron.conf',
-                 '/etc/neutron/plugins/ml2/ml2_conf_cisco.ini') +
-            "--log-file /var/log/neutron/opflex-ep-watcher.log",
-            "exitcodes=0,2",
-            "stopasgroup=true",
-            "startsecs=10",
-            "startretries=3",
-            "stopwaitsecs=10",
-            "stdout_logfile=NONE",
-            "stderr_logfile=NONE",
-            "user=neutron",
-            "",
-            "[program:opflex-state-watcher]",
-            "command=/usr/bin/opflex-state-watcher " +
-            conf('/usr/share/neutron/neutron-dist.conf',
-                 '/etc/neutron/neutron.conf',
-                 '/etc/neutron/plugins/ml2/ml2_conf_cisco.ini') +
-            "--log-file /var/log/neutron/opflex-state-watcher.log",
-            "exitcodes=0,2",
-            "stopasgroup=true",
-            "startsecs=10",
-            "startretries=3",
-            "stopwaitsecs=10",
-            "stdout_logfile=NONE",
-            "stderr_logfile=NONE",
-            "user=neutron",
+        ])
+        if cfg.CONF.OPFLEX.unified_metadata_watcher:
+            watchers = [("opflex-md-watcher", "/usr/bin/opflex-md-watcher")]
+        else:
+            watchers = [
+                ("opflex-ep-watcher", "/usr/bin/opflex-ep-watcher"),
+                ("opflex-state-watcher", "/usr/bin/opflex-state-watcher"),
+            ]
+        for program, command in watchers:
+            config_str += "\n".join([
+                "",
+                "[program:%s]" % program,
+                "command=%s " % command +
+                conf('/usr/share/neutron/neutron-dist.conf',
+                     '/etc/neutron/neutron.conf',
+                     '/etc/neutron/plugins/ml2/ml2_conf_cisco.ini') +
+                "--log-file /var/log/neutron/%s.log" % program,
+                "exitcodes=0,2",
+                "stopasgroup=true",
+                "startsecs=10",
+                "startretries=3",
+                "stopwaitsecs=10",
+                "stdout_logfile=NONE",
+                "stderr_logfile=NONE",
+                "user=neutron",
+                "",
+            ])
+        if self.consolidated_proxy:
+            config_str += "\n".join([
+                "",
+                "[program:opflex-ns-proxy]",
+                "command=ip netns exec %s "
+                "/usr/bin/opflex-ns-proxy "
+                "--metadata_proxy_socket=/var/lib/neutron/metadata_proxy "
+                "--state_path=/var/lib/neutron "
+                "--pid_file=%s "
+                "--domains_file=%s/%s --metadata_port=80 "
+                "--metadata_proxy_user=neutron "
+                "--metadata_proxy_group=neutron "
+                "--log-dir=/var/log/neutron "
+                "--log-file=opflex-ns-proxy.log" % (
+                    SVC_NS, PID_FILE_NAME_FORMAT % "opflex-ns-proxy",
+                    MD_DIR, STATE_FILENAME_SVC),
+                "exitcodes=0,2",
+                "stopasgroup=true",
+                "startsecs=10",
+                "startretries=3",
+                "stopwaitsecs=10",
+                "stdout_logfile=NONE",
+                "stderr_logfile=NONE",
+                "",
+            ])
+        config_str += "\n".join([
             "",
             "[include]",
             "files = %s/*.proxy %s/*.snat" % (MD_DIR, MD_DIR),
@@ -824,6 +1313,12 @@ def state_watcher_main():
     StateWatcher().run()
 
 
+def md_watcher_main():
+    init_env()
+    MultiWatcher([EpWatcher(threaded=True),
+                  StateWatcher(threaded=True)]).run()
+
+
 def as_metadata_main():
     init_env()
     root_helper = cfg.CONF.AGENT.root_helper
@@ -52,8 +52,30 @@ gbp_opts = [
     cfg.StrOpt('opflex_notify_socket_path',
                default='/var/run/opflex-agent-notif.sock',
                help=_("Path of the Opflex notification socket.")),
+    cfg.StrOpt('opflex_notify_mode', default='process',
+               choices=['process', 'greenthread'],
+               help=_("How the opflex agent runs the virtual IP notification "
+                      "subscriber: in a separate 'process' (default), or as "
+                      "a 'greenthread' of the agent itself.")),
+    cfg.FloatOpt('opflex_notify_batch_window', default=0.5, min=0,
+                 help=_("Time in seconds the opflex notify agent waits for "
+                        "more virtual IP notifications before sending them "
+                        "to the server. Notifications for the same port and "
+                        "IP in that window are coalesced.")),
+    cfg.IntOpt('opflex_notify_max_batch_size', default=100, min=1,
+               help=_("Maximum number of IP address owner updates sent in "
+                      "a single RPC call.")),
+    cfg.FloatOpt('opflex_notify_rate_limit', default=1.0, min=0,
+                 help=_("Maximum rate of IP address owner update RPC calls "
+                        "per second, 0 to disable the rate limiting.")),
     cfg.IntOpt('nat_mtu_size', default=0,
                help=_("MTU size of the NAT namespace interface.")),
+    cfg.IntOpt('snat_provisioning_workers', default=4, min=0,
+               help=_("Number of external segment SNAT namespaces which "
+                      "are provisioned in parallel, in the background of "
+                      "the agent loop. Endpoint files depending on an "
+                      "external segment are written once its SNAT "
+                      "namespace is ready. 0 provisions them inline.")),
     cfg.StrOpt('fabric_bridge', default='br-fabric',
                help=_("The name of the bridge which connects to the ACI "
                       "fabric")),
@@ -76,11 +98,55 @@ gbp_opts = [
     cfg.BoolOpt('enable_snat_conn_track', default=True,
                 help=("Enable the SNAT connection track which will dump "
                       "the output to syslog.")),
+    cfg.StrOpt('file_watcher_mode', default='process',
+               choices=['process', 'thread'],
+               help=_("How the EP and state watchers process the file "
+                      "events. 'process' (default) uses a separate process, "
+                      "'thread' uses a thread of the watcher process and "
+                      "saves the memory of an extra interpreter.")),
+    cfg.FloatOpt('file_watcher_quiet_period', default=0.1, min=0,
+                 help=_("Seconds without new file events the EP and state "
+                        "watchers wait for before processing a batch, so "
+                        "that a burst of writes is processed at once. 0 "
+                        "processes the events already received right "
+                        "away.")),
+    cfg.FloatOpt('file_watcher_max_latency', default=1.0, min=0,
+                 help=_("Maximum seconds the EP and state watchers keep "
+                        "batching file events while waiting for the quiet "
+                        "period, 0 for no limit.")),
+    cfg.BoolOpt('unified_metadata_watcher', default=False,
+                help=_("Run the EP and state watchers of the anycast "
+                       "metadata service in a single opflex-md-watcher "
+                       "process instead of opflex-ep-watcher and "
+                       "opflex-state-watcher.")),
+    cfg.IntOpt('anycast_svc_pool_size', default=1000, min=1, max=4092,
+               help=_("Number of anycast metadata service next-hop IPs, "
+                      "allocated from 169.254.240.3. One IP is used by each "
+                      "L3 domain with endpoints on the host.")),
+    cfg.StrOpt('metadata_proxy_mode', default='per-domain',
+               choices=['per-domain', 'consolidated'],
+               help=_("How the anycast metadata service proxies are run. "
+                      "'per-domain' (default) runs one opflex-ns-proxy "
+                      "process per L3 domain, 'consolidated' runs a single "
+                      "opflex-ns-proxy listening on the next-hop IPs of all "
+                      "the L3 domains.")),
 ]
 
 vpp_opts = [
     cfg.StrOpt('vhostuser_socket_dir', default='/var/run/vpp-sockets',
-               help=_("Path where VPP vhost-user sockets are created by nova"))
+               help=_("Path where VPP vhost-user sockets are created by "
+                      "nova")),
+    cfg.StrOpt('liveness_probe', default='ping',
+               choices=['ping', 'version'],
+               help=_("How the agent checks that VPP is alive. 'ping' "
+                      "(default) sends a control_ping over a persistent "
+                      "connection and only reports a restart when the VPP "
+                      "process changed, 'version' connects and queries the "
+                      "VPP version on every check.")),
+    cfg.BoolOpt('api_metrics', default=False,
+                help=_("Record per message call counts, error counts and "
+                       "latency histograms of the VPP API calls made by the "
+                       "agent. Send SIGUSR2 to the agent to log them.")),
 ]
 
 cfg.CONF.register_opts(gbp_opts, "OPFLEX")
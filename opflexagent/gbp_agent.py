@@ -446,6 +446,7 @@ class GBPOpflexAgent(sg_rpc.SecurityGroupAgentRpcCallbackMixin,
         sleep = False
         while elapsed < self.polling_interval:
             self.port_manager.apply_config()
+            self.ep_manager.apply_async_updates()
             # TODO(ivar): Verify optimal sleep time
             sleep = True
             time.sleep(min(self.config_apply_interval,
@@ -458,6 +459,7 @@ class GBPOpflexAgent(sg_rpc.SecurityGroupAgentRpcCallbackMixin,
                        'elapsed': elapsed})
             # Still apply config at least once
             self.port_manager.apply_config()
+            self.ep_manager.apply_async_updates()
         self.iter_num = self.iter_num + 1
 
     def rpc_loop(self, polling_manager):
@@ -638,6 +640,8 @@ def create_agent_config_map(conf):
     except cfg.NoSuchOptError:
         agent_config['dhcp_domain'] = conf.dns_domain
     agent_config['nat_mtu_size'] = conf.OPFLEX.nat_mtu_size
+    agent_config['snat_provisioning_workers'] = (
+        conf.OPFLEX.snat_provisioning_workers)
     agent_config['nested_domain_uplink_interface'] = (
             conf.OPFLEX.nested_domain_uplink_interface)
     return agent_config
@@ -12,10 +12,16 @@
 #    License for the specific language governing permissions and limitations
 #    under the License.
 
+import collections
+from eventlet.green import socket as green_socket
 import httplib2
+import os
 from oslo_config import cfg
 from oslo_log import log as logging
+from six.moves import http_client as httplib
 import six.moves.urllib.parse as urlparse
+import socket
+import time
 import webob
 
 from neutron.agent.linux import daemon
@@ -27,33 +33,210 @@ from oslo_serialization import jsonutils
 
 LOG = logging.getLogger(__name__)
 
+STREAM_CHUNK_SIZE = 65536
+INSTANCE_NETWORKS_FILE = '%s/%s' % ('/var/lib/neutron/opflex_agent',
+                                    'instance_networks.state')
+
+
+class StateFile(object):
+    """In memory copy of a JSON state file written by the EP watcher.
+
+    The file is parsed again only when it is replaced or modified, which
+    is detected by comparing its inode, size and mtime.
+    """
+
+    def __init__(self, filename):
+        self.filename = filename
+        self.data = {}
+        self.file_id = None
+        self.loads = 0
+
+    def reload(self):
+        try:
+            st = os.stat(self.filename)
+        except OSError as e:
+            if self.file_id is not None:
+                LOG.warning("Exception in reading file: %s" % str(e))
+            self.data = {}
+            self.file_id = None
+            return self.data
+        file_id = (st.st_ino, st.st_size, st.st_mtime)
+        if file_id == self.file_id:
+            return self.data
+        try:
+            with open(self.filename, "r") as f:
+                self.data = jsonutils.load(f) or {}
+            self.file_id = file_id
+            self.loads += 1
+        except Exception as e:
+            LOG.warning("Exception in reading file: %s" % str(e))
+        return self.data
+
+
+class NetworkMap(StateFile):
+    """IP to neutron network map of each domain, reloaded on change."""
+
+    def __init__(self, filename=INSTANCE_NETWORKS_FILE):
+        super(NetworkMap, self).__init__(filename)
+
+    def get_network_id(self, domain_id, remote_address):
+        return self.reload().get(domain_id, {}).get(remote_address)
+
+
+class DomainMap(StateFile):
+    """Next-hop IP to L3 domain map of the anycast services, reloaded on
+    change.
+    """
+
+    def __init__(self, filename):
+        super(DomainMap, self).__init__(filename)
+        self.services = None
+        self.domains = {}
+
+    def get_domain_id(self, next_hop_ip):
+        services = self.reload()
+        if services is not self.services:
+            self.domains = dict((svc.get('next-hop-ip'), domain_id)
+                                for domain_id, svc in services.items())
+            self.services = services
+        return self.domains.get(next_hop_ip)
+
+
+class UnixConnectionPool(object):
+    """Keep-alive connections to the metadata agent Unix domain socket.
+
+    Each pooled httplib2.Http object holds one open connection. A request
+    reusing a connection which the agent closed in the meantime is retried
+    once on a new connection when it is idempotent.
+    """
+
+    RETRY_METHODS = ('GET', 'HEAD')
+
+    def __init__(self, size=0, timeout=None, idle_timeout=None):
+        self.size = size
+        self.timeout = timeout
+        self.idle_timeout = idle_timeout
+        self.free = collections.deque()
+        self.hits = 0
+        self.misses = 0
+        self.stale = 0
+
+    def _new(self):
+        return httplib2.Http(timeout=self.timeout)
+
+    @staticmethod
+    def _close(http):
+        for conn in http.connections.values():
+            conn.close()
+        http.connections.clear()
+
+    def _get(self):
+        now = time.time()
+        while self.free:
+            last_used, http = self.free.pop()
+            if self.idle_timeout and now - last_used > self.idle_timeout:
+                self._close(http)
+                self.stale += 1
+                continue
+            self.hits += 1
+            return http, True
+        self.misses += 1
+        return self._new(), False
+
+    def _put(self, http):
+        if len(self.free) < self.size:
+            self.free.append((time.time(), http))
+        else:
+            self._close(http)
+
+    def _request(self, http, url, **kwargs):
+        return http.request(
+            url,
+            connection_type=agent_utils.UnixDomainHTTPConnection,
+            **kwargs)
+
+    def request(self, url, method='GET', **kwargs):
+        http, reused = self._get()
+        try:
+            resp, content = self._request(http, url, method=method, **kwargs)
+        except (socket.error, httplib.HTTPException,
+                httplib2.HttpLib2Error) as e:
+            self._close(http)
+            if not reused or method not in self.RETRY_METHODS:
+                raise
+            LOG.debug("Pooled connection failed, retrying: %s", e)
+            self.stale += 1
+            http = self._new()
+            resp, content = self._request(http, url, method=method, **kwargs)
+        self._put(http)
+        LOG.debug("Connection pool: %s", self.stats())
+        return resp, content
+
+    def stats(self):
+        requests = self.hits + self.misses
+        return {'hits': self.hits,
+                'misses': self.misses,
+                'stale': self.stale,
+                'hit_rate': float(self.hits) / requests if requests else 0.0}
+
+
+class GreenUnixDomainHTTPConnection(agent_utils.UnixDomainHTTPConnection):
+    """HTTP over the metadata agent Unix socket, without blocking the hub"""
+
+    def connect(self):
+        self.sock = green_socket.socket(green_socket.AF_UNIX,
+                                        green_socket.SOCK_STREAM)
+        if self.timeout:
+            self.sock.settimeout(self.timeout)
+        self.sock.connect(self.socket_path)
+
 
 class NetworkMetadataProxyHandler(object):
     """Proxy AF_INET metadata request through Unix Domain socket.
 
     The Unix domain socket allows the proxy access resource that are not
-    accessible within the isolated tenant context.
+    accessible within the isolated tenant context. With a domain map, the
+    domain of each request is the one whose next-hop IP it was sent to.
     """
 
-    def __init__(self, network_id=None, router_id=None, domain_id=None):
+    def __init__(self, network_id=None, router_id=None, domain_id=None,
+                 pool=None, streaming=False, domain_map=None):
         self.network_id = network_id
         self.router_id = router_id
         self.domain_id = domain_id
+        self.domain_map = domain_map
+        self.network_map = NetworkMap()
+        self.pool = pool or UnixConnectionPool()
+        self.streaming = streaming
 
-        if network_id is None and router_id is None and domain_id is None:
-            msg = _('network_id, router_id, and domain_id are None. '
-                    'One of them must be provided.')
+        if (network_id is None and router_id is None and domain_id is None
+                and domain_map is None):
+            msg = _('network_id, router_id, domain_id and domain_map are '
+                    'None. One of them must be provided.')
             raise ValueError(msg)
 
     @webob.dec.wsgify(RequestClass=webob.Request)
     def __call__(self, req):
         LOG.debug("Request: %s", req)
         try:
+            domain_id = self.domain_id
+            if self.domain_map is not None:
+                # SERVER_NAME is the local address the connection was
+                # accepted on, not the Host header of the request
+                local_address = req.environ.get('SERVER_NAME')
+                domain_id = self.domain_map.get_domain_id(local_address)
+                if domain_id is None:
+                    LOG.warning("No domain for next-hop IP %s" %
+                                local_address)
+                    return webob.exc.HTTPNotFound()
+            if self.streaming:
+                return self._stream_request(req, domain_id)
             return self._proxy_request(req.remote_addr,
                                        req.method,
                                        req.path_info,
                                        req.query_string,
-                                       req.body)
+                                       req.body,
+                                       domain_id=domain_id)
         except Exception:
             LOG.exception("Unexpected error.")
             msg = _('An unknown error has occurred. '
@@ -61,41 +244,139 @@ class NetworkMetadataProxyHandler(object):
             return webob.exc.HTTPInternalServerError(explanation=unicode(msg))
 
     def get_network_id(self, domain_id, remote_address):
-        filedir = '/var/lib/neutron/opflex_agent'
-        filename = 'instance_networks.state'
-        fqfn = '%s/%s' % (filedir, filename)
-
-        nets = None
-        try:
-            with open(fqfn, "r") as f:
-                nets = jsonutils.load(f)
-        except Exception as e:
-            LOG.warning("Exception in reading file: %s" % str(e))
-
-        if nets:
-            if domain_id in nets:
-                if remote_address in nets[domain_id]:
-                    return nets[domain_id][remote_address]
+        network_id = self.network_map.get_network_id(domain_id,
+                                                     remote_address)
+        if network_id:
+            return network_id
         LOG.warning("IP address not found: domain=%s, addr=%s" % (
                     domain_id, remote_address))
         return None
 
-    def _proxy_request(self, remote_address, method, path_info,
-                       query_string, body):
+    def _get_headers(self, remote_address, domain_id=None):
         headers = {
             'X-Forwarded-For': remote_address,
         }
 
-        if self.domain_id:
-            network_id = self.get_network_id(self.domain_id, remote_address)
+        if domain_id:
+            network_id = self.get_network_id(domain_id, remote_address)
             if network_id:
                 headers['X-Neutron-Network-ID'] = network_id
             else:
-                return webob.exc.HTTPNotFound()
+                return None
         elif self.router_id:
             headers['X-Neutron-Router-ID'] = self.router_id
         else:
             headers['X-Neutron-Network-ID'] = self.network_id
+        return headers
+
+    def _error_response(self, status):
+        if status == 400:
+            return webob.exc.HTTPBadRequest()
+        elif status == 404:
+            return webob.exc.HTTPNotFound()
+        elif status == 409:
+            return webob.exc.HTTPConflict()
+        elif status == 500:
+            msg = _(
+                'Remote metadata server experienced an internal server error.'
+            )
+            LOG.debug(msg)
+            return webob.exc.HTTPInternalServerError(explanation=unicode(msg))
+        else:
+            raise Exception(_('Unexpected response code: %s') % status)
+
+    def _stream_request(self, req, domain_id=None):
+        """Proxy the request with bounded memory.
+
+        The request and response bodies are copied in chunks between the
+        client and the metadata agent, the response is returned as soon as
+        its headers are received. A chunked request body is sent upstream
+        chunked as well.
+        """
+        headers = self._get_headers(req.remote_addr, domain_id)
+        if headers is None:
+            return webob.exc.HTTPNotFound()
+
+        url = req.path_info
+        if req.query_string:
+            url = '%s?%s' % (url, req.query_string)
+
+        conn = GreenUnixDomainHTTPConnection('169.254.169.254',
+                                             timeout=self.pool.timeout)
+        try:
+            conn.putrequest(req.method, url)
+            for name, value in headers.items():
+                conn.putheader(name, value)
+            length = req.content_length
+            chunked = length is None and req.headers.get(
+                'Transfer-Encoding', '').lower() == 'chunked'
+            if chunked:
+                conn.putheader('Transfer-Encoding', 'chunked')
+            elif length or req.method in ('POST', 'PUT'):
+                conn.putheader('Content-Length', str(length or 0))
+            conn.endheaders()
+            if chunked:
+                self._send_chunked(conn, req.body_file_raw)
+            elif length and not self._send_body(conn, req.body_file_raw,
+                                                length):
+                LOG.warning("Request body shorter than its Content-Length "
+                            "%s" % length)
+                conn.close()
+                return webob.exc.HTTPBadRequest()
+            resp = conn.getresponse()
+        except Exception:
+            conn.close()
+            raise
+
+        if resp.status != 200:
+            conn.close()
+            return self._error_response(resp.status)
+
+        response = webob.Response(status=resp.status,
+                                  app_iter=self._iter_body(conn, resp),
+                                  headerlist=[])
+        content_type = resp.getheader('content-type')
+        if content_type is not None:
+            response.headers['Content-Type'] = content_type
+        length = resp.getheader('content-length')
+        if length is not None:
+            response.content_length = int(length)
+        return response
+
+    @staticmethod
+    def _send_body(conn, body_file, length):
+        while length > 0:
+            chunk = body_file.read(min(STREAM_CHUNK_SIZE, length))
+            if not chunk:
+                return False
+            conn.send(chunk)
+            length -= len(chunk)
+        return True
+
+    @staticmethod
+    def _send_chunked(conn, body_file):
+        chunk = body_file.read(STREAM_CHUNK_SIZE)
+        while chunk:
+            conn.send(('%x\r\n' % len(chunk)).encode('ascii') + chunk +
+                      b'\r\n')
+            chunk = body_file.read(STREAM_CHUNK_SIZE)
+        conn.send(b'0\r\n\r\n')
+
+    @staticmethod
+    def _iter_body(conn, resp):
+        try:
+            chunk = resp.read(STREAM_CHUNK_SIZE)
+            while chunk:
+                yield chunk
+                chunk = resp.read(STREAM_CHUNK_SIZE)
+        finally:
+            conn.close()
+
+    def _proxy_request(self, remote_address, method, path_info,
+                       query_string, body, domain_id=None):
+        headers = self._get_headers(remote_address, domain_id)
+        if headers is None:
+            return webob.exc.HTTPNotFound()
 
         url = urlparse.urlunsplit((
             'http',
@@ -104,13 +385,11 @@ class NetworkMetadataProxyHandler(object):
             query_string,
             ''))
 
-        h = httplib2.Http()
-        resp, content = h.request(
+        resp, content = self.pool.request(
             url,
             method=method,
             headers=headers,
-            body=body,
-            connection_type=agent_utils.UnixDomainHTTPConnection)
+            body=body)
 
         if resp.status == 200:
             LOG.debug(resp)
@@ -120,26 +399,14 @@ class NetworkMetadataProxyHandler(object):
             response.headers['Content-Type'] = resp['content-type']
             response.body = content
             return response
-        elif resp.status == 400:
-            return webob.exc.HTTPBadRequest()
-        elif resp.status == 404:
-            return webob.exc.HTTPNotFound()
-        elif resp.status == 409:
-            return webob.exc.HTTPConflict()
-        elif resp.status == 500:
-            msg = _(
-                'Remote metadata server experienced an internal server error.'
-            )
-            LOG.debug(msg)
-            return webob.exc.HTTPInternalServerError(explanation=unicode(msg))
-        else:
-            raise Exception(_('Unexpected response code: %s') % resp.status)
+        return self._error_response(resp.status)
 
 
 class ProxyDaemon(daemon.Daemon):
     def __init__(self, pidfile, port, network_id=None, router_id=None,
                  domain_id=None,
-                 user=None, group=None, host="0.0.0.0"):
+                 user=None, group=None, host="0.0.0.0", pool_size=0,
+                 pool_timeout=None, pool_idle_timeout=None, streaming=False):
         uuid = domain_id or network_id or router_id
         super(ProxyDaemon, self).__init__(pidfile, uuid=uuid, user=user,
                                           group=group)
@@ -148,12 +415,21 @@ class ProxyDaemon(daemon.Daemon):
         self.domain_id = domain_id
         self.port = port
         self.host = host
+        self.pool_size = pool_size
+        self.pool_timeout = pool_timeout
+        self.pool_idle_timeout = pool_idle_timeout
+        self.streaming = streaming
 
     def run(self):
+        pool = UnixConnectionPool(self.pool_size,
+                                  timeout=self.pool_timeout,
+                                  idle_timeout=self.pool_idle_timeout)
         handler = NetworkMetadataProxyHandler(
             self.network_id,
             self.router_id,
-            self.domain_id)
+            self.domain_id,
+            pool=pool,
+            streaming=self.streaming)
         proxy = wsgi.Server('opflex-network-metadata-proxy')
         proxy.start(handler, self.port, host=self.host)
 
@@ -163,6 +439,45 @@ class ProxyDaemon(daemon.Daemon):
         proxy.wait()
 
 
+class MultiDomainProxyDaemon(daemon.Daemon):
+    """Proxy the metadata requests of all the L3 domains in one process.
+
+    A single listener receives the requests sent to the next-hop IPs of all
+    the domains found in the anycast services state file, the local address
+    of each connection selects its domain. Privileges are dropped once the
+    listener is bound.
+    """
+
+    def __init__(self, pidfile, port, domains_file, user=None, group=None,
+                 host="0.0.0.0", pool_size=0, pool_timeout=None,
+                 pool_idle_timeout=None, streaming=False):
+        super(MultiDomainProxyDaemon, self).__init__(
+            pidfile, uuid='opflex-ns-proxy', user=user, group=group)
+        self.port = port
+        self.host = host
+        self.domains_file = domains_file
+        self.pool_size = pool_size
+        self.pool_timeout = pool_timeout
+        self.pool_idle_timeout = pool_idle_timeout
+        self.streaming = streaming
+
+    def run(self):
+        pool = UnixConnectionPool(self.pool_size,
+                                  timeout=self.pool_timeout,
+                                  idle_timeout=self.pool_idle_timeout)
+        handler = NetworkMetadataProxyHandler(
+            domain_map=DomainMap(self.domains_file),
+            pool=pool,
+            streaming=self.streaming)
+        proxy = wsgi.Server('opflex-ns-proxy')
+        proxy.start(handler, self.port, host=self.host)
+
+        # Drop privileges after port bind
+        super(MultiDomainProxyDaemon, self).run()
+
+        proxy.wait()
+
+
 def main():
     opts = [
         cfg.StrOpt('network_id',
@@ -199,6 +514,30 @@ def main():
                    default=None,
                    help=_("Group (gid or name) running metadata proxy after "
                           "its initialization")),
+        cfg.IntOpt('metadata_proxy_pool_size',
+                   default=8,
+                   help=_("Number of idle keep-alive connections to the "
+                          "metadata proxy socket kept open, 0 opens a new "
+                          "connection for each request.")),
+        cfg.IntOpt('metadata_proxy_pool_timeout',
+                   default=30,
+                   help=_("Timeout in seconds of the requests sent to the "
+                          "metadata proxy socket.")),
+        cfg.IntOpt('metadata_proxy_pool_idle_timeout',
+                   default=60,
+                   help=_("Idle time in seconds after which a pooled "
+                          "connection is closed instead of reused.")),
+        cfg.BoolOpt('metadata_proxy_streaming',
+                    default=False,
+                    help=_("Copy the request and response bodies in chunks "
+                           "between the client and the metadata proxy "
+                           "socket instead of buffering them, one new "
+                           "connection is used for each request.")),
+        cfg.StrOpt('domains_file',
+                   help=_("Anycast services state file. When set, the "
+                          "metadata of all the L3 domains it lists is "
+                          "proxied by this process, the next-hop IP a "
+                          "request is sent to selects its domain.")),
     ]
 
     cfg.CONF.register_cli_opts(opts)
@@ -207,14 +546,32 @@ def main():
     config.setup_logging()
     utils.log_opt_values(LOG)
 
-    proxy = ProxyDaemon(cfg.CONF.pid_file,
-                        cfg.CONF.metadata_port,
-                        network_id=cfg.CONF.network_id,
-                        router_id=cfg.CONF.router_id,
-                        domain_id=cfg.CONF.domain_id,
-                        user=cfg.CONF.metadata_proxy_user,
-                        group=cfg.CONF.metadata_proxy_group,
-                        host=cfg.CONF.metadata_host)
+    if cfg.CONF.domains_file:
+        proxy = MultiDomainProxyDaemon(
+            cfg.CONF.pid_file,
+            cfg.CONF.metadata_port,
+            cfg.CONF.domains_file,
+            user=cfg.CONF.metadata_proxy_user,
+            group=cfg.CONF.metadata_proxy_group,
+            host=cfg.CONF.metadata_host,
+            pool_size=cfg.CONF.metadata_proxy_pool_size,
+            pool_timeout=cfg.CONF.metadata_proxy_pool_timeout,
+            pool_idle_timeout=cfg.CONF.metadata_proxy_pool_idle_timeout,
+            streaming=cfg.CONF.metadata_proxy_streaming)
+    else:
+        proxy = ProxyDaemon(
+            cfg.CONF.pid_file,
+            cfg.CONF.metadata_port,
+            network_id=cfg.CONF.network_id,
+            router_id=cfg.CONF.router_id,
+            domain_id=cfg.CONF.domain_id,
+            user=cfg.CONF.metadata_proxy_user,
+            group=cfg.CONF.metadata_proxy_group,
+            host=cfg.CONF.metadata_host,
+            pool_size=cfg.CONF.metadata_proxy_pool_size,
+            pool_timeout=cfg.CONF.metadata_proxy_pool_timeout,
+            pool_idle_timeout=cfg.CONF.metadata_proxy_pool_idle_timeout,
+            streaming=cfg.CONF.metadata_proxy_streaming)
 
     if cfg.CONF.daemonize:
         proxy.start()
@@ -11,12 +11,15 @@
 #    License for the specific language governing permissions and limitations
 #    under the License.
 
+import collections
+import eventlet
 import json
 import multiprocessing
 import os.path
 import socket
 import struct
 import sys
+import threading
 import time
 
 from neutron.common import config
@@ -26,10 +29,167 @@ from opflexagent import config as ofcfg  # noqa
 from opflexagent import rpc
 from oslo_config import cfg
 from oslo_log import log as logging
+import oslo_messaging
 
 
 LOG = logging.getLogger(__name__)
 
+# Remote errors of servers not implementing ip_address_owner_update_list
+UNSUPPORTED_RPC_ERRORS = ('UnsupportedVersion', 'NoSuchMethod')
+
+
+# Messages on the notification socket are prefixed by their length
+FRAME_HEADER = struct.Struct('!I')
+MAX_FRAME_SIZE = 16 * 1024 * 1024
+READ_SIZE = 65536
+
+
+class FrameReader(object):
+    """Buffered reader of length prefixed messages from a stream socket
+
+    Messages may be split over several reads and a single read may
+    return several messages, the partial data stays in the buffer.
+    """
+
+    def __init__(self, sock, read_size=READ_SIZE):
+        self.sock = sock
+        self.read_size = read_size
+        self.buf = bytearray()
+        self.pos = 0
+
+    def _next_frame(self):
+        available = len(self.buf) - self.pos
+        if available < FRAME_HEADER.size:
+            return None
+        msg_len = FRAME_HEADER.unpack_from(self.buf, self.pos)[0]
+        if msg_len > MAX_FRAME_SIZE:
+            raise ValueError('Unexpected message length {}'.format(msg_len))
+        if available < FRAME_HEADER.size + msg_len:
+            return None
+        start = self.pos + FRAME_HEADER.size
+        self.pos = start + msg_len
+        return bytes(self.buf[start:self.pos])
+
+    def read(self):
+        """Return the next message, None at end of file"""
+        while True:
+            msg = self._next_frame()
+            if msg is not None:
+                return msg
+            data = self.sock.recv(self.read_size)
+            if not data:
+                if len(self.buf) > self.pos:
+                    raise ValueError('Unexpected end-of-file')
+                return None
+            # drop the consumed messages before buffering more
+            del self.buf[:self.pos]
+            self.pos = 0
+            self.buf.extend(data)
+
+
+class RateLimiter(object):
+    """Token bucket allowing rate calls per second, burst at once"""
+
+    def __init__(self, rate, burst=1):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.last = time.time()
+
+    def wait(self):
+        """Block until a call is allowed, return the time waited"""
+        if self.rate <= 0:
+            return 0
+        now = time.time()
+        self.tokens = min(self.burst,
+                          self.tokens + (now - self.last) * self.rate)
+        self.last = now
+        delay = 0
+        if self.tokens < 1:
+            delay = (1 - self.tokens) / self.rate
+            time.sleep(delay)
+            self.tokens = 1
+            self.last = now + delay
+        self.tokens -= 1
+        return delay
+
+
+class NotificationBatcher(object):
+    """Coalesce notifications by (port, ip) and send them in batches
+
+    The notifications received within window seconds of the first
+    pending one go out together, in batches of up to max_size, while
+    send() is called at most rate times per second.
+    """
+
+    def __init__(self, send, window=0, max_size=100, rate=0):
+        self.send = send
+        self.window = window
+        self.max_size = max_size
+        self.limiter = RateLimiter(rate)
+        self.pending = collections.OrderedDict()
+        self.cond = threading.Condition()
+        self.received = 0
+        self.coalesced = 0
+        self.sent = 0
+        self.batches = 0
+        self.running = True
+
+    def add(self, notification):
+        key = (notification['port'], notification['ip_address_v4'])
+        with self.cond:
+            self.received += 1
+            if key in self.pending:
+                # only the latest owner matters
+                self.coalesced += 1
+                del self.pending[key]
+            self.pending[key] = notification
+            self.cond.notify()
+
+    def get_batch(self):
+        with self.cond:
+            while self.running and not self.pending:
+                self.cond.wait()
+            full = len(self.pending) >= self.max_size
+        if not full and self.window:
+            time.sleep(self.window)
+        with self.cond:
+            batch = []
+            while self.pending and len(batch) < self.max_size:
+                batch.append(self.pending.popitem(last=False)[1])
+            return batch
+
+    def flush(self):
+        batch = self.get_batch()
+        if not batch:
+            return
+        self.limiter.wait()
+        self.send(batch)
+        self.sent += len(batch)
+        self.batches += 1
+        LOG.debug('Batcher: sent {} notification(s), received: {}, '
+                  'coalesced: {}, sent: {}, batches: {}'.format(
+                      len(batch), self.received, self.coalesced,
+                      self.sent, self.batches))
+
+    def stop(self):
+        with self.cond:
+            self.running = False
+            self.cond.notify_all()
+
+    def run(self):
+        while self.running:
+            try:
+                self.flush()
+            except Exception as e:
+                LOG.error('Batcher: {}'.format(e))
+
+    def start(self):
+        thread = threading.Thread(target=self.run, name='notify-batcher')
+        thread.daemon = True
+        thread.start()
+        return thread
+
 
 class OpflexNotifyAgent(object):
     def __init__(self):
@@ -38,27 +198,52 @@ class OpflexNotifyAgent(object):
         self.context = context.get_admin_context_without_session()
         self.sockname = cfg.CONF.OPFLEX.opflex_notify_socket_path
         self.of_rpc = rpc.GBPServerRpcApi(rpc.TOPIC_OPFLEX)
+        self.list_rpc = True
+        self.running = True
+        self.client = None
+        self.batcher = NotificationBatcher(
+            self._send,
+            window=cfg.CONF.OPFLEX.opflex_notify_batch_window,
+            max_size=cfg.CONF.OPFLEX.opflex_notify_max_batch_size,
+            rate=cfg.CONF.OPFLEX.opflex_notify_rate_limit)
 
     def _handle(self, uuids, mac, addr):
         LOG.debug('Handle: endpoint(s): {}, mac: {}, addr: {}'.
             format(uuids, mac, addr))
+        for uuid in uuids:
+            uuid = uuid.split('|')[0]
+            if not uuid:
+                continue
+            notification = {
+                'port': uuid,
+                'ip_address_v4': addr,
+                'mac': mac,
+            }
+            LOG.debug('Handle: notification: {}'.format(notification))
+            self.batcher.add(notification)
+
+    def _send(self, notifications):
+        LOG.debug('Send: {} notification(s)'.format(len(notifications)))
         try:
-            for uuid in uuids:
-                uuid = uuid.split('|')[0]
-                if not uuid:
-                    continue
-                notification = {
-                    'port': uuid,
-                    'ip_address_v4': addr,
-                    'mac': mac,
-                }
-                LOG.debug('Handle: notification: {}'.format(notification))
+            if self.list_rpc:
+                try:
+                    self.of_rpc.ip_address_owner_update_list(
+                        self.context, self.agent_id,
+                        ip_owner_infos=notifications, host=self.host)
+                    return
+                except oslo_messaging.RemoteError as e:
+                    if e.exc_type not in UNSUPPORTED_RPC_ERRORS:
+                        raise
+                    LOG.info('Send: Server does not support batched '
+                             'updates, falling back to single updates')
+                    self.list_rpc = False
+            for notification in notifications:
                 self.of_rpc.ip_address_owner_update(
                     self.context, self.agent_id,
                     notification, host=self.host)
         except Exception as e:
-            # skip this notification, but don't kill daemon
-            LOG.error('Handle: In sending RPC: {}'.format(e))
+            # skip these notifications, but don't kill daemon
+            LOG.error('Send: In sending RPC: {}'.format(e))
 
     def _connect(self):
         name = self.sockname
@@ -80,9 +265,7 @@ class OpflexNotifyAgent(object):
                     },
                 }
                 msg = bytearray(json.dumps(subscribe))
-                msg_len = socket.htonl(len(msg))
-                client.send(struct.pack('I', msg_len))
-                client.send(msg)
+                client.sendall(FRAME_HEADER.pack(len(msg)) + msg)
                 LOG.info('Connect: Established: {}'.format(name))
             except Exception as e:
                 # set client to None, but don't kill daemon
@@ -95,28 +278,28 @@ class OpflexNotifyAgent(object):
 
         return client
 
-    def _read_msg(self, client):
+    def _read_msg(self, reader):
         LOG.debug('Read: Waiting for notification ...')
 
         notification = None
         try:
-            data = client.recv(4)
-            if (len(data) < 4):
-                raise ValueError('Unexpected end-of-file')
-
-            msg_len = socket.ntohl(struct.unpack('I', data)[0])
-            msg = client.recv(msg_len)
-            if (len(msg) < msg_len):
-                raise ValueError('Unexpected message length {} (msg_len {})'.
-                    format(len(msg), msg_len))
-
-            notif = json.loads(msg)
-            if ('method' not in notif or 'params' not in notif):
-                raise ValueError('Unexpected message {}'.format(notif))
-
-            if (notif['method'] == 'virtual-ip'):
-                p = notif['params']
-                if ('uuid' in p and 'mac' in p and 'ip' in p):
+            while notification is None:
+                msg = reader.read()
+                if msg is None:
+                    LOG.info('Read: Connection closed')
+                    break
+                try:
+                    notif = json.loads(msg)
+                    method = notif['method']
+                    p = notif['params']
+                except (ValueError, KeyError, TypeError) as ve:
+                    # the framing is intact, just skip this message
+                    LOG.error('Read: Could not decode message {}: {}'.format(
+                        msg, ve))
+                    continue
+
+                if (method == 'virtual-ip' and
+                        'uuid' in p and 'mac' in p and 'ip' in p):
                     notification = (p['uuid'], p['mac'], p['ip'])
 
         except ValueError as ve:
@@ -128,9 +311,9 @@ class OpflexNotifyAgent(object):
         return notification
 
     def _throttle(self):
-        LOG.debug('Trrottle ...')
+        LOG.debug('Throttle ...')
         try:
-            time.sleep(1)  # throttle to less than 1 update/sec
+            time.sleep(1)  # don't reconnect more than once a second
         except Exception as e:
             LOG.warning('Throttle: {}'.format(e))
 
@@ -153,17 +336,19 @@ class OpflexNotifyAgent(object):
                         "notifications will not be sent")
             return
 
-        while True:
+        self.batcher.start()
+        client = None
+        while self.running:
             try:
-                client = self._connect()
+                client = self.client = self._connect()
                 if client is not None:
-                    while True:
-                        msg = self._read_msg(client)
+                    reader = FrameReader(client)
+                    while self.running:
+                        msg = self._read_msg(reader)
                         if msg is not None:
                             self._handle(*msg)
-                            self._throttle()
                         else:
-                            # unexpected msg, exit inner loop
+                            # connection lost, exit inner loop
                             break
                     LOG.debug('Run: Close client')
                     client.close()
@@ -174,8 +359,52 @@ class OpflexNotifyAgent(object):
             except Exception as e:
                 LOG.error('Run: {}'.format(e))
 
+    def stop(self):
+        self.running = False
+        self.batcher.stop()
+        if self.client is not None:
+            try:
+                self.client.close()
+            except Exception as e:
+                LOG.warning('Stop: {}'.format(e))
+
+
+class OpflexNotifyGreenWorker(object):
+    """Runs the notify agent as greenthreads of the calling process
+
+    Relies on the caller having monkey patched the standard library, so
+    the socket reads and the batcher thread only block their own
+    greenthread while the RPCs are sent.
+    """
+
+    def __init__(self):
+        self.agent = OpflexNotifyAgent()
+        self.thread = None
+
+    def start(self):
+        self.thread = eventlet.spawn(self.agent.run)
+
+    def is_alive(self):
+        return self.thread is not None and not self.thread.dead
+
+    def terminate(self):
+        self.agent.stop()
+        if self.thread is not None:
+            self.thread.kill()
+
+
+def worker(initconfig=False, daemon=True, mode=None):
+    if mode is None:
+        mode = cfg.CONF.OPFLEX.opflex_notify_mode
+    if mode == 'greenthread':
+        worker = None
+        try:
+            worker = OpflexNotifyGreenWorker()
+            worker.start()
+        except Exception as e:
+            LOG.error('Worker Initalization: {}'.format(e))
+        return worker
 
-def worker(initconfig=False, daemon=True):
     class OpflexNotifyWorker(multiprocessing.Process):
         def __init__(self):
             self.agent = None
@@ -202,7 +431,7 @@ def worker(initconfig=False, daemon=True):
 
 
 def main():
-    worker(initconfig=True, daemon=False)
+    worker(initconfig=True, daemon=False, mode='process')
     return
 
 
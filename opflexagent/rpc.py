@@ -74,9 +74,11 @@ class GBPServerRpcApi(object):
     """Agent-side RPC (stub) for agent-to-plugin interaction.
 
     Version 1.1: add async request_* APIs
+    Version 1.2: add ip_address_owner_update_list
     """
 
     GBP_RPC_VERSION = "1.1"
+    GBP_RPC_LIST_VERSION = "1.2"
 
     def __init__(self, topic):
         target = oslo_messaging.Target(
@@ -149,6 +151,16 @@ class GBPServerRpcApi(object):
         cctxt.call(context, 'ip_address_owner_update', agent_id=agent_id,
                    ip_owner_info=ip_owner_info, host=host)
 
+    @log.log_method_call
+    def ip_address_owner_update_list(self, context, agent_id,
+                                     ip_owner_infos=None, host=None):
+        # Only servers implementing 1.2 know about this call, older ones
+        # raise an UnsupportedVersion error
+        cctxt = self.client.prepare(version=self.GBP_RPC_LIST_VERSION)
+        cctxt.call(context, 'ip_address_owner_update_list',
+                   agent_id=agent_id, ip_owner_infos=ip_owner_infos,
+                   host=host)
+
 
 class GBPServerRpcCallback(object):
     """Plugin-side RPC (implementation) for agent-to-plugin interaction."""
@@ -156,8 +168,9 @@ class GBPServerRpcCallback(object):
     # History
     #   1.0 Initial version
     #   1.1 Async request_* APIs
+    #   1.2 ip_address_owner_update_list
 
-    RPC_API_VERSION = "1.1"
+    RPC_API_VERSION = "1.2"
     target = oslo_messaging.Target(version=RPC_API_VERSION)
 
     def __init__(self, gbp_driver, agent_notifier=None):
@@ -237,6 +250,11 @@ class GBPServerRpcCallback(object):
     def ip_address_owner_update(self, context, **kwargs):
         self.gbp_driver.ip_address_owner_update(context, **kwargs)
 
+    def ip_address_owner_update_list(self, context, **kwargs):
+        for ip_owner_info in kwargs.pop('ip_owner_infos', []):
+            self.gbp_driver.ip_address_owner_update(
+                context, ip_owner_info=ip_owner_info, **kwargs)
+
 
 class OpenstackRpcMixin(object):
     """A mix-in that enable Opflex agent
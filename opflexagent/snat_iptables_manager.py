@@ -11,11 +11,15 @@
 #    under the License.
 
 
+import collections
+import contextlib
+import eventlet
 import hashlib
 import netaddr
 
 from neutron.agent.linux import ip_lib
 from neutron.agent.linux import iptables_manager
+from neutron.agent.linux import utils as agent_utils
 from oslo_config import cfg
 from oslo_log import log as logging
 
@@ -31,6 +35,8 @@ class SnatIptablesManager(object):
         self.int_br = int_br
         self.snat_conn_track_handler = (
             as_metadata_manager.SnatConnTrackHandler())
+        self._in_inventory = False
+        self._namespaces = None
 
     def _cleanup(self, if_name, ns_name):
         self.int_br.delete_port(if_name)
@@ -66,17 +72,26 @@ class SnatIptablesManager(object):
         return if_dev
 
     def _setup_routes(self, if_dev, ver, ip_start, ip_end, gw_ip):
+        """Set the address and gateway, return the local routes to add"""
         gw_ip_net = netaddr.IPNetwork(gw_ip)
         if_dev.addr.add("%s/%s" % (ip_start, gw_ip_net.prefixlen))
         if_dev.route.add_gateway(str(gw_ip_net.ip))
-        if ip_start != ip_end:
-            local_nets = netaddr.cidr_merge(netaddr.iter_iprange(ip_start,
-                                                                 ip_end))
-            max_pfx_len = (ver == 4 and 32 or 128)
-            for l in local_nets:
-                if l.prefixlen < max_pfx_len or str(l.ip) != ip_start:
-                    if_dev.route._as_root('add', 'local', str(l),
-                                          'dev', if_dev.name, options=[ver])
+        if ip_start == ip_end:
+            return []
+        # The cover is computed from the range boundaries, the addresses
+        # of the range are never enumerated
+        local_nets = netaddr.iprange_to_cidrs(ip_start, ip_end)
+        max_pfx_len = (ver == 4 and 32 or 128)
+        return [net for net in local_nets
+                if net.prefixlen < max_pfx_len or str(net.ip) != ip_start]
+
+    def _add_local_routes(self, ns, if_name, local_nets):
+        if not local_nets:
+            return
+        cmds = ''.join("route add local %s dev %s\n" % (net, if_name)
+                       for net in local_nets)
+        agent_utils.execute(['ip', '-netns', ns, '-batch', '-'],
+                            process_input=cmds, run_as_root=True)
 
     def _setup_iptables(self, netns, if_name, ip_start, ip_end,
                         ip6_start, ip6_end):
@@ -136,13 +151,17 @@ class SnatIptablesManager(object):
         LOG.debug(_("Created namespace %(ns)s, and added port %(pt)s to it"),
                   {'ns': ns, 'pt': next_hop_if})
 
+        local_nets = []
         if use_v4:
-            self._setup_routes(if_dev, 4, ip_start, ip_end, ip_gw)
+            local_nets += self._setup_routes(if_dev, 4, ip_start, ip_end,
+                                             ip_gw)
             LOG.debug(_("Set IPv4 address and routes"))
 
         if use_v6:
-            self._setup_routes(if_dev, 6, ip6_start, ip6_end, ip6_gw)
+            local_nets += self._setup_routes(if_dev, 6, ip6_start, ip6_end,
+                                             ip6_gw)
             LOG.debug(_("Set IPv6 address and routes"))
+        self._add_local_routes(ns, if_dev.name, local_nets)
 
         self._setup_iptables(ns, next_hop_if, ip_start, ip_end,
                              ip6_start, ip6_end)
@@ -153,13 +172,141 @@ class SnatIptablesManager(object):
         next_hop_if = next_hop_if or self._get_hash_for_es(es_name)
         self._cleanup(next_hop_if, next_hop_if)
 
+    def _get_namespaces(self):
+        if self._namespaces is not None:
+            return self._namespaces
+        namespaces = set(ns for ns in ip_lib.IPWrapper.get_namespaces()
+                         if ns.startswith(self.IFACE_PREFIX))
+        if self._in_inventory:
+            self._namespaces = namespaces
+        return namespaces
+
+    @contextlib.contextmanager
+    def inventory(self):
+        """Snapshot the SNAT namespaces for a bulk operation.
+
+        check_if_exists() and cleanup_snat_all() called in the context share
+        a single listing of the namespaces, taken when first needed, instead
+        of one lookup each.
+        """
+        self._in_inventory = True
+        try:
+            yield
+        finally:
+            self._in_inventory = False
+            self._namespaces = None
+
     def cleanup_snat_all(self, exclude_es=[]):
         exclude_ports = set([self._get_hash_for_es(e) for e in exclude_es])
         ports = [p for p in self.int_br.get_port_name_list()
                  if p.startswith(self.IFACE_PREFIX) and p not in exclude_ports]
-        for ifn in ports:
-            self._cleanup(ifn, ifn)
+        if not ports:
+            return
+        stale_ns = sorted(self._get_namespaces().intersection(ports))
+        ovsdb = self.int_br.ovsdb
+        with self.int_br.ovsdb_transaction() as txn:
+            for ifn in ports:
+                txn.add(ovsdb.del_port(ifn, self.int_br.br_name))
+        ip_wrapper_root = ip_lib.IPWrapper()
+        conn_track = cfg.CONF.OPFLEX.enable_snat_conn_track
+        for ns_name in stale_ns:
+            if conn_track:
+                self.snat_conn_track_handler.conn_track_del(
+                    ns_name, update_supervisor=False)
+            ip_wrapper_root.netns.delete(ns_name)
+        if conn_track and stale_ns:
+            self.snat_conn_track_handler.mgr.schedule_update_supervisor()
+        LOG.debug("Removed %(ports)d stale SNAT ports and %(ns)d namespaces",
+                  {'ports': len(ports), 'ns': len(stale_ns)})
 
     def check_if_exists(self, es_name):
         ns_name = self._get_hash_for_es(es_name)
+        if self._in_inventory:
+            return ns_name in self._get_namespaces()
         return ip_lib.IPWrapper().netns.exists(ns_name)
+
+
+class SnatProvisioner(object):
+    """Set up the SNAT namespaces of external segments in the background
+
+    Each external segment being set up is a greenthread of a pool, so that
+    independent segments are provisioned in parallel without blocking the
+    agent loop. The segments scheduled while all the workers are busy are
+    queued, and started as workers complete. The results are collected
+    with get_ready().
+    """
+
+    def __init__(self, snat_iptables, workers):
+        self.snat_iptables = snat_iptables
+        self.pool = eventlet.GreenPool(workers)
+        self.queued = collections.OrderedDict()
+        self.futures = {}
+        self.cancelled = {}
+
+    def provision(self, es_name, *args, **kwargs):
+        if es_name not in self.futures and es_name not in self.queued:
+            LOG.debug("Scheduling SNAT setup for %s", es_name)
+            self.queued[es_name] = (args, kwargs)
+            self._start_queued()
+
+    def _start_queued(self, *ignored):
+        # GreenPool.spawn() blocks the caller when no worker is free
+        while self.queued and self.pool.free():
+            es_name, (args, kwargs) = self.queued.popitem(last=False)
+            future = self.pool.spawn(
+                self._setup, es_name, self.cancelled.pop(es_name, None),
+                *args, **kwargs)
+            self.futures[es_name] = future
+            # Linked after the pool, which frees the worker first
+            future.link(self._start_queued)
+
+    def _setup(self, es_name, previous, *args, **kwargs):
+        if self.futures.get(es_name) is not eventlet.getcurrent():
+            return (None, None)
+        if previous:
+            # Don't race with a cancelled setup of the same namespace
+            try:
+                previous.wait()
+            except Exception:
+                pass
+        return self.snat_iptables.setup_snat_for_es(es_name, *args, **kwargs)
+
+    def pending(self, es_name):
+        return es_name in self.futures or es_name in self.queued
+
+    def cancel(self, es_name):
+        # A setup in progress runs to completion, its result is dropped
+        if self.queued.pop(es_name, None):
+            LOG.debug("Cancelling SNAT setup for %s", es_name)
+        future = self.futures.pop(es_name, None)
+        if future:
+            LOG.debug("Cancelling SNAT setup for %s", es_name)
+            self.cancelled[es_name] = future
+
+    def get_ready(self):
+        """Return {es_name: (result, error)} for the completed setups."""
+        ready = {}
+        for es_name, future in self.futures.items():
+            if not future.dead:
+                continue
+            del self.futures[es_name]
+            try:
+                ready[es_name] = (future.wait(), None)
+            except Exception as e:
+                ready[es_name] = (None, e)
+        return ready
+
+    def get_cancelled(self):
+        """Return the segments whose cancelled setup completed.
+
+        Such a setup may have completed after the segment was cleaned up,
+        unless the segment was scheduled again its namespace is left over.
+        """
+        cancelled = []
+        for es_name, future in self.cancelled.items():
+            if not future.dead:
+                continue
+            del self.cancelled[es_name]
+            if not self.pending(es_name):
+                cancelled.append(es_name)
+        return cancelled
@@ -0,0 +1,657 @@
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+import errno
+import itertools
+import os
+import shutil
+import sys
+import tempfile
+import threading
+import time
+
+import mock
+from six.moves import queue as Queue
+sys.modules["pyinotify"] = mock.Mock()
+
+from opflexagent import as_metadata_manager
+
+from neutron.tests import base
+from oslo_config import cfg
+from oslo_serialization import jsonutils
+
+
+class TestEpWatcher(base.BaseTestCase):
+
+    def setUp(self):
+        super(TestEpWatcher, self).setUp()
+        self.ep_dir = tempfile.mkdtemp()
+        self.md_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.ep_dir)
+        self.addCleanup(shutil.rmtree, self.md_dir)
+        cfg.CONF.set_override('epg_mapping_dir', self.ep_dir, 'OPFLEX')
+        mock.patch('multiprocessing.Process').start()
+        mock.patch.object(as_metadata_manager, 'MD_DIR', self.md_dir).start()
+        self.watcher = as_metadata_manager.EpWatcher()
+
+    def _write_ep(self, name, domain, network=None, ips=None, **kwargs):
+        ep = {'domain-name': domain, 'domain-policy-space': 'common'}
+        if network:
+            ep['neutron-network'] = network
+            ep['anycast-return-ip'] = ips or []
+        ep.update(kwargs)
+        with open('%s/%s.ep' % (self.ep_dir, name), 'w') as f:
+            jsonutils.dump(ep, f)
+        return ('update', '%s/%s.ep' % (self.ep_dir, name))
+
+    def _read_state(self):
+        svc = as_metadata_manager.read_jsonfile(self.watcher.svcfile)
+        nets = as_metadata_manager.read_jsonfile(self.watcher.netsfile)
+        return svc, nets
+
+    def test_incremental_updates(self):
+        uuid1 = self.watcher.gen_domain_uuid('common', 'd1')
+        uuid2 = self.watcher.gen_domain_uuid('common', 'd2')
+        self.watcher.process([
+            self._write_ep('ep1', 'd1', 'net1', ['10.0.0.1']),
+            self._write_ep('ep2', 'd1', 'net1', ['10.0.0.2']),
+            self._write_ep('ep3', 'd2', 'net2', ['10.0.1.1'])])
+        svc, nets = self._read_state()
+        self.assertEqual([uuid1, uuid2], sorted(svc))
+        self.assertEqual({'10.0.0.1': 'net1', '10.0.0.2': 'net1'},
+                         nets[uuid1])
+        next_hop = svc[uuid1]['next-hop-ip']
+
+        # Only the changed file is read
+        with mock.patch.object(as_metadata_manager, 'read_jsonfile',
+                               wraps=as_metadata_manager.read_jsonfile) as rd:
+            self.watcher.process([
+                self._write_ep('ep2', 'd1', 'net1', ['10.0.0.3'])])
+            self.assertEqual(
+                ['%s/ep2.ep' % self.ep_dir, self.watcher.svcfile],
+                [c[0][0] for c in rd.call_args_list])
+        svc, nets = self._read_state()
+        self.assertEqual({'10.0.0.1': 'net1', '10.0.0.3': 'net1'},
+                         nets[uuid1])
+
+        # The domain and its service go away with its last EP
+        self.watcher.process([('delete', '%s/ep3.ep' % self.ep_dir)])
+        svc, nets = self._read_state()
+        self.assertEqual([uuid1], list(svc))
+        self.assertEqual([uuid1], list(nets))
+        self.assertEqual(next_hop, svc[uuid1]['next-hop-ip'])
+
+    def test_shared_ip(self):
+        uuid1 = self.watcher.gen_domain_uuid('common', 'd1')
+        self.watcher.process([
+            self._write_ep('ep1', 'd1', 'net1', ['10.0.0.1']),
+            self._write_ep('ep2', 'd1', 'net2', ['10.0.0.1'])])
+        self.assertEqual({'10.0.0.1': 'net1'}, self._read_state()[1][uuid1])
+        self.watcher.process([('delete', '%s/ep1.ep' % self.ep_dir)])
+        self.assertEqual({'10.0.0.1': 'net2'}, self._read_state()[1][uuid1])
+
+    def test_duplicate_ip(self):
+        uuid1 = self.watcher.gen_domain_uuid('common', 'd1')
+        self.watcher.process([
+            self._write_ep('ep1', 'd1', 'net1', ['10.0.0.1', '10.0.0.1']),
+            self._write_ep('ep2', 'd1', 'net1', ['10.0.0.2'])])
+        self.assertEqual({'10.0.0.1': 'net1', '10.0.0.2': 'net1'},
+                         self._read_state()[1][uuid1])
+        self.watcher.process([
+            self._write_ep('ep1', 'd1', 'net1', ['10.0.0.3', '10.0.0.3'])])
+        self.assertEqual({'10.0.0.2': 'net1', '10.0.0.3': 'net1'},
+                         self._read_state()[1][uuid1])
+        self.watcher.process([('delete', '%s/ep1.ep' % self.ep_dir)])
+        self.assertEqual({'10.0.0.2': 'net1'}, self._read_state()[1][uuid1])
+        self.assertEqual(1, self.watcher.domains[uuid1][2])
+
+    def test_metadata_optimization_disabled(self):
+        self.watcher.process([
+            self._write_ep('ep1', 'd1', 'net1', ['10.0.0.1']),
+            self._write_ep('ep2', 'd1', **{
+                'neutron-metadata-optimization': False})])
+        self.assertEqual({}, self._read_state()[0])
+        # No anycast IP is taken while no service is published
+        used = bytearray(self.watcher.ip_pool.used)
+        for i in range(3):
+            self.watcher.process([
+                self._write_ep('ep%d' % (i + 3), 'd%d' % (i + 2), 'net1',
+                               ['10.0.1.%d' % i])])
+            self.assertEqual({}, self._read_state()[0])
+        self.assertEqual(used, self.watcher.ip_pool.used)
+        self.assertNotIn(1, self.watcher.ip_pool.used)
+        self.assertEqual(set(), self.watcher.pool_ips)
+
+        self.watcher.process([('delete', '%s/ep2.ep' % self.ep_dir)])
+        svc = self._read_state()[0]
+        self.assertEqual(4, len(svc))
+        self.assertEqual(
+            ['169.254.240.%d' % i for i in range(3, 7)],
+            sorted(s['next-hop-ip'] for s in svc.values()))
+
+    def test_next_hop_allocation(self):
+        self.watcher.process([
+            self._write_ep('ep%d' % i, 'd%d' % i) for i in range(3)])
+        svc = self._read_state()[0]
+        uuids = [self.watcher.gen_domain_uuid('common', 'd%d' % i)
+                 for i in range(3)]
+        ips = sorted(svc[domain_uuid]['next-hop-ip'] for domain_uuid in uuids)
+        self.assertEqual(
+            ['169.254.240.3', '169.254.240.4', '169.254.240.5'], ips)
+        released = svc[uuids[1]]['next-hop-ip']
+        self.watcher.process([('delete', '%s/ep1.ep' % self.ep_dir)])
+        self.watcher.process([self._write_ep('ep3', 'd3')])
+        svc = self._read_state()[0]
+        # The freed IP is reused, the others are kept
+        self.assertEqual(
+            released,
+            svc[self.watcher.gen_domain_uuid('common', 'd3')]['next-hop-ip'])
+        self.assertEqual(3, len(self.watcher.pool_ips))
+
+    def test_rescan(self):
+        self._write_ep('ep1', 'd1', 'net1', ['10.0.0.1'])
+        self.watcher.process([('update', 'ep1.ep')])
+        self.watcher.eps['stale.ep'] = self.watcher.eps['ep1.ep']
+        self.watcher.reset()
+        self.watcher.process([('update', 'ep1.ep')])
+        self.assertEqual(['ep1.ep'], list(self.watcher.eps))
+
+    def test_skip_unchanged_nets(self):
+        uuid1 = self.watcher.gen_domain_uuid('common', 'd1')
+        self.watcher.process([
+            self._write_ep('ep1', 'd1', 'net1', ['10.0.0.1'])])
+        mtime = os.stat(self.watcher.netsfile).st_mtime
+        # A change which doesn't affect instance_networks
+        self.watcher.process([self._write_ep('ep2', 'd1')])
+        self.assertEqual(mtime, os.stat(self.watcher.netsfile).st_mtime)
+        self.assertEqual(1, self.watcher.nets_writes)
+        self.assertEqual(1, self.watcher.nets_writes_skipped)
+        self.watcher.process([
+            self._write_ep('ep2', 'd1', 'net1', ['10.0.0.2'])])
+        self.assertEqual(2, self.watcher.nets_writes)
+        self.assertEqual(2, len(self._read_state()[1][uuid1]))
+        self.assertFalse(os.path.exists(self.watcher.netsfile + '.tmp'))
+
+
+class TestStateWatcher(base.BaseTestCase):
+
+    def setUp(self):
+        super(TestStateWatcher, self).setUp()
+        self.as_dir = tempfile.mkdtemp()
+        self.md_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.as_dir)
+        self.addCleanup(shutil.rmtree, self.md_dir)
+        as_metadata_manager.config.register_root_helper(cfg.CONF)
+        cfg.CONF.set_override('as_mapping_dir', self.as_dir, 'OPFLEX')
+        mock.patch('multiprocessing.Process').start()
+        mock.patch.object(as_metadata_manager, 'MD_DIR', self.md_dir).start()
+        mock.patch.object(as_metadata_manager, 'AS_MAPPING_DIR',
+                          self.as_dir).start()
+        mock.patch.object(as_metadata_manager, 'PID_DIR', self.md_dir).start()
+        mgr_cls = mock.patch.object(as_metadata_manager,
+                                    'AsMetadataManager').start()
+        mgr_cls.side_effect = lambda *args: mock.Mock(
+            consolidated_proxy=False,
+            **{'get_asport_mac.return_value': 'fa:16:3e:00:00:01'})
+        self.watcher = self._new_watcher()
+
+    def _new_watcher(self):
+        watcher = as_metadata_manager.StateWatcher()
+        watcher.reset()
+        return watcher
+
+    def _write_services(self, services):
+        as_metadata_manager.replace_jsonfile(self.watcher.svcfile, dict(
+            (domain_uuid, {'uuid': domain_uuid,
+                           'domain-name': name,
+                           'domain-policy-space': 'common',
+                           'next-hop-ip': ip})
+            for domain_uuid, (name, ip) in services.items()))
+
+    def _files(self, dirname, extension):
+        return sorted(filename[:-len(extension) - 1]
+                      for filename in os.listdir(dirname)
+                      if filename.endswith('.' + extension))
+
+    def _assert_ips(self, add_ips, del_ips):
+        self.watcher.mgr.update_ips.assert_called_once_with(
+            add_ips=add_ips, del_ips=del_ips)
+        self.watcher.mgr.update_ips.reset_mock()
+
+    def test_diff(self):
+        mgr = self.watcher.mgr
+        self._write_services({'d1': ('vrf1', '169.254.240.3'),
+                              'd2': ('vrf2', '169.254.240.4')})
+        self.watcher.process([])
+        self.assertEqual(['d1', 'd2'], self._files(
+            self.as_dir, as_metadata_manager.AS_FILE_EXTENSION))
+        self.assertEqual(['d1', 'd2'], self._files(
+            self.md_dir, as_metadata_manager.PROXY_FILE_EXTENSION))
+        asvc = as_metadata_manager.read_jsonfile('%s/d1.as' % self.as_dir)
+        self.assertEqual('169.254.240.3',
+                         asvc['service-mapping'][0]['next-hop-ip'])
+        self._assert_ips(['169.254.240.3', '169.254.240.4'], [])
+        self.assertEqual(1, mgr.schedule_update_supervisor.call_count)
+
+        # Nothing changed, nothing to do
+        with mock.patch.object(as_metadata_manager, 'replace_jsonfile',
+                               wraps=as_metadata_manager.replace_jsonfile
+                               ) as replace:
+            self.watcher.process([])
+            self.assertFalse(replace.called)
+        self.assertFalse(mgr.update_ips.called)
+        self.assertEqual(1, mgr.schedule_update_supervisor.call_count)
+
+        self._write_services({'d2': ('vrf2', '169.254.240.5'),
+                              'd3': ('vrf3', '169.254.240.3')})
+        self.watcher.process([])
+        self.assertEqual(['d2', 'd3'], self._files(
+            self.as_dir, as_metadata_manager.AS_FILE_EXTENSION))
+        self.assertEqual(['d2', 'd3'], self._files(
+            self.md_dir, as_metadata_manager.PROXY_FILE_EXTENSION))
+        self._assert_ips(['169.254.240.5'], ['169.254.240.4'])
+        self.assertEqual(2, mgr.schedule_update_supervisor.call_count)
+
+        # Only the .as file depends on the domain name
+        self._write_services({'d2': ('vrf2', '169.254.240.5'),
+                              'd3': ('vrf4', '169.254.240.3')})
+        self.watcher.process([])
+        asvc = as_metadata_manager.read_jsonfile('%s/d3.as' % self.as_dir)
+        self.assertEqual('vrf4', asvc['domain-name'])
+        self.assertFalse(mgr.update_ips.called)
+        self.assertEqual(2, mgr.schedule_update_supervisor.call_count)
+
+    def test_reset(self):
+        self._write_services({'d1': ('vrf1', '169.254.240.3')})
+        self.watcher.process([])
+        with open('%s/stale.as' % self.as_dir, 'w') as f:
+            jsonutils.dump({'uuid': 'stale', 'service-mapping': [
+                {'next-hop-ip': '169.254.240.9'}]}, f)
+
+        # A restarted watcher picks up the applied state from the files
+        self.watcher = self._new_watcher()
+        self.assertEqual(['d1', 'stale'], sorted(self.watcher.services))
+        self.assertEqual(['d1'], sorted(self.watcher.proxies))
+        self.watcher.process([])
+        self.assertEqual(['d1'], self._files(
+            self.as_dir, as_metadata_manager.AS_FILE_EXTENSION))
+        self._assert_ips(['169.254.240.3'], ['169.254.240.9'])
+        self.assertFalse(self.watcher.mgr.schedule_update_supervisor.called)
+
+    def test_consolidated_proxy(self):
+        self._write_services({'d1': ('vrf1', '169.254.240.3')})
+        self.watcher.process([])
+        self.watcher.mgr.consolidated_proxy = True
+        self.watcher.mgr.reset_mock()
+        self.watcher.process([])
+        self.assertEqual(['d1'], self._files(
+            self.as_dir, as_metadata_manager.AS_FILE_EXTENSION))
+        self.assertEqual([], self._files(
+            self.md_dir, as_metadata_manager.PROXY_FILE_EXTENSION))
+        self.assertEqual(
+            1, self.watcher.mgr.schedule_update_supervisor.call_count)
+
+
+class TestAsMetadataManager(base.BaseTestCase):
+
+    def setUp(self):
+        super(TestAsMetadataManager, self).setUp()
+        self.ip_lib = mock.patch.object(as_metadata_manager,
+                                        'ip_lib').start()
+        self.ovs_lib = mock.patch.object(as_metadata_manager,
+                                         'ovs_lib').start()
+        self.mgr = as_metadata_manager.AsMetadataManager(
+            as_metadata_manager.LOG, 'sudo')
+        self.sh = mock.patch.object(self.mgr, 'sh').start()
+        self.device = self.ip_lib.IPDevice.return_value
+        self.device.addr.list.return_value = [
+            {'cidr': '169.254.1.2/16'}, {'cidr': '169.254.240.3/16'}]
+
+    def test_update_ips(self):
+        execute = mock.patch.object(as_metadata_manager,
+                                    'agent_utils').start().execute
+        self.mgr.update_ips(
+            add_ips=['169.254.240.3', '169.254.240.4'],
+            del_ips=['169.254.240.9', '169.254.1.2'])
+        # All the changes in one ip process, without an address dump
+        port = as_metadata_manager.SVC_NS_PORT
+        execute.assert_called_once_with(
+            ['ip', '-netns', as_metadata_manager.SVC_NS, '-force', '-batch',
+             '-'],
+            process_input=('address del 169.254.240.9/16 dev %(port)s\n'
+                           'address del 169.254.1.2/16 dev %(port)s\n'
+                           'address replace 169.254.240.3/16 dev %(port)s\n'
+                           'address replace 169.254.240.4/16 dev %(port)s\n'
+                           % {'port': port}),
+            run_as_root=True)
+        self.assertFalse(self.device.addr.list.called)
+        self.assertFalse(self.device.addr.add.called)
+        self.assertFalse(self.device.addr.delete.called)
+        self.assertFalse(self.sh.called)
+
+        execute.reset_mock()
+        self.mgr.update_ips()
+        self.assertFalse(execute.called)
+
+    def test_init_host(self):
+        ensure_dir = mock.patch.object(self.mgr, 'ensure_dir').start()
+        execute = mock.patch.object(as_metadata_manager,
+                                    'agent_utils').start().execute
+        exists = mock.patch.object(as_metadata_manager.os.path,
+                                   'exists').start()
+        exists.return_value = False
+        ip = self.ip_lib.IPWrapper.return_value
+        ip.netns.exists.return_value = False
+        self.mgr.init_host('br-fabric')
+        self.assertEqual(3, ensure_dir.call_count)
+        ip.netns.add.assert_called_once_with(as_metadata_manager.SVC_NS)
+        exists.assert_called_once_with(
+            '/sys/class/net/%s' % as_metadata_manager.SVC_OVS_PORT)
+        # One ip batch run per namespace
+        self.assertEqual(
+            [mock.call(['ip', '-batch', '-'],
+                       process_input=(
+                           'link add of-svc-ovsport type veth peer name '
+                           'of-svc-nsport netns of-svc\n'
+                           'link set of-svc-ovsport up\n'),
+                       run_as_root=True),
+             mock.call(['ip', '-netns', 'of-svc', '-batch', '-'],
+                       process_input=(
+                           'link set of-svc-nsport up\n'
+                           'address replace 169.254.1.2/16 dev '
+                           'of-svc-nsport\n'
+                           'route replace default via 169.254.1.1\n'),
+                       run_as_root=True)],
+            execute.call_args_list)
+        self.assertFalse(ip.add_veth.called)
+        self.assertFalse(self.ip_lib.IPDevice.called)
+        self.ovs_lib.OVSBridge.assert_called_once_with('br-fabric')
+        self.ovs_lib.OVSBridge.return_value.add_port.assert_called_once_with(
+            as_metadata_manager.SVC_OVS_PORT)
+        # Besides, only the offloads need a command
+        self.assertEqual(2, self.sh.call_count)
+
+        self.sh.reset_mock()
+        execute.reset_mock()
+        ip.netns.exists.return_value = True
+        exists.return_value = True
+        self.mgr.init_host('br-fabric')
+        self.assertEqual(1, ip.netns.add.call_count)
+        self.assertFalse(execute.called)
+        self.assertFalse(self.sh.called)
+
+    def test_init_supervisor_watchers(self):
+        write_file = mock.patch.object(self.mgr, 'write_file').start()
+        self.mgr.init_supervisor()
+        config_str = write_file.call_args[0][1]
+        self.assertIn('[program:opflex-ep-watcher]', config_str)
+        self.assertIn('[program:opflex-state-watcher]', config_str)
+        self.assertNotIn('[program:opflex-md-watcher]', config_str)
+
+        cfg.CONF.set_override('unified_metadata_watcher', True, 'OPFLEX')
+        self.mgr.init_supervisor()
+        config_str = write_file.call_args[0][1]
+        self.assertIn('\n\n[program:opflex-md-watcher]\n'
+                      'command=/usr/bin/opflex-md-watcher ', config_str)
+        self.assertNotIn('[program:opflex-ep-watcher]', config_str)
+        self.assertNotIn('[program:opflex-state-watcher]', config_str)
+
+    def test_init_supervisor_consolidated_proxy(self):
+        write_file = mock.patch.object(self.mgr, 'write_file').start()
+        self.mgr.init_supervisor()
+        self.assertNotIn('[program:opflex-ns-proxy]',
+                         write_file.call_args[0][1])
+
+        self.mgr.consolidated_proxy = True
+        self.mgr.init_supervisor()
+        config_str = write_file.call_args[0][1]
+        program = config_str.split('\n[program:opflex-ns-proxy]\n')[1]
+        command = program.split('\n')[0]
+        self.assertTrue(command.startswith(
+            'command=ip netns exec %s /usr/bin/opflex-ns-proxy ' %
+            as_metadata_manager.SVC_NS))
+        self.assertIn('--domains_file=%s/%s ' % (
+            as_metadata_manager.MD_DIR,
+            as_metadata_manager.STATE_FILENAME_SVC), command)
+        self.assertIn('--metadata_port=80 ', command)
+        self.assertIn('--metadata_proxy_user=neutron '
+                      '--metadata_proxy_group=neutron ', command)
+        self.assertNotIn('--metadata_host', command)
+        # The program is declared before the per-domain proxies included
+        self.assertLess(config_str.index('[program:opflex-ns-proxy]'),
+                        config_str.index('[include]'))
+
+    def test_stop_supervisor_not_running(self):
+        self.mgr.md_pidfile = '/nonexistent/md-svc-supervisor.pid'
+        with mock.patch('time.sleep') as sleep:
+            self.mgr.stop_supervisor()
+        self.assertFalse(self.sh.called)
+        self.assertFalse(sleep.called)
+
+    def test_stop_supervisor(self):
+        pids = [1234, 1234, None]
+        with mock.patch.object(self.mgr, 'supervisor_pid',
+                               side_effect=pids), \
+                mock.patch('time.sleep') as sleep:
+            self.mgr.stop_supervisor()
+        self.assertEqual(1, self.sh.call_count)
+        self.assertEqual(1, sleep.call_count)
+
+    def test_stop_supervisor_timeout(self):
+        with mock.patch.object(self.mgr, 'supervisor_pid',
+                               return_value=1234), \
+                mock.patch('time.sleep'), \
+                mock.patch('time.time', side_effect=itertools.count(0, 10)):
+            self.mgr.stop_supervisor()
+        self.assertEqual(1, self.sh.call_count)
+
+    def test_supervisor_pid(self):
+        md_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, md_dir)
+        self.mgr.md_pidfile = '%s/md-svc-supervisor.pid' % md_dir
+        with open(self.mgr.md_pidfile, 'w') as f:
+            f.write('%d\n' % os.getpid())
+        self.assertEqual(os.getpid(), self.mgr.supervisor_pid())
+        with mock.patch('os.kill', side_effect=OSError(errno.ESRCH, '')):
+            self.assertIsNone(self.mgr.supervisor_pid())
+
+    def test_rpc_update_supervisor(self):
+        rpc = mock.patch.object(self.mgr, 'supervisor_rpc').start()
+        supervisor = rpc.return_value.supervisor
+        supervisor.reloadConfig.return_value = [
+            [['opflex-ns-proxy-d3'], ['opflex-ns-proxy-d2'],
+             ['opflex-ns-proxy-d1']]]
+        mock.patch.object(as_metadata_manager, 'supervisor_xmlrpc').start()
+        self.mgr.update_supervisor()
+        self.assertEqual(
+            [mock.call('opflex-ns-proxy-d1'), mock.call('opflex-ns-proxy-d2')],
+            supervisor.removeProcessGroup.call_args_list)
+        self.assertEqual(
+            [mock.call('opflex-ns-proxy-d2'), mock.call('opflex-ns-proxy-d3')],
+            supervisor.addProcessGroup.call_args_list)
+        self.assertFalse(self.sh.called)
+
+        # supervisorctl is used when XML-RPC fails
+        supervisor.reloadConfig.side_effect = IOError
+        self.mgr.update_supervisor()
+        self.assertEqual(2, self.sh.call_count)
+
+    def test_schedule_update_supervisor(self):
+        update = mock.patch.object(self.mgr, 'update_supervisor').start()
+        updater = self.mgr.supervisor_updater
+        updater.delay = 0.1
+        for i in range(10):
+            self.mgr.schedule_update_supervisor()
+        timer = updater.timer
+        self.assertFalse(update.called)
+        timer.join(5)
+        update.assert_called_once_with()
+        self.assertEqual(10, updater.scheduled)
+        self.assertEqual(1, updater.updates)
+        self.assertIsNone(updater.timer)
+
+    def test_ensure_terminated_cancels_update(self):
+        update = mock.patch.object(self.mgr, 'update_supervisor').start()
+        stop = mock.patch.object(self.mgr, 'stop_supervisor').start()
+        mock.patch.object(self.mgr, 'clean_files').start()
+        updater = self.mgr.supervisor_updater
+        updater.delay = 60
+        self.mgr.schedule_update_supervisor()
+        timer = updater.timer
+        self.mgr.initialized = True
+        self.mgr.ensure_terminated()
+        stop.assert_called_once_with()
+        timer.join(5)
+        self.assertFalse(timer.is_alive())
+        self.assertIsNone(updater.timer)
+        self.assertFalse(update.called)
+
+
+class TestAddressPool(base.BaseTestCase):
+
+    def test_allocation(self):
+        pool = as_metadata_manager.AddressPool(100, 4)
+        pool.reserve(101)
+        self.assertEqual([100, 102, 103, None],
+                         [pool.get_addr() for i in range(4)])
+        pool.release(102)
+        pool.release(100)
+        # The lowest free address comes first
+        self.assertEqual(100, pool.get_addr())
+        self.assertEqual(102, pool.get_addr())
+        self.assertRaises(ValueError, pool.reserve, 104)
+        self.assertRaises(ValueError, pool.release, 99)
+
+    def test_large_pool(self):
+        pool = as_metadata_manager.AddressPool(
+            as_metadata_manager.SVC_IP_BASE, 4092)
+        addrs = [pool.get_addr() for i in range(4092)]
+        self.assertEqual(list(range(as_metadata_manager.SVC_IP_BASE,
+                                    as_metadata_manager.SVC_IP_BASE + 4092)),
+                         addrs)
+        self.assertIsNone(pool.get_addr())
+
+
+class TestFileProcessor(base.BaseTestCase):
+
+    def _event(self, name, maskname='IN_CLOSE_WRITE'):
+        return mock.Mock(pathname='/dir/%s' % name, maskname=maskname)
+
+    def _processor(self, eventq, quiet_period=0):
+        self.processfn = mock.Mock()
+        return as_metadata_manager.FileProcessor(
+            '/dir', ['ep'], eventq, self.processfn,
+            quiet_period=quiet_period)
+
+    def setUp(self):
+        super(TestFileProcessor, self).setUp()
+        mock.patch('os.listdir', return_value=[]).start()
+
+    def test_batch_queued_events(self):
+        eventq = Queue.Queue()
+        fp = self._processor(eventq)
+        events = [self._event('a.ep'), self._event('b.ep', 'IN_DELETE')]
+        for event in events:
+            eventq.put(event)
+        self.assertEqual(events, fp.get_events())
+
+    def test_quiet_period(self):
+        eventq = Queue.Queue()
+        fp = self._processor(eventq, quiet_period=0.2)
+
+        def writer():
+            for i in range(5):
+                eventq.put(self._event('%d.ep' % i))
+                time.sleep(0.05)
+        thread = threading.Thread(target=writer)
+        thread.start()
+        # The burst is received as one batch
+        self.assertEqual(5, len(fp.get_events()))
+        thread.join()
+
+    def test_max_latency(self):
+        eventq = Queue.Queue()
+        fp = self._processor(eventq, quiet_period=0.2)
+        fp.max_latency = 0.3
+        stop = threading.Event()
+
+        def writer():
+            while not stop.is_set():
+                eventq.put(self._event('a.ep'))
+                time.sleep(0.02)
+        thread = threading.Thread(target=writer)
+        thread.start()
+        start = time.time()
+        fp.get_events()
+        elapsed = time.time() - start
+        stop.set()
+        thread.join()
+        self.assertLess(elapsed, 1)
+
+    def test_batch_dedup(self):
+        eventq = Queue.Queue()
+        fp = self._processor(eventq)
+        for event in [self._event('a.ep'),
+                      self._event('b.ep'),
+                      self._event('a.ep', 'IN_DELETE'),
+                      self._event('c.ep', 'IN_MOVED_FROM'),
+                      self._event('c.ep', 'IN_MOVED_TO'),
+                      as_metadata_manager.EOQ]:
+            eventq.put(event)
+        fp.run()
+        self.processfn.assert_called_with(
+            [('update', '/dir/b.ep'), ('delete', '/dir/a.ep'),
+             ('update', '/dir/c.ep')])
+        self.assertEqual(5, fp.events_received)
+        self.assertEqual(1, fp.batches_processed)
+
+    def test_run_thread_mode(self):
+        cfg.CONF.set_override('file_watcher_mode', 'thread', 'OPFLEX')
+        process = mock.patch('multiprocessing.Process').start()
+        watcher = as_metadata_manager.FileWatcher('/dir', 'ep')
+        self.assertFalse(process.called)
+        self.assertIsInstance(watcher.processor, threading.Thread)
+        self.assertIsInstance(watcher.eventq, Queue.Queue)
+        watcher.eventq.put(self._event('a.ep'))
+        watcher.eventq.put(as_metadata_manager.EOQ)
+        watcher.processor.join(5)
+        self.assertFalse(watcher.processor.is_alive())
+
+
+class TestMultiWatcher(base.BaseTestCase):
+
+    def setUp(self):
+        super(TestMultiWatcher, self).setUp()
+        self.pyinotify = mock.patch.object(as_metadata_manager,
+                                           'pyinotify').start()
+        mock.patch.object(as_metadata_manager, 'signal').start()
+
+    def test_run(self):
+        watchers = [mock.Mock(), mock.Mock()]
+        as_metadata_manager.MultiWatcher(watchers).run()
+        wm = self.pyinotify.WatchManager.return_value
+        self.pyinotify.Notifier.assert_called_once_with(wm)
+        self.pyinotify.Notifier.return_value.loop.assert_called_once_with()
+        for watcher in watchers:
+            watcher.watch.assert_called_once_with(wm)
+            watcher.terminate.assert_called_once_with(None, None)
+            watcher.processor.join.assert_called_once_with()
+
+    def test_watch(self):
+        process = mock.patch('multiprocessing.Process').start()
+        watcher = as_metadata_manager.FileWatcher('/dir', 'ep',
+                                                  threaded=False)
+        self.assertTrue(process.called)
+        wm = mock.Mock()
+        watcher.watch(wm)
+        wm.add_watch.assert_called_once_with(
+            '/dir', mock.ANY, proc_fun=mock.ANY, rec=False)
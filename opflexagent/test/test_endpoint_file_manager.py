@@ -14,8 +14,10 @@ import os
 import shutil
 import sys
 
+import eventlet
 import mock
 from mock import call
+import netaddr
 sys.modules["apicapi"] = mock.Mock()
 sys.modules["pyinotify"] = mock.Mock()
 
@@ -50,8 +52,10 @@ class TestEndpointFileManager(base.OpflexTestBase):
         except OSError:
             pass
 
-    def _initialize_agent(self):
+    def _initialize_agent(self, snat_workers=0):
         cfg.CONF.set_override('epg_mapping_dir', self.ep_dir, 'OPFLEX')
+        cfg.CONF.set_override('snat_provisioning_workers', snat_workers,
+                              'OPFLEX')
         kwargs = gbp_agent.create_agent_config_map(cfg.CONF)
         agent = endpoint_file_manager.EndpointFileManager().initialize(
             'h1', mock.Mock(), kwargs)
@@ -1059,3 +1063,225 @@ class TestEndpointFileManager(base.OpflexTestBase):
         self.manager.declare_endpoint(port, mapping)
         self.manager._write_endpoint_file.assert_called_with(ep_name, ep_file)
         self.manager.bridge_manager.get_port_vif_name = old_method
+
+    def _async_manager(self):
+        with mock.patch.object(snat_iptables_manager.SnatIptablesManager,
+                               'cleanup_snat_all'):
+            manager = self._initialize_agent(snat_workers=2)
+        manager.nat_mtu_size = 9000
+        self._mock_agent(manager)
+        manager.snat_provisioner.snat_iptables = manager.snat_iptables
+        manager.snat_iptables.setup_snat_for_es.return_value = (
+            'foo-if', 'foo-mac')
+        return manager
+
+    def _written_ep_files(self, manager):
+        return dict((c[0][0], c[0][1])
+                    for c in manager._write_endpoint_file.call_args_list)
+
+    def _next_hops(self, ep_file):
+        return set(m.get('next-hop-if')
+                   for m in ep_file.get('ip-address-mapping', [])
+                   if m.get('next-hop-if'))
+
+    def test_snat_async_provisioning(self):
+        manager = self._async_manager()
+        setup = manager.snat_iptables.setup_snat_for_es
+        mapping = self._get_gbp_details()
+        ports = [self._port(), self._port()]
+        ep_names = [p.vif_id + '_' + mapping['mac_address'] for p in ports]
+        for port in ports:
+            manager.declare_endpoint(port, mapping)
+
+        # The declarations don't wait for the SNAT namespace, but the EP
+        # files are not written without their SNAT mappings
+        self.assertFalse(manager._write_endpoint_file.called)
+        self.assertEqual(set(p.vif_id for p in ports),
+                         manager.get_registered_endpoints())
+        self.assertTrue(manager.snat_provisioner.pending('EXT-1'))
+        self.assertEqual(set(p.vif_id for p in ports),
+                         set(manager.snat_waiters['EXT-1']))
+        self.assertFalse(setup.called)
+
+        eventlet.sleep(0)
+        setup.assert_called_once_with(
+            'EXT-1', '200.0.0.10', None, '200.0.0.1/8', None, None,
+            None, None, mtu=9000)
+
+        # Once ready, the SNAT EP and the waiting endpoints are written
+        manager._write_endpoint_file.reset_mock()
+        manager.apply_async_updates()
+        written = self._written_ep_files(manager)
+        self.assertEqual('foo-if', written['EXT-1']['interface-name'])
+        for ep_name in ep_names:
+            self.assertEqual(set(['foo-if']),
+                             self._next_hops(written[ep_name]))
+        self.assertEqual({}, manager.snat_waiters)
+        self.assertEqual(set((p.vif_id, mapping['mac_address'])
+                             for p in ports),
+                         manager.es_port_dict['EXT-1'])
+
+        # The next hop is known now, declarations are synchronous
+        manager._write_endpoint_file.reset_mock()
+        manager.declare_endpoint(ports[0], mapping)
+        self.assertEqual(set(['foo-if']), self._next_hops(
+            self._written_ep_files(manager)[ep_names[0]]))
+        self.assertEqual(1, setup.call_count)
+
+    def test_snat_async_parallel(self):
+        manager = self._async_manager()
+        active = []
+        concurrency = []
+
+        def setup_snat_for_es(es_name, *args, **kwargs):
+            active.append(es_name)
+            concurrency.append(len(active))
+            eventlet.sleep(0.01)
+            active.remove(es_name)
+            return ('if-' + es_name, 'mac-' + es_name)
+        manager.snat_iptables.setup_snat_for_es.side_effect = (
+            setup_snat_for_es)
+
+        ports = []
+        for es in ('EXT-1', 'EXT-2'):
+            ipm = self._get_gbp_details()['ip_mapping'][0]
+            ipm['external_segment_name'] = es
+            mapping = self._get_gbp_details(
+                ip_mapping=[ipm],
+                host_snat_ips=[{'external_segment_name': es,
+                                'host_snat_ip': '200.0.0.10',
+                                'gateway_ip': '200.0.0.1',
+                                'prefixlen': 8}])
+            ports.append(self._port())
+            manager.declare_endpoint(ports[-1], mapping)
+
+        while manager.snat_provisioner.futures:
+            eventlet.sleep(0.01)
+            manager.apply_async_updates()
+        self.assertEqual(2, max(concurrency))
+        written = self._written_ep_files(manager)
+        self.assertEqual('if-EXT-1', written['EXT-1']['interface-name'])
+        self.assertEqual('if-EXT-2', written['EXT-2']['interface-name'])
+        self.assertEqual({}, manager.snat_waiters)
+
+    def test_snat_async_error(self):
+        manager = self._async_manager()
+        setup = manager.snat_iptables.setup_snat_for_es
+        setup.side_effect = RuntimeError
+        mapping = self._get_gbp_details()
+        port = self._port()
+        ep_name = port.vif_id + '_' + mapping['mac_address']
+        manager.declare_endpoint(port, mapping)
+        eventlet.sleep(0)
+        manager.apply_async_updates()
+        # The waiting port is written without the SNAT mappings
+        written = self._written_ep_files(manager)
+        self.assertNotIn('EXT-1', written)
+        self.assertEqual(set(), self._next_hops(written[ep_name]))
+        self.assertFalse(manager.snat_provisioner.pending('EXT-1'))
+        self.assertEqual({}, manager.snat_waiters)
+        self.assertEqual(1, setup.call_count)
+
+        # Retried by the next declaration
+        setup.side_effect = None
+        manager.declare_endpoint(port, mapping)
+        eventlet.sleep(0)
+        manager.apply_async_updates()
+        self.assertEqual(2, setup.call_count)
+        self.assertIn('EXT-1', self._written_ep_files(manager))
+
+    def test_snat_async_unused(self):
+        manager = self._async_manager()
+        mapping = self._get_gbp_details()
+        port = self._port()
+        manager.declare_endpoint(port, mapping)
+        manager.undeclare_endpoint(port.vif_id)
+        self.assertEqual({}, manager.snat_waiters)
+        eventlet.sleep(0)
+        manager.apply_async_updates()
+        self.assertNotIn('EXT-1', self._written_ep_files(manager))
+        manager.snat_iptables.cleanup_snat_for_es.assert_called_once_with(
+            'EXT-1')
+
+        # A host SNAT IP change cancels the pending setup
+        manager.snat_iptables.setup_snat_for_es.reset_mock()
+        manager.declare_endpoint(port, mapping)
+        future = manager.snat_provisioner.futures['EXT-1']
+        mapping['host_snat_ips'][0]['host_snat_ip'] = '200.0.0.11'
+        manager.declare_endpoint(port, mapping)
+        self.assertIsNot(future, manager.snat_provisioner.futures['EXT-1'])
+        eventlet.sleep(0)
+        manager.snat_iptables.setup_snat_for_es.assert_called_once_with(
+            'EXT-1', '200.0.0.11', None, '200.0.0.1/8', None, None,
+            None, None, mtu=9000)
+
+    def test_snat_async_cancel_in_flight(self):
+        manager = self._async_manager()
+        setup = manager.snat_iptables.setup_snat_for_es
+        cleanup = manager.snat_iptables.cleanup_snat_for_es
+        mapping = self._get_gbp_details()
+        port = self._port()
+        manager.declare_endpoint(port, mapping)
+        eventlet.sleep(0)
+        manager.apply_async_updates()
+        self.assertIn('EXT-1', manager.es_port_dict)
+
+        # A host SNAT IP change sets the namespace up again
+        done = eventlet.Event()
+        calls = []
+
+        def setup_snat_for_es(es_name, *args, **kwargs):
+            calls.append('setup')
+            done.wait()
+            calls.append('setup done')
+            return ('foo-if', 'foo-mac')
+        setup.side_effect = setup_snat_for_es
+        cleanup.side_effect = lambda es_name: calls.append('cleanup')
+        mapping['host_snat_ips'][0]['host_snat_ip'] = '200.0.0.11'
+        manager.declare_endpoint(port, mapping)
+        eventlet.sleep(0)
+        self.assertEqual(['setup'], calls)
+
+        # The last port leaves while the setup is in flight
+        manager.undeclare_endpoint(port.vif_id)
+        self.assertNotIn('EXT-1', manager.es_port_dict)
+        self.assertEqual(['setup', 'cleanup'], calls)
+        done.send()
+        eventlet.sleep(0)
+        manager.apply_async_updates()
+        # What the setup created after the cleanup is removed as well
+        self.assertEqual(['setup', 'cleanup', 'setup done', 'cleanup'],
+                         calls)
+        self.assertEqual({}, manager.snat_provisioner.cancelled)
+        manager.apply_async_updates()
+        self.assertEqual(4, len(calls))
+
+    def test_snat_range_limit(self):
+        self.manager._load_es_next_hop_info({
+            'EXT-1': [('ip_address_range', ['200.0.0.10,200.0.15.255']),
+                      ('ip_gateway', ['200.0.0.1/8']),
+                      ('ip6_address_range',
+                       ['2001:db8::,2001:db8::ffff:ffff:ffff:ffff']),
+                      ('ip6_gateway', ['2001:db8::1/64'])]})
+        # IPv4 ranges are used as configured, IPv6 ones are truncated
+        nh = self.manager.ext_seg_next_hop['EXT-1']
+        self.assertEqual('200.0.15.255', nh.ip_end)
+        ip6_end = str(netaddr.IPAddress('2001:db8::') +
+                      endpoint_file_manager.MAX_SNAT_RANGE_SIZE - 1)
+        self.assertEqual(ip6_end, nh.ip6_end)
+
+        # The SNAT datapath and the host EP use the same ranges
+        self.manager.snat_iptables.setup_snat_for_es.return_value = (
+            'foo-if', 'foo-mac')
+        self.manager._get_next_hop_info_for_es(
+            self._get_gbp_details()['ip_mapping'][0], set())
+        self.manager.snat_iptables.setup_snat_for_es.assert_called_once_with(
+            'EXT-1', '200.0.0.10', '200.0.15.255', '200.0.0.1/8',
+            '2001:db8::', ip6_end, '2001:db8::1/64', None,
+            mtu=self.manager.nat_mtu_size)
+        ips = self.manager._write_endpoint_file.call_args[0][1]['ip']
+        self.assertEqual(4086 + endpoint_file_manager.MAX_SNAT_RANGE_SIZE,
+                         len(ips))
+        self.assertEqual(['200.0.0.10', '200.0.0.11'], ips[:2])
+        self.assertEqual('200.0.15.255', ips[4085])
+        self.assertEqual(ip6_end, ips[-1])
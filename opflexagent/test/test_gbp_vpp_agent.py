@@ -10,9 +10,11 @@
 #    License for the specific language governing permissions and limitations
 #    under the License.
 
+import os
 import shutil
 import sys
 
+import fixtures
 import mock
 sys.modules["apicapi"] = mock.Mock()
 sys.modules["pyinotify"] = mock.Mock()
@@ -25,6 +27,7 @@ from neutron.conf.agent import dhcp as dhcp_config
 from neutron.objects import trunk as trunk_obj
 from neutron.plugins.ml2.drivers.openvswitch.agent import (
     ovs_neutron_agent as ovs)
+from neutron.plugins.ml2.drivers.openvswitch.agent.common import constants
 from opflexagent import gbp_agent
 from opflexagent import snat_iptables_manager
 from opflexagent.test import base
@@ -80,6 +83,7 @@ class TestGBPOpflexAgent(base.OpflexTestBase):
 
     def _initialize_agent(self):
         cfg.CONF.set_override('epg_mapping_dir', self.ep_dir, 'OPFLEX')
+        cfg.CONF.set_override('snat_provisioning_workers', 0, 'OPFLEX')
         cfg.CONF.set_override('bridge_manager',
             'opflexagent.utils.bridge_managers.vpp_manager.VppManager',
             'OPFLEX')
@@ -305,6 +309,27 @@ class TestGBPOpflexAgent(base.OpflexTestBase):
             agent.ep_manager.undeclare_endpoint.assert_called_once_with(
                 'uuid2')
 
+    def test_handle_removed_eps(self):
+        sock_dir = self.useFixture(fixtures.TempDir()).path
+        open(os.path.join(sock_dir, 'vhu-kept'), 'w').close()
+        access_ints = {'ep1': os.path.join(sock_dir, 'vhu-kept'),
+                       'ep2': os.path.join(sock_dir, 'vhu-gone'),
+                       'ep3': 'veth-kept',
+                       'ep4': 'veth-gone',
+                       'ep5': None,
+                       'ep6': '/no/such/dir/vhu-gone'}
+        em = mock.Mock()
+        em.get_access_int_for_vif.side_effect = access_ints.get
+        link = mock.Mock()
+        link.name = 'veth-kept'
+        with mock.patch('neutron.agent.linux.ip_lib.IPWrapper') as wrapper:
+            wrapper.return_value.get_devices.return_value = [link]
+            removed = self.agent.bridge_manager.handle_removed_eps(
+                em, set(access_ints))
+            # links are listed once for all the veths
+            wrapper.return_value.get_devices.assert_called_once_with()
+        self.assertEqual(set(['ep2', 'ep4', 'ep5', 'ep6']), removed)
+
     def test_process_deleted_ports(self):
         self.agent.bridge_manager.delete_patch_ports = mock.Mock()
         with contextlib.nested(
@@ -376,6 +401,31 @@ class TestGBPOpflexAgent(base.OpflexTestBase):
     def test_apply_config_interval(self):
         self.assertEqual(0.5, self.agent.config_apply_interval)
 
+    def test_check_bridge_status_ping(self):
+        manager = self.agent.bridge_manager
+        manager.vapi = mock.Mock()
+        manager.vpp_boot_id = None
+        manager.vapi.control_ping.return_value = 100
+        self.assertEqual(constants.OVS_NORMAL, manager.check_bridge_status())
+        self.assertEqual(constants.OVS_NORMAL, manager.check_bridge_status())
+        self.assertIsNotNone(manager.probe_latency)
+        self.assertFalse(manager.vapi.get_version.called)
+
+        # VPP went away, the connection is dropped
+        manager.vapi.control_ping.side_effect = IOError
+        self.assertEqual(constants.OVS_DEAD, manager.check_bridge_status())
+        manager.vapi.disconnect.assert_called_once_with()
+
+        # Same VPP process is back, no resync needed
+        manager.vapi.control_ping.side_effect = None
+        self.assertEqual(constants.OVS_NORMAL, manager.check_bridge_status())
+
+        # VPP restarted
+        manager.vapi.control_ping.return_value = 200
+        self.assertEqual(constants.OVS_RESTARTED,
+                         manager.check_bridge_status())
+        self.assertEqual(constants.OVS_NORMAL, manager.check_bridge_status())
+
     def test_trunk_handler(self):
         trunk_id = uuidutils.generate_uuid()
         subports = [
@@ -0,0 +1,295 @@
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+import os
+import shutil
+import socket
+import tempfile
+import time
+
+import mock
+import webob
+
+from opflexagent import namespace_proxy
+
+from neutron.tests import base
+from oslo_log import log as logging
+from oslo_serialization import jsonutils
+
+LOG = logging.getLogger(__name__)
+DOMAIN = 'domain-uuid-1'
+
+
+class TestNetworkMap(base.BaseTestCase):
+
+    def setUp(self):
+        super(TestNetworkMap, self).setUp()
+        self.state_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.state_dir)
+        self.filename = '%s/instance_networks.state' % self.state_dir
+        self.network_map = namespace_proxy.NetworkMap(self.filename)
+
+    def _write_nets(self, count, network='net1'):
+        nets = {DOMAIN: {}}
+        for i in range(count):
+            nets[DOMAIN]['10.%d.%d.%d' % (
+                i >> 16, (i >> 8) & 0xff, i & 0xff)] = network
+        tmpname = self.filename + '.tmp'
+        with open(tmpname, 'w') as f:
+            jsonutils.dump(nets, f)
+        os.rename(tmpname, self.filename)
+        return list(nets[DOMAIN])
+
+    def test_lookup(self):
+        self.assertIsNone(
+            self.network_map.get_network_id(DOMAIN, '10.0.0.1'))
+        self._write_nets(2)
+        self.assertEqual(
+            'net1', self.network_map.get_network_id(DOMAIN, '10.0.0.1'))
+        self.assertIsNone(
+            self.network_map.get_network_id(DOMAIN, '10.0.0.9'))
+        self.assertIsNone(
+            self.network_map.get_network_id('other', '10.0.0.1'))
+        self.assertEqual(1, self.network_map.loads)
+
+    def test_reload_on_replace(self):
+        self._write_nets(2)
+        self.network_map.get_network_id(DOMAIN, '10.0.0.1')
+        self._write_nets(2, network='net2')
+        self.assertEqual(
+            'net2', self.network_map.get_network_id(DOMAIN, '10.0.0.1'))
+        self.assertEqual(2, self.network_map.loads)
+        os.unlink(self.filename)
+        self.assertIsNone(
+            self.network_map.get_network_id(DOMAIN, '10.0.0.1'))
+
+    def test_lookup_load(self):
+        ips = self._write_nets(10000)
+        requests = 20000
+        start = time.time()
+        for i in range(requests):
+            self.assertEqual('net1', self.network_map.get_network_id(
+                DOMAIN, ips[i % len(ips)]))
+        elapsed = time.time() - start
+        self.assertEqual(1, self.network_map.loads)
+        LOG.info("NetworkMap: %(rate)d lookups/s with %(count)d entries",
+                 {'rate': requests / max(elapsed, 1e-6), 'count': len(ips)})
+
+
+class TestUnixConnectionPool(base.BaseTestCase):
+
+    def setUp(self):
+        super(TestUnixConnectionPool, self).setUp()
+        self.http_cls = mock.patch.object(namespace_proxy.httplib2,
+                                          'Http').start()
+        self.http_cls.side_effect = self._new_http
+
+    def _new_http(self, timeout=None):
+        http = mock.Mock()
+        http.connections = {}
+        http.request.return_value = (mock.Mock(status=200), 'content')
+        return http
+
+    def test_reuse(self):
+        pool = namespace_proxy.UnixConnectionPool(2, timeout=10)
+        for i in range(5):
+            self.assertEqual('content', pool.request('url')[1])
+        self.assertEqual(1, self.http_cls.call_count)
+        self.http_cls.assert_called_once_with(timeout=10)
+        self.assertEqual({'hits': 4, 'misses': 1, 'stale': 0,
+                          'hit_rate': 0.8}, pool.stats())
+
+    def test_no_pool(self):
+        pool = namespace_proxy.UnixConnectionPool()
+        pool.request('url')
+        pool.request('url')
+        self.assertEqual(2, self.http_cls.call_count)
+        self.assertEqual(0.0, pool.stats()['hit_rate'])
+
+    def test_stale_connection(self):
+        pool = namespace_proxy.UnixConnectionPool(2)
+        pool.request('url')
+        stale = pool.free[0][1]
+        stale.request.side_effect = socket.error
+        self.assertEqual('content', pool.request('url')[1])
+        self.assertEqual(2, self.http_cls.call_count)
+        self.assertEqual(1, pool.stats()['stale'])
+        self.assertNotIn(stale, [http for _t, http in pool.free])
+
+        # Non idempotent requests are not retried
+        pool.free[0][1].request.side_effect = socket.error
+        self.assertRaises(socket.error, pool.request, 'url', method='POST')
+        self.assertEqual(0, len(pool.free))
+
+    def test_idle_timeout(self):
+        pool = namespace_proxy.UnixConnectionPool(2, idle_timeout=60)
+        pool.request('url')
+        pool.free.append((time.time() - 120, pool.free.pop()[1]))
+        pool.request('url')
+        self.assertEqual(2, self.http_cls.call_count)
+        self.assertEqual({'hits': 0, 'misses': 2, 'stale': 1,
+                          'hit_rate': 0.0}, pool.stats())
+
+
+class TestMultiDomainProxyDaemon(base.BaseTestCase):
+
+    def setUp(self):
+        super(TestMultiDomainProxyDaemon, self).setUp()
+        self.state_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.state_dir)
+        self.filename = '%s/anycast_services.state' % self.state_dir
+        self.pool = mock.patch.object(namespace_proxy,
+                                      'UnixConnectionPool').start()
+
+    def _write_services(self, services):
+        tmpname = self.filename + '.tmp'
+        with open(tmpname, 'w') as f:
+            jsonutils.dump(dict(
+                (domain_id, {'next-hop-ip': ip, 'uuid': domain_id})
+                for domain_id, ip in services.items()), f)
+        os.rename(tmpname, self.filename)
+
+    def test_run(self):
+        calls = mock.Mock()
+        with mock.patch.object(namespace_proxy, 'wsgi') as wsgi, \
+                mock.patch.object(namespace_proxy.daemon.Daemon,
+                                  'run') as drop_privileges:
+            calls.attach_mock(wsgi.Server.return_value, 'server')
+            calls.attach_mock(drop_privileges, 'drop_privileges')
+            proxy = namespace_proxy.MultiDomainProxyDaemon(
+                'pidfile', 80, self.filename, user='neutron',
+                group='neutron')
+            proxy.run()
+        # A single listener, bound before privileges are dropped
+        handler = wsgi.Server.return_value.start.call_args[0][0]
+        self.assertEqual(
+            [mock.call.server.start(handler, 80, host='0.0.0.0'),
+             mock.call.drop_privileges(),
+             mock.call.server.wait()],
+            calls.mock_calls)
+        self.assertEqual(self.filename, handler.domain_map.filename)
+
+    def test_domain_of_request(self):
+        handler = namespace_proxy.NetworkMetadataProxyHandler(
+            domain_map=namespace_proxy.DomainMap(self.filename))
+        handler.network_map = mock.Mock()
+        handler.network_map.get_network_id.return_value = 'net1'
+        resp = mock.MagicMock(status=200)
+        resp.__getitem__.return_value = 'text/plain'
+        self.pool.return_value.request.return_value = (resp, 'data')
+
+        def request(server_name):
+            req = webob.Request.blank('/', remote_addr='10.0.0.1',
+                                      environ={'SERVER_NAME': server_name})
+            return req.get_response(handler).status_int
+
+        self.assertEqual(404, request('169.254.240.3'))
+        self._write_services({'d1': '169.254.240.3', 'd2': '169.254.240.4'})
+        self.assertEqual(200, request('169.254.240.4'))
+        handler.network_map.get_network_id.assert_called_once_with(
+            'd2', '10.0.0.1')
+        self.assertEqual(404, request('169.254.240.5'))
+
+        self._write_services({'d3': '169.254.240.4'})
+        self.assertEqual(200, request('169.254.240.4'))
+        handler.network_map.get_network_id.assert_called_with(
+            'd3', '10.0.0.1')
+
+
+class TestStreamingProxy(base.BaseTestCase):
+
+    def setUp(self):
+        super(TestStreamingProxy, self).setUp()
+        self.conn_cls = mock.patch.object(
+            namespace_proxy, 'GreenUnixDomainHTTPConnection').start()
+        self.conn = self.conn_cls.return_value
+        self.handler = namespace_proxy.NetworkMetadataProxyHandler(
+            domain_id=DOMAIN, streaming=True)
+        self.handler.network_map = mock.Mock()
+        self.handler.network_map.get_network_id.return_value = 'net1'
+
+    def _upstream_response(self, status, body, content_type='text/plain'):
+        resp = mock.Mock(status=status)
+        resp.read.side_effect = [
+            body[i:i + namespace_proxy.STREAM_CHUNK_SIZE] for i in range(
+                0, len(body), namespace_proxy.STREAM_CHUNK_SIZE)] + [b'']
+        headers = {'content-length': str(len(body))}
+        if content_type:
+            headers['content-type'] = content_type
+        resp.getheader.side_effect = headers.get
+        self.conn.getresponse.return_value = resp
+
+    def test_stream(self):
+        body = b'x' * (namespace_proxy.STREAM_CHUNK_SIZE * 2 + 10)
+        self._upstream_response(200, body)
+        req = webob.Request.blank('/latest/user-data?a=b', method='POST',
+                                  remote_addr='10.0.0.1', body=body)
+        resp = req.get_response(self.handler)
+        self.assertEqual(200, resp.status_int)
+        self.assertEqual(len(body), resp.content_length)
+        self.assertEqual('text/plain', resp.content_type)
+        self.conn.putrequest.assert_called_once_with(
+            'POST', '/latest/user-data?a=b')
+        self.conn.putheader.assert_any_call('X-Neutron-Network-ID', 'net1')
+        self.conn.putheader.assert_any_call('X-Forwarded-For', '10.0.0.1')
+        self.assertEqual(3, self.conn.send.call_count)
+        self.assertFalse(self.conn.close.called)
+        chunks = list(resp.app_iter)
+        self.assertEqual(3, len(chunks))
+        self.assertEqual(body, b''.join(chunks))
+        self.conn.close.assert_called_once_with()
+
+    def test_stream_error(self):
+        self._upstream_response(404, b'')
+        req = webob.Request.blank('/', remote_addr='10.0.0.1')
+        self.assertEqual(404, req.get_response(self.handler).status_int)
+        self.conn.close.assert_called_once_with()
+
+    def test_stream_unknown_ip(self):
+        self.handler.network_map.get_network_id.return_value = None
+        req = webob.Request.blank('/', remote_addr='10.0.0.1')
+        self.assertEqual(404, req.get_response(self.handler).status_int)
+        self.assertFalse(self.conn_cls.called)
+
+    def test_stream_chunked(self):
+        self._upstream_response(200, b'ok')
+        body = b'x' * (namespace_proxy.STREAM_CHUNK_SIZE + 10)
+        req = webob.Request.blank('/', method='POST', remote_addr='10.0.0.1',
+                                  body=body)
+        del req.content_length
+        req.headers['Transfer-Encoding'] = 'chunked'
+        self.assertEqual(200, req.get_response(self.handler).status_int)
+        self.conn.putheader.assert_any_call('Transfer-Encoding', 'chunked')
+        self.assertNotIn('Content-Length',
+                         [c[0][0] for c in self.conn.putheader.call_args_list])
+        self.assertEqual(
+            [mock.call(b'10000\r\n' + body[:-10] + b'\r\n'),
+             mock.call(b'a\r\n' + body[-10:] + b'\r\n'),
+             mock.call(b'0\r\n\r\n')],
+            self.conn.send.call_args_list)
+
+    def test_stream_short_body(self):
+        req = webob.Request.blank('/', method='POST', remote_addr='10.0.0.1',
+                                  body=b'xx')
+        req.content_length = 10
+        self.assertEqual(400, req.get_response(self.handler).status_int)
+        self.conn.send.assert_called_once_with(b'xx')
+        self.assertFalse(self.conn.getresponse.called)
+        self.conn.close.assert_called_once_with()
+
+    def test_stream_no_content_type(self):
+        self._upstream_response(200, b'ok', content_type=None)
+        req = webob.Request.blank('/', remote_addr='10.0.0.1')
+        resp = req.get_response(self.handler)
+        self.assertEqual(200, resp.status_int)
+        self.assertNotIn('Content-Type', resp.headers)
+        self.assertEqual(b'ok', resp.body)
@@ -0,0 +1,251 @@
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+import json
+import socket
+import sys
+import threading
+import time
+
+import mock
+sys.modules["pyinotify"] = mock.Mock()
+
+from opflexagent import opflex_notify
+
+from neutron.tests import base
+from oslo_config import cfg
+from oslo_log import log as logging
+import oslo_messaging
+
+LOG = logging.getLogger(__name__)
+
+
+def _notification(port, ip, mac='fa:16:3e:00:00:01'):
+    return {'port': port, 'ip_address_v4': ip, 'mac': mac}
+
+
+def _frame(msg):
+    data = json.dumps(msg).encode('utf-8')
+    return opflex_notify.FRAME_HEADER.pack(len(data)) + data
+
+
+def _vip(i):
+    return {'method': 'virtual-ip',
+            'params': {'uuid': ['port-%d|tag' % i],
+                       'mac': 'fa:16:3e:00:00:01',
+                       'ip': '10.0.%d.%d' % (i >> 8, i & 0xff)}}
+
+
+class TestFrameReader(base.BaseTestCase):
+
+    def _reader(self, chunks):
+        sock = mock.Mock()
+        sock.recv.side_effect = list(chunks) + [b'']
+        return opflex_notify.FrameReader(sock)
+
+    def test_split_frames(self):
+        data = _frame(_vip(1)) + _frame(_vip(2))
+        # one byte at a time, including the headers
+        reader = self._reader(data[i:i + 1] for i in range(len(data)))
+        self.assertEqual(_vip(1), json.loads(reader.read()))
+        self.assertEqual(_vip(2), json.loads(reader.read()))
+        self.assertIsNone(reader.read())
+
+    def test_several_frames_per_read(self):
+        data = b''.join(_frame(_vip(i)) for i in range(10))
+        reader = self._reader([data[:-3], data[-3:]])
+        msgs = [json.loads(reader.read()) for i in range(10)]
+        self.assertEqual([_vip(i) for i in range(10)], msgs)
+        self.assertEqual(2, reader.sock.recv.call_count)
+        self.assertIsNone(reader.read())
+
+    def test_truncated(self):
+        reader = self._reader([_frame(_vip(1))[:-1]])
+        self.assertRaises(ValueError, reader.read)
+
+    def test_too_large(self):
+        too_large = opflex_notify.MAX_FRAME_SIZE + 1
+        reader = self._reader([opflex_notify.FRAME_HEADER.pack(too_large)])
+        self.assertRaises(ValueError, reader.read)
+
+    def test_read_msg(self):
+        agent = mock.Mock(spec=opflex_notify.OpflexNotifyAgent)
+        reader = self._reader([
+            _frame({'method': 'other', 'params': {}}) +
+            opflex_notify.FRAME_HEADER.pack(3) + b'{[}' +
+            _frame(_vip(1))])
+        self.assertEqual(
+            (['port-1|tag'], 'fa:16:3e:00:00:01', '10.0.0.1'),
+            opflex_notify.OpflexNotifyAgent._read_msg(agent, reader))
+        self.assertIsNone(
+            opflex_notify.OpflexNotifyAgent._read_msg(agent, reader))
+
+    def test_throughput(self):
+        count = 20000
+        data = b''.join(_frame(_vip(i % 4096)) for i in range(count))
+        server, client = socket.socketpair(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.addCleanup(server.close)
+        self.addCleanup(client.close)
+
+        def write():
+            # odd sized writes split the frames anywhere
+            for i in range(0, len(data), 4093):
+                server.sendall(data[i:i + 4093])
+            server.shutdown(socket.SHUT_WR)
+
+        writer = threading.Thread(target=write)
+        writer.daemon = True
+        start = time.time()
+        writer.start()
+        reader = opflex_notify.FrameReader(client)
+        agent = mock.Mock(spec=opflex_notify.OpflexNotifyAgent)
+        received = 0
+        while opflex_notify.OpflexNotifyAgent._read_msg(agent, reader):
+            received += 1
+        elapsed = time.time() - start
+        writer.join(5)
+        self.assertEqual(count, received)
+        LOG.info("FrameReader: %(rate)d messages/s, %(mbps).1f MB/s",
+                 {'rate': count / max(elapsed, 1e-6),
+                  'mbps': len(data) / max(elapsed, 1e-6) / 1e6})
+
+
+class TestNotificationBatcher(base.BaseTestCase):
+
+    def setUp(self):
+        super(TestNotificationBatcher, self).setUp()
+        self.sleep = mock.patch.object(opflex_notify.time, 'sleep').start()
+        self.send = mock.Mock()
+
+    def test_coalesce(self):
+        batcher = opflex_notify.NotificationBatcher(self.send, window=0.5)
+        batcher.add(_notification('p1', '10.0.0.1'))
+        batcher.add(_notification('p2', '10.0.0.1'))
+        batcher.add(_notification('p1', '10.0.0.1', mac='fa:16:3e:00:00:02'))
+        batcher.flush()
+        self.sleep.assert_called_once_with(0.5)
+        self.send.assert_called_once_with([
+            _notification('p2', '10.0.0.1'),
+            _notification('p1', '10.0.0.1', mac='fa:16:3e:00:00:02')])
+        self.assertEqual((3, 1, 2, 1), (batcher.received, batcher.coalesced,
+                                        batcher.sent, batcher.batches))
+
+    def test_max_size(self):
+        batcher = opflex_notify.NotificationBatcher(self.send, window=0.5,
+                                                    max_size=2)
+        for i in range(5):
+            batcher.add(_notification('p%d' % i, '10.0.0.1'))
+        batcher.flush()
+        batcher.flush()
+        # full batches don't wait for the window
+        self.assertFalse(self.sleep.called)
+        batcher.flush()
+        self.sleep.assert_called_once_with(0.5)
+        self.assertEqual([2, 2, 1], [len(c[0][0])
+                                     for c in self.send.call_args_list])
+
+    def test_rate_limiter(self):
+        now = [100.0]
+        mock.patch.object(opflex_notify.time, 'time',
+                          side_effect=lambda: now[0]).start()
+        limiter = opflex_notify.RateLimiter(2)
+        self.assertEqual(0, limiter.wait())
+        self.assertEqual(0.5, limiter.wait())
+        now[0] += 0.25
+        self.assertEqual(0.75, limiter.wait())
+        now[0] += 10
+        self.assertEqual(0, limiter.wait())
+        self.assertEqual(0, opflex_notify.RateLimiter(0).wait())
+
+
+class TestOpflexNotifyAgent(base.BaseTestCase):
+
+    def setUp(self):
+        super(TestOpflexNotifyAgent, self).setUp()
+        mock.patch.object(opflex_notify.rpc, 'GBPServerRpcApi').start()
+        self.agent = opflex_notify.OpflexNotifyAgent()
+        self.of_rpc = self.agent.of_rpc
+
+    def test_handle(self):
+        self.agent.batcher = mock.Mock()
+        self.agent._handle(['p1|tag', '', 'p2'], 'mac', '10.0.0.1')
+        self.assertEqual(
+            [mock.call(_notification('p1', '10.0.0.1', 'mac')),
+             mock.call(_notification('p2', '10.0.0.1', 'mac'))],
+            self.agent.batcher.add.call_args_list)
+        self.assertFalse(self.of_rpc.ip_address_owner_update_list.called)
+
+    def test_send(self):
+        batch = [_notification('p1', '10.0.0.1'),
+                 _notification('p2', '10.0.0.1')]
+        self.agent._send(batch)
+        self.of_rpc.ip_address_owner_update_list.assert_called_once_with(
+            mock.ANY, self.agent.agent_id, ip_owner_infos=batch,
+            host=self.agent.host)
+        self.assertFalse(self.of_rpc.ip_address_owner_update.called)
+
+    def test_send_fallback(self):
+        self.of_rpc.ip_address_owner_update_list.side_effect = (
+            oslo_messaging.RemoteError('UnsupportedVersion'))
+        batch = [_notification('p1', '10.0.0.1'),
+                 _notification('p2', '10.0.0.1')]
+        self.agent._send(batch)
+        self.agent._send(batch[:1])
+        self.assertEqual(
+            1, self.of_rpc.ip_address_owner_update_list.call_count)
+        self.assertEqual(3, self.of_rpc.ip_address_owner_update.call_count)
+
+    def test_send_error(self):
+        self.of_rpc.ip_address_owner_update_list.side_effect = (
+            oslo_messaging.MessagingTimeout)
+        self.agent._send([_notification('p1', '10.0.0.1')])
+        self.assertTrue(self.agent.list_rpc)
+        self.assertFalse(self.of_rpc.ip_address_owner_update.called)
+
+    def test_stop(self):
+        self.agent.client = mock.Mock()
+        self.agent.stop()
+        self.assertFalse(self.agent.running)
+        self.assertFalse(self.agent.batcher.running)
+        self.agent.client.close.assert_called_once_with()
+        # a stopped batcher doesn't wait for notifications anymore
+        self.assertEqual([], self.agent.batcher.get_batch())
+        self.agent.batcher.run()
+
+
+class TestWorker(base.BaseTestCase):
+
+    def setUp(self):
+        super(TestWorker, self).setUp()
+        mock.patch.object(opflex_notify.rpc, 'GBPServerRpcApi').start()
+        self.spawn = mock.patch.object(opflex_notify.eventlet,
+                                       'spawn').start()
+        self.process_start = mock.patch.object(
+            opflex_notify.multiprocessing.Process, 'start').start()
+
+    def test_process_mode(self):
+        cfg.CONF.set_override('opflex_notify_mode', 'process', 'OPFLEX')
+        worker = opflex_notify.worker()
+        self.assertIsInstance(worker, opflex_notify.multiprocessing.Process)
+        self.process_start.assert_called_once_with()
+        self.assertFalse(self.spawn.called)
+
+    def test_greenthread_mode(self):
+        cfg.CONF.set_override('opflex_notify_mode', 'greenthread', 'OPFLEX')
+        worker = opflex_notify.worker()
+        self.assertIsInstance(worker, opflex_notify.OpflexNotifyGreenWorker)
+        self.spawn.assert_called_once_with(worker.agent.run)
+        self.assertFalse(self.process_start.called)
+        worker.agent.stop = mock.Mock()
+        worker.terminate()
+        worker.agent.stop.assert_called_once_with()
+        self.spawn.return_value.kill.assert_called_once_with()
@@ -97,3 +97,13 @@ class TestOpflexRpc(base.OpflexTestBase):
             mock.ANY, host='h1', requests=range(3))
         self.assertFalse(
             self.callback.agent_notifier.opflex_vrf_update.called)
+
+    def test_ip_address_owner_update_list(self):
+        infos = [{'port': 'p%d' % i, 'ip_address_v4': '10.0.0.%d' % i}
+                 for i in range(3)]
+        self.callback.ip_address_owner_update_list(
+            mock.ANY, agent_id='a1', host='h1', ip_owner_infos=infos)
+        self.assertEqual(
+            [mock.call(mock.ANY, ip_owner_info=info, agent_id='a1',
+                       host='h1') for info in infos],
+            self.callback.gbp_driver.ip_address_owner_update.call_args_list)
@@ -0,0 +1,179 @@
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+import time
+
+import eventlet
+import mock
+import netaddr
+
+from opflexagent import snat_iptables_manager
+
+from neutron.tests import base
+from oslo_config import cfg
+
+
+class TestSnatIptablesManager(base.BaseTestCase):
+
+    def setUp(self):
+        super(TestSnatIptablesManager, self).setUp()
+        self.ip_lib = mock.patch.object(snat_iptables_manager,
+                                        'ip_lib').start()
+        mock.patch.object(snat_iptables_manager, 'iptables_manager').start()
+        self.execute = mock.patch.object(snat_iptables_manager.agent_utils,
+                                         'execute').start()
+        self.if_dev = self.ip_lib.IPWrapper.return_value.device.return_value
+        self.if_dev.name = 'of-1234'
+        self.if_dev.link.address = 'fa:16:3e:00:00:01'
+        self.snat = snat_iptables_manager.SnatIptablesManager(mock.Mock())
+
+    def _batch(self):
+        self.assertEqual(1, self.execute.call_count)
+        args, kwargs = self.execute.call_args
+        self.assertEqual('-batch', args[0][-2])
+        self.assertTrue(kwargs['run_as_root'])
+        return kwargs['process_input'].splitlines()
+
+    def test_setup_routes(self):
+        self.snat.setup_snat_for_es(
+            'EXT-1', '200.0.0.11', '200.0.0.14', '200.0.0.1/8',
+            '2001:db8::10', '2001:db8::1f', '2001:db8::1/64')
+        ns = self.snat._get_hash_for_es('EXT-1')
+        self.assertEqual(['ip', '-netns', ns, '-batch', '-'],
+                         self.execute.call_args[0][0])
+        # The interface address itself is not a local route
+        self.assertEqual(
+            ['route add local %s dev of-1234' % net for net in (
+                '200.0.0.12/31', '200.0.0.14/32', '2001:db8::10/124')],
+            self._batch())
+        self.if_dev.addr.add.assert_has_calls(
+            [mock.call('200.0.0.11/8'), mock.call('2001:db8::10/64')])
+        self.assertFalse(self.if_dev.route._as_root.called)
+
+    def test_setup_routes_single_ip(self):
+        self.snat.setup_snat_for_es('EXT-1', '200.0.0.10', None,
+                                    '200.0.0.1/8')
+        self.if_dev.addr.add.assert_called_once_with('200.0.0.10/8')
+        self.assertFalse(self.execute.called)
+
+    def test_setup_routes_large_range(self):
+        start = time.time()
+        self.snat.setup_snat_for_es(
+            'EXT-1', None, None, None,
+            '2001:db8::', '2001:db8::ffff:ffff:ffff:fffe', '2001:db8::1/64')
+        self.assertLess(time.time() - start, 5)
+        nets = [netaddr.IPNetwork(line.split()[3]) for line in self._batch()]
+        self.assertEqual(2 ** 64 - 1, sum(net.size for net in nets))
+        self.assertEqual(64, len(nets))
+
+    def _setup_inventory(self, ports, namespaces):
+        self.snat.int_br = mock.MagicMock(br_name='br-fabric')
+        self.snat.int_br.get_port_name_list.return_value = ports
+        self.txn = (
+            self.snat.int_br.ovsdb_transaction.return_value.__enter__.
+            return_value)
+        self.ip_lib.IPWrapper.get_namespaces.return_value = namespaces
+        self.snat.snat_conn_track_handler = mock.Mock()
+
+    def test_cleanup_snat_all(self):
+        cfg.CONF.set_override('enable_snat_conn_track', True, 'OPFLEX')
+        ns = dict((es, self.snat._get_hash_for_es(es))
+                  for es in ('EXT-1', 'EXT-2', 'EXT-3'))
+        self._setup_inventory(
+            [ns['EXT-1'], ns['EXT-2'], ns['EXT-3'], 'qpf-1234'],
+            [ns['EXT-1'], ns['EXT-3'], 'qrouter-1234'])
+        self.snat.cleanup_snat_all(exclude_es=['EXT-3'])
+
+        # All the stale ports are deleted in a single transaction
+        self.assertEqual(1, self.snat.int_br.ovsdb_transaction.call_count)
+        self.assertEqual(
+            sorted([mock.call(ns['EXT-1'], 'br-fabric'),
+                    mock.call(ns['EXT-2'], 'br-fabric')]),
+            sorted(self.snat.int_br.ovsdb.del_port.call_args_list))
+        self.assertEqual(2, self.txn.add.call_count)
+        self.assertFalse(self.snat.int_br.delete_port.called)
+
+        # Only the existing namespaces are deleted, without a lookup each
+        netns = self.ip_lib.IPWrapper.return_value.netns
+        netns.delete.assert_called_once_with(ns['EXT-1'])
+        self.assertFalse(netns.exists.called)
+        self.assertEqual(1, self.ip_lib.IPWrapper.get_namespaces.call_count)
+        handler = self.snat.snat_conn_track_handler
+        handler.conn_track_del.assert_called_once_with(
+            ns['EXT-1'], update_supervisor=False)
+        handler.mgr.schedule_update_supervisor.assert_called_once_with()
+
+    def test_cleanup_snat_all_nothing_stale(self):
+        self._setup_inventory([self.snat._get_hash_for_es('EXT-1')], [])
+        self.snat.cleanup_snat_all(exclude_es=['EXT-1'])
+        self.assertFalse(self.snat.int_br.ovsdb_transaction.called)
+        self.assertFalse(self.ip_lib.IPWrapper.get_namespaces.called)
+
+    def test_inventory(self):
+        ns = self.snat._get_hash_for_es('EXT-1')
+        self._setup_inventory([ns], [ns])
+        with self.snat.inventory():
+            self.assertFalse(self.ip_lib.IPWrapper.get_namespaces.called)
+            for i in range(2, 100):
+                self.assertTrue(self.snat.check_if_exists('EXT-1'))
+                self.assertFalse(self.snat.check_if_exists('EXT-%d' % i))
+            self.snat.cleanup_snat_all()
+        self.assertEqual(1, self.ip_lib.IPWrapper.get_namespaces.call_count)
+        self.assertFalse(
+            self.ip_lib.IPWrapper.return_value.netns.exists.called)
+
+        # Out of an inventory, the namespace is looked up
+        self.snat.check_if_exists('EXT-1')
+        netns = self.ip_lib.IPWrapper.return_value.netns
+        netns.exists.assert_called_once_with(ns)
+
+
+class TestSnatProvisioner(base.BaseTestCase):
+
+    def setUp(self):
+        super(TestSnatProvisioner, self).setUp()
+        self.snat = mock.Mock()
+        self.done = eventlet.Event()
+        self.started = []
+
+        def setup_snat_for_es(es_name, *args, **kwargs):
+            self.started.append(es_name)
+            self.done.wait()
+            return ('if-' + es_name, 'mac-' + es_name)
+        self.snat.setup_snat_for_es.side_effect = setup_snat_for_es
+        self.provisioner = snat_iptables_manager.SnatProvisioner(self.snat, 1)
+
+    def test_queue(self):
+        # Scheduling doesn't wait for a free worker
+        with eventlet.Timeout(5):
+            for es in ('EXT-1', 'EXT-2', 'EXT-3', 'EXT-1'):
+                self.provisioner.provision(es, '200.0.0.10')
+        self.assertEqual(['EXT-1'], list(self.provisioner.futures))
+        self.assertEqual(['EXT-2', 'EXT-3'], list(self.provisioner.queued))
+        for es in ('EXT-1', 'EXT-2', 'EXT-3'):
+            self.assertTrue(self.provisioner.pending(es))
+
+        self.provisioner.cancel('EXT-2')
+        self.assertFalse(self.provisioner.pending('EXT-2'))
+        eventlet.sleep(0)
+        self.assertEqual(['EXT-1'], self.started)
+        self.done.send()
+        ready = {}
+        with eventlet.Timeout(5):
+            while len(ready) < 2:
+                eventlet.sleep(0.01)
+                ready.update(self.provisioner.get_ready())
+        self.assertEqual(['EXT-1', 'EXT-3'], self.started)
+        self.assertEqual({'EXT-1': (('if-EXT-1', 'mac-EXT-1'), None),
+                          'EXT-3': (('if-EXT-3', 'mac-EXT-3'), None)},
+                         ready)
+        self.assertEqual({}, self.provisioner.queued)
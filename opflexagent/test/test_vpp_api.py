@@ -0,0 +1,249 @@
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+import collections
+import importlib
+import sys
+
+import mock
+
+from neutron.tests import base
+
+CreateReply = collections.namedtuple('CreateReply', ['retval', 'sw_if_index'])
+PingReply = collections.namedtuple('PingReply', ['retval', 'vpe_pid'])
+Reply = collections.namedtuple('Reply', ['retval'])
+
+
+def _load_vpplib(module, mocked_modules):
+    # Other test modules replace the whole vpplib package in sys.modules,
+    # load the real module while keeping their mocks in place.
+    with mock.patch.dict(sys.modules):
+        for name in list(sys.modules):
+            if name.startswith('opflexagent.vpplib'):
+                del sys.modules[name]
+        for name in mocked_modules:
+            sys.modules[name] = mock.MagicMock()
+        return importlib.import_module('opflexagent.vpplib.%s' % module)
+
+
+def _load_vpp_api():
+    return _load_vpplib('VPPApi', ['opflexagent.vpplib.vpp_papi_provider'])
+
+
+class TestVPPApi(base.BaseTestCase):
+
+    def setUp(self):
+        super(TestVPPApi, self).setUp()
+        self.vpp_api = _load_vpp_api()
+        self.provider_cls = mock.patch.object(
+            self.vpp_api, 'VppPapiProvider').start()
+        self.vppp = self.provider_cls.return_value
+        self.vppp.connect.return_value = 0
+        self.vppp.create_vhostuser_socket.return_value = CreateReply(0, 7)
+        self.vppp.set_interface_mtu.return_value = Reply(0)
+        self.vppp.set_interface_state.return_value = Reply(0)
+        self.vapi = self.vpp_api.VPPApi(mock.Mock(), 'test')
+
+    def test_calls_without_session(self):
+        self.vapi.set_interface_mtu(7, 1500)
+        self.vapi.set_interface_state(7, 1)
+        self.assertEqual(2, self.provider_cls.call_count)
+
+    def test_session_single_connection(self):
+        with self.vapi.session():
+            self.vapi.set_interface_mtu(7, 1500)
+            with self.vapi.session():
+                self.vapi.set_interface_state(7, 1)
+            self.vapi.set_interface_state(7, 0)
+        self.assertEqual(1, self.provider_cls.call_count)
+        self.assertEqual(1, self.vppp.connect.call_count)
+        # A new connection is used once the session is over
+        self.vapi.set_interface_state(7, 1)
+        self.assertEqual(2, self.provider_cls.call_count)
+
+    def test_persistent_connection(self):
+        self.vppp.control_ping.return_value = PingReply(0, 1234)
+        self.vapi.connect()
+        self.assertTrue(self.vapi.connected)
+        self.assertEqual(1234, self.vapi.control_ping())
+        with self.vapi.session():
+            self.vapi.control_ping()
+        # The session doesn't close the persistent connection
+        self.assertTrue(self.vapi.connected)
+        self.vapi.control_ping()
+        self.assertEqual(1, self.provider_cls.call_count)
+        self.vapi.disconnect()
+        self.assertFalse(self.vapi.connected)
+
+    def test_create_vhost_user_vif(self):
+        sw_if_index = self.vapi.create_vhost_user_vif(
+            '/tmp/sock', 1, 'mac', 'tag', mtu=1400)
+        self.assertEqual(7, sw_if_index)
+        self.assertEqual(1, self.provider_cls.call_count)
+        self.vppp.create_vhostuser_socket.assert_called_once_with(
+            '/tmp/sock', 1, 'mac', 'tag')
+        self.vppp.set_interface_mtu.assert_called_once_with(7, 1400)
+        self.vppp.set_interface_state.assert_called_once_with(7, 1)
+
+    def test_create_vhost_user_vif_no_mtu(self):
+        self.vapi.create_vhost_user_vif('/tmp/sock', 0, 'mac', 'tag')
+        self.assertFalse(self.vppp.set_interface_mtu.called)
+        self.vppp.set_interface_state.assert_called_once_with(7, 1)
+
+
+class TestVppInterfaceCatalog(base.BaseTestCase):
+
+    def setUp(self):
+        super(TestVppInterfaceCatalog, self).setUp()
+        self.vpp_api = _load_vpp_api()
+
+    def _dumps(self, count):
+        interfaces = []
+        vhosts = []
+        for i in range(count):
+            name = 'VirtualEthernet0/0/%d' % i
+            interfaces.append({'interface_name': name,
+                               'sw_if_index': i + 1,
+                               'tag': 'port-%d|tag' % i,
+                               'l2_address': 'fa:16:3e:%02x:%02x:%02x' % (
+                                   i >> 16, (i >> 8) & 0xff, i & 0xff)})
+            vhosts.append({'interface_name': name,
+                           'sw_if_index': i + 1,
+                           'sock_filename': '/var/run/vpp-sockets/'
+                                            'vhu%08d-aaaa-bbbb' % i,
+                           'sock_errno': 0,
+                           'num_regions': 1})
+        interfaces.append({'interface_name': 'host-tap1234',
+                           'sw_if_index': count + 1,
+                           'tag': 'port-tap',
+                           'l2_address': 'fa:16:3e:ff:ff:ff'})
+        return interfaces, vhosts
+
+    def test_lookups(self):
+        interfaces, vhosts = self._dumps(3)
+        catalog = self.vpp_api.VppInterfaceCatalog(interfaces, vhosts)
+        self.assertEqual(2, catalog.by_tag['port-1|tag']['sw_if_index'])
+        self.assertEqual(
+            'VirtualEthernet0/0/2',
+            catalog.by_mac['fa:16:3e:00:00:02']['interface_name'])
+        # Only vhost-user interfaces are indexed by mac
+        self.assertNotIn('fa:16:3e:ff:ff:ff', catalog.by_mac)
+        self.assertEqual('/var/run/vpp-sockets/vhu00000001-aaaa-bbbb',
+                         catalog.sock_name('VirtualEthernet0/0/1'))
+        self.assertEqual('', catalog.sock_name('host-tap1234'))
+
+    def test_vhost_from_sock(self):
+        interfaces, vhosts = self._dumps(3)
+        catalog = self.vpp_api.VppInterfaceCatalog(interfaces, vhosts)
+        path = '/var/run/vpp-sockets/vhu00000001-aaaa-bbbb'
+        self.assertEqual(2, catalog.vhost_from_sock(path)['sw_if_index'])
+        self.assertEqual(
+            2, catalog.vhost_from_sock('vhu00000001-aaaa-bbbb')[
+                'sw_if_index'])
+        self.assertEqual(
+            3, catalog.vhost_from_sock('vhu00000002')['sw_if_index'])
+        self.assertIsNone(catalog.vhost_from_sock('vhu00000009'))
+        # Substrings which are not a basename prefix don't match anymore
+        self.assertIsNone(catalog.vhost_from_sock('aaaa'))
+        self.assertIsNone(catalog.vhost_from_sock(''))
+
+    def test_vhost_status(self):
+        interfaces, vhosts = self._dumps(2)
+        vhosts[1]['num_regions'] = 0
+        catalog = self.vpp_api.VppInterfaceCatalog([], vhosts)
+        get_status = self.vpp_api.VPPApi._get_vhost_status
+        self.assertEqual(
+            (0, vhosts[0]),
+            get_status(catalog, vhosts[0]['sock_filename']))
+        self.assertEqual(
+            (4, ''), get_status(catalog, vhosts[1]['sock_filename']))
+        self.assertEqual((1, ''), get_status(catalog, '/no/such/socket'))
+
+    def test_get_vhost_tag_dicts_scale(self):
+        vapi = self.vpp_api.VPPApi(mock.Mock(), 'test')
+        vapi._connection = mock.MagicMock()
+        for count in (10, 1000, 10000):
+            interfaces, vhosts = self._dumps(count)
+            vapi._get_catalog = mock.Mock(
+                return_value=self.vpp_api.VppInterfaceCatalog(
+                    interfaces, vhosts))
+            tag_dict = vapi.get_vhost_tag_dicts()
+            self.assertEqual(count + 1, len(tag_dict))
+            self.assertEqual('tap1234', tag_dict['port-tap'])
+            for i in range(0, count, max(1, count // 100)):
+                self.assertEqual(vhosts[i]['sock_filename'],
+                                 tag_dict['port-%d|tag' % i])
+
+    def test_catalog_scale(self):
+        interfaces, vhosts = self._dumps(10000)
+        catalog = self.vpp_api.VppInterfaceCatalog(interfaces, vhosts)
+        for i in range(10000):
+            intf = catalog.by_mac[interfaces[i]['l2_address']]
+            self.assertEqual(vhosts[i]['sock_filename'],
+                             catalog.sock_name(intf['interface_name']))
+            basename = vhosts[i]['sock_filename'].split('/')[-1]
+            self.assertEqual(
+                i + 1, catalog.vhost_from_sock(basename[:11])['sw_if_index'])
+
+
+class TestApiMetrics(base.BaseTestCase):
+
+    def setUp(self):
+        super(TestApiMetrics, self).setUp()
+        self.provider = _load_vpplib('vpp_papi_provider', ['vpp_papi'])
+
+    def _api_fn(self, name, reply):
+        api_fn = mock.Mock(return_value=reply)
+        api_fn.__name__ = name
+        return api_fn
+
+    def test_disabled(self):
+        vppp = self.provider.VppPapiProvider('test')
+        self.assertIs(self.provider.Hook, type(vppp.hook))
+        vppp.api(self._api_fn('show_version', Reply(0)), {})
+        self.assertEqual({}, self.provider.api_metrics.dump())
+
+    def test_enabled(self):
+        self.provider.api_metrics.enable()
+        vppp = self.provider.VppPapiProvider('test')
+        self.assertIsInstance(vppp.hook, self.provider.MetricsHook)
+        vppp.api(self._api_fn('show_version', Reply(0)), {})
+        vppp.api(self._api_fn('show_version', Reply(0)), {})
+        self.assertRaises(self.provider.UnexpectedApiReturnValueError,
+                          vppp.api, self._api_fn('control_ping', Reply(-1)),
+                          {})
+        api_fn = self._api_fn('control_ping', None)
+        api_fn.side_effect = IOError
+        self.assertRaises(IOError, vppp.api, api_fn, {})
+
+        metrics = self.provider.api_metrics.dump()
+        self.assertEqual(['control_ping', 'show_version'], sorted(metrics))
+        self.assertEqual(2, metrics['show_version']['calls'])
+        self.assertEqual(0, metrics['show_version']['errors'])
+        self.assertEqual(2, metrics['control_ping']['calls'])
+        self.assertEqual(2, metrics['control_ping']['errors'])
+        self.assertEqual(
+            2, sum(metrics['show_version']['histogram'].values()))
+
+    def test_histogram(self):
+        metrics = self.provider.api_metrics
+        metrics.record('show_version', 0.00005)
+        metrics.record('show_version', 0.002)
+        metrics.record('show_version', 0.005)
+        metrics.record('show_version', 3)
+        histogram = metrics.dump()['show_version']['histogram']
+        self.assertEqual(1, histogram['<=0.0001'])
+        self.assertEqual(2, histogram['<=0.005'])
+        self.assertEqual(1, histogram['>1.0'])
+        self.assertEqual(4, sum(histogram.values()))
+        metrics.reset()
+        self.assertEqual({}, metrics.dump())
@@ -10,15 +10,20 @@
 #    License for the specific language governing permissions and limitations
 #    under the License.
 
+import collections
 from neutron.agent.linux import ip_lib
 from neutron.plugins.ml2.drivers.openvswitch.agent.common import constants
 from neutron_lib import constants as lib_constants
 from opflexagent import constants as ofcst
 from opflexagent.utils.bridge_managers import bridge_manager_base
 from opflexagent.utils.bridge_managers import trunk_skeleton
+from opflexagent.vpplib import hook as vpp_hook
 from opflexagent.vpplib.VPPApi import VPPApi
 import os
 from oslo_log import log as logging
+from oslo_serialization import jsonutils
+import signal
+import time
 
 
 LOG = logging.getLogger(__name__)
@@ -34,6 +39,15 @@ class VppManager(bridge_manager_base.BridgeManagerBase,
     def initialize(self, host, conf, agent_state):
         self.int_br_device_count = 0
         vpp_config = conf.VPP
+        self.liveness_probe = vpp_config.liveness_probe
+        # Persistent connection used by the liveness probe
+        self.vapi = VPPApi(LOG, 'gbp-agent')
+        # Pid of the VPP process seen by the last successful probe
+        self.vpp_boot_id = None
+        self.probe_latency = None
+        if vpp_config.api_metrics:
+            vpp_hook.api_metrics.enable()
+            signal.signal(signal.SIGUSR2, self._log_api_metrics)
         agent_state['agent_type'] = ofcst.AGENT_TYPE_OPFLEX_VPP
         agent_state['vhostuser_socket_dir'] = vpp_config.vhostuser_socket_dir
         return self, agent_state
@@ -41,13 +55,45 @@ class VppManager(bridge_manager_base.BridgeManagerBase,
     def get_local_ip(self):
         return None
 
+    def _log_api_metrics(self, signum, frame):
+        LOG.info("VPP API metrics: %s",
+                 jsonutils.dumps(vpp_hook.api_metrics.dump()))
+
     def check_bridge_status(self):
+        if self.liveness_probe == 'version':
+            return self._check_version()
+        return self._check_ping()
+
+    def _check_version(self):
         vapi = VPPApi(LOG, 'gbp-agent')
         version = vapi.get_version()
         if (version['retval'] == 0) and version['version']:
             return constants.OVS_NORMAL
         return constants.OVS_DEAD
 
+    def _check_ping(self):
+        start = time.time()
+        try:
+            self.vapi.connect()
+            boot_id = self.vapi.control_ping()
+        except Exception as e:
+            LOG.warning("VPP liveness probe failed: %s", e)
+            try:
+                self.vapi.disconnect()
+            except Exception:
+                pass
+            return constants.OVS_DEAD
+        self.probe_latency = time.time() - start
+        LOG.debug("VPP liveness probe completed. Elapsed:%(elapsed).6f",
+                  {'elapsed': self.probe_latency})
+        status = constants.OVS_NORMAL
+        if self.vpp_boot_id is not None and boot_id != self.vpp_boot_id:
+            LOG.info("VPP restarted (pid %(old)s -> %(new)s)",
+                     {'old': self.vpp_boot_id, 'new': boot_id})
+            status = constants.OVS_RESTARTED
+        self.vpp_boot_id = boot_id
+        return status
+
     def setup_integration_bridge(self):
         """Override parent setup integration bridge.
         VPP renderer handles the bridge creation.
@@ -134,20 +180,42 @@ class VppManager(bridge_manager_base.BridgeManagerBase,
         return uuid_filtered
 
     @staticmethod
-    def _device_exists(device_name):
-        if device_name:
+    def _existing_devices(device_names):
+        """Get the subset of device_names which exist.
+
+        Veth names are checked against a single listing of the host links,
+        vhost-user socket paths against a single listing of each socket
+        directory, whatever the number of devices.
+        """
+        existing = set()
+        veths = set()
+        sockets = collections.defaultdict(set)
+        for device_name in device_names:
+            if not device_name:
+                continue
             if device_name.startswith(lib_constants.VETH_DEVICE_PREFIX):
-                return ip_lib.device_exists(device_name)
+                veths.add(device_name)
             else:
-                return os.path.exists(device_name)
-        else:
-            return False
+                sockets[os.path.dirname(device_name)].add(device_name)
+        if veths:
+            links = set(dev.name for dev in ip_lib.IPWrapper().get_devices())
+            existing |= veths & links
+        for dirname, paths in sockets.items():
+            try:
+                entries = set(os.listdir(dirname or os.curdir))
+            except OSError:
+                continue
+            existing |= set(path for path in paths
+                            if os.path.basename(path) in entries)
+        return existing
 
     def handle_removed_eps(self, em, removed_eps):
+        port_names = dict((ep, em.get_access_int_for_vif(ep))
+                          for ep in removed_eps)
+        existing = self._existing_devices(port_names.values())
         retain = set()
-        for ep in removed_eps:
-            port_name = em.get_access_int_for_vif(ep)
-            if self._device_exists(port_name):
+        for ep, port_name in port_names.items():
+            if port_name in existing:
                 LOG.debug("Retaining {}".format(port_name))
                 retain |= {ep}
         removed_eps -= retain
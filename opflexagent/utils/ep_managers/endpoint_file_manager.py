@@ -33,6 +33,10 @@ VRF_FILE_NAME_FORMAT = "%s." + VRF_FILE_EXTENSION
 LBIFACE_FILE_EXTENSION = "lbiface"
 LBIFACE_FILE_NAME_FORMAT = "%s." + LBIFACE_FILE_EXTENSION
 NESTED_DOMAIN_UPLINK = "uplink"
+# Every address of the SNAT range of an external segment is listed in its
+# host EP file. IPv6 ranges, e.g. a /64, are truncated to this many
+# addresses when loaded, for the SNAT datapath and the EP alike.
+MAX_SNAT_RANGE_SIZE = 4096
 
 
 class ExtSegNextHopInfo(object):
@@ -48,6 +52,7 @@ class ExtSegNextHopInfo(object):
         self.next_hop_iface = None
         self.next_hop_mac = None
         self.from_config = False
+        self.setup_failed = False
         self.uuid = uuidutils.generate_uuid()
 
     def __str__(self):
@@ -94,6 +99,15 @@ class EndpointFileManager(endpoint_manager_base.EndpointManagerBase):
 
         self.snat_iptables = snat_iptables_manager.SnatIptablesManager(
             bridge_manager.fabric_br)
+        # SNAT namespaces are set up in the background when workers are
+        # configured, the EP files of the ports using an external segment
+        # are written once its next hop is ready.
+        self.snat_provisioner = None
+        if config['snat_provisioning_workers']:
+            self.snat_provisioner = snat_iptables_manager.SnatProvisioner(
+                self.snat_iptables, config['snat_provisioning_workers'])
+        self.snat_ipms = {}
+        self.snat_waiters = {}
         self._registered_endpoints = set()
         self._stale_endpoints = set()
         self.vif_int_dict = {}
@@ -111,9 +125,12 @@ class EndpointFileManager(endpoint_manager_base.EndpointManagerBase):
         LOG.debug("Mapping file for port %(port)s, %(mapping)s" %
                   {'port': port.vif_id, 'mapping': mapping})
 
+        self._discard_snat_waiter(port.vif_id)
         if not mapping:
             return
         else:
+            # External segments whose next hop is being set up
+            es_pending = set()
             # Multiple files will be created based on how many MAC
             # addresses are owned by the specific port.
             mapping_copy = copy.deepcopy(mapping)
@@ -165,7 +182,8 @@ class EndpointFileManager(endpoint_manager_base.EndpointManagerBase):
             # Create mapping file for base MAC address
             LOG.debug("Main file mapping %s", mapping_copy)
             macs.add(mapping_copy.get('mac_address') or port.vif_mac)
-            self._mapping_to_file(port, mapping_copy, port.fixed_ips)
+            self._mapping_to_file(port, mapping_copy, port.fixed_ips,
+                                  es_pending=es_pending)
             # Reset for AAP EP files
             mapping_copy['allowed_address_pairs'] = []
             mapping_copy['fixed_ips'] = []
@@ -196,16 +214,21 @@ class EndpointFileManager(endpoint_manager_base.EndpointManagerBase):
                 mapping_copy['allowed_address_pairs'] = aaps
                 LOG.debug("Secondary file mapping %s", mapping_copy)
                 macs.add(mapping_copy.get('mac_address'))
-                self._mapping_to_file(port, mapping_copy, [])
+                self._mapping_to_file(port, mapping_copy, [],
+                                      es_pending=es_pending)
 
             # PT cleanup is needed after the new endpoint files
             self._mapping_cleanup(port.vif_id, cleanup_vrf=False,
                                   mac_exceptions=macs)
             self._registered_endpoints.add(port.vif_id)
             self.vif_int_dict.update({port.vif_id: port.port_name})
+            for es in es_pending:
+                self.snat_waiters.setdefault(es, {})[port.vif_id] = (
+                    port, mapping)
 
     def undeclare_endpoint(self, port_id):
         LOG.info("Endpoint undeclare requested for port %s", port_id)
+        self._discard_snat_waiter(port_id)
         self._mapping_cleanup(port_id)
         self._registered_endpoints.discard(port_id)
         self._stale_endpoints.discard(port_id)
@@ -220,8 +243,71 @@ class EndpointFileManager(endpoint_manager_base.EndpointManagerBase):
     def get_access_int_for_vif(self, vif):
         return self.vif_int_dict.get(vif)
 
+    def apply_async_updates(self):
+        if not self.snat_provisioner:
+            return
+        for es_name in self.snat_provisioner.get_cancelled():
+            if (es_name in self.snat_waiters or
+                    es_name in self.es_port_dict):
+                continue
+            # Cleaned up again, the setup may have run after the cleanup
+            try:
+                self.snat_iptables.cleanup_snat_for_es(es_name)
+            except Exception as e:
+                LOG.warn(_("Failed to remove SNAT iptables for "
+                           "%(es)s: %(ex)s"), {'es': es_name, 'ex': e})
+        for es_name, (result, error) in (
+                self.snat_provisioner.get_ready().items()):
+            ipm = self.snat_ipms.pop(es_name, None)
+            nh = self.ext_seg_next_hop.get(es_name)
+            if error:
+                LOG.error(_("Error while creating SNAT iptables for "
+                            "%(es)s: %(ex)s"), {'es': es_name, 'ex': error})
+                if nh:
+                    # The waiting ports are written without its SNAT
+                    # mappings, the next declaration of a port retries
+                    nh.setup_failed = True
+                    try:
+                        self._declare_snat_waiters(es_name)
+                    finally:
+                        nh.setup_failed = False
+                continue
+            if not ipm or not nh:
+                continue
+            if (es_name not in self.snat_waiters and
+                    es_name not in self.es_port_dict):
+                # The ports needing it went away in the meantime
+                try:
+                    self.snat_iptables.cleanup_snat_for_es(es_name)
+                except Exception as e:
+                    LOG.warn(_("Failed to remove SNAT iptables for "
+                               "%(es)s: %(ex)s"), {'es': es_name, 'ex': e})
+                continue
+            try:
+                (nh.next_hop_iface, nh.next_hop_mac) = result
+                LOG.info(_("Created SNAT iptables for %(es)s: "
+                           "iface %(if)s, mac %(mac)s"),
+                         {'es': es_name, 'if': nh.next_hop_iface,
+                          'mac': nh.next_hop_mac})
+                self._create_host_endpoint_file(ipm, nh)
+                self._declare_snat_waiters(es_name)
+            except Exception as e:
+                LOG.exception(_("Error while applying SNAT setup for "
+                                "%(es)s: %(ex)s"), {'es': es_name, 'ex': e})
+
     # Private Methods
 
+    def _declare_snat_waiters(self, es_name):
+        waiters = self.snat_waiters.pop(es_name, {})
+        for port, mapping in waiters.values():
+            self.declare_endpoint(port, mapping)
+
+    def _discard_snat_waiter(self, port_id):
+        for es in self.snat_waiters.keys():
+            self.snat_waiters[es].pop(port_id, None)
+            if not self.snat_waiters[es]:
+                del self.snat_waiters[es]
+
     def _setup_ep_directory(self):
         """ Setup endpoint directory
 
@@ -231,41 +317,44 @@ class EndpointFileManager(endpoint_manager_base.EndpointManagerBase):
         created = False
         snat_excl = []
         dirs = set([os.path.dirname(f) for f in self.file_formats])
-        for directory in dirs:
-            if not os.path.exists(directory):
-                created = True
-                os.makedirs(directory)
-                continue
-            # Calculate registered endpoints
-            for f in os.listdir(directory):
-                if f.endswith('.' + FILE_EXTENSION):
-                    filename = f[:-len(FILE_EXTENSION) - 1]
-                    if '_' in f:
-                        self._registered_endpoints.add(f.split('_')[0])
-                        fp = file(os.path.join(directory, f))
-                        try:
-                            ep_opts = json.load(fp)
-                            access_int = ep_opts['access-interface']
-                            self.vif_int_dict.update({f.split('_')[0]:
-                                access_int})
-                        except Exception as e:
-                            # KeyError should only happen for UT
-                            # EP File would be deleted if parsing fails
-                            # for a VPP endpoint at restart
-                            LOG.exception(_("Error while parsing ep "
-                                "file %(file)s: %(ex)s"),
-                                {'file': f, 'ex': e})
-
-                    elif self.snat_iptables.check_if_exists(filename):
-                        # check if EP file is for SNAT EP. If so mark it for
-                        # exclusion from clean-up; also don't register the EP
-                        # file, otherwise it will be treated as a removed port
-                        snat_excl.append(filename)
-                    else:
-                        # Mark unknown EP file as stale
-                        self._stale_endpoints.add(f)
-        if not created:
-            self.snat_iptables.cleanup_snat_all(exclude_es=snat_excl)
+        # A single listing of the SNAT namespaces serves all the checks
+        with self.snat_iptables.inventory():
+            for directory in dirs:
+                if not os.path.exists(directory):
+                    created = True
+                    os.makedirs(directory)
+                    continue
+                # Calculate registered endpoints
+                for f in os.listdir(directory):
+                    if f.endswith('.' + FILE_EXTENSION):
+                        filename = f[:-len(FILE_EXTENSION) - 1]
+                        if '_' in f:
+                            self._registered_endpoints.add(f.split('_')[0])
+                            fp = file(os.path.join(directory, f))
+                            try:
+                                ep_opts = json.load(fp)
+                                access_int = ep_opts['access-interface']
+                                self.vif_int_dict.update({f.split('_')[0]:
+                                    access_int})
+                            except Exception as e:
+                                # KeyError should only happen for UT
+                                # EP File would be deleted if parsing fails
+                                # for a VPP endpoint at restart
+                                LOG.exception(_("Error while parsing ep "
+                                    "file %(file)s: %(ex)s"),
+                                    {'file': f, 'ex': e})
+
+                        elif self.snat_iptables.check_if_exists(filename):
+                            # check if EP file is for SNAT EP. If so mark it
+                            # for exclusion from clean-up; also don't register
+                            # the EP file, otherwise it will be treated as a
+                            # removed port
+                            snat_excl.append(filename)
+                        else:
+                            # Mark unknown EP file as stale
+                            self._stale_endpoints.add(f)
+            if not created:
+                self.snat_iptables.cleanup_snat_all(exclude_es=snat_excl)
 
     def _mapping_cleanup(self, vif_id, cleanup_vrf=True, mac_exceptions=None):
         mac_exceptions = mac_exceptions or set()
@@ -277,10 +366,11 @@ class EndpointFileManager(endpoint_manager_base.EndpointManagerBase):
             self._release_int_fip(6, vif_id)
             self._update_vif_to_vrf(vif_id, None)
 
-    def _mapping_to_file(self, port, mapping, fixed_ips):
+    def _mapping_to_file(self, port, mapping, fixed_ips, es_pending=None):
         """Mapping to file.
 
-        Converts the port mapping into file.
+        Converts the port mapping into file. The external segments whose
+        next hop is still being set up are added to es_pending.
         """
         # Skip router-interface ports - they interfere with OVS pipeline
 
@@ -375,9 +465,11 @@ class EndpointFileManager(endpoint_manager_base.EndpointManagerBase):
                 x[0].strip(): x[2].strip() for x in lbls})
 
         self._handle_host_snat_ip(mapping.get('host_snat_ips', []))
-        self._fill_ip_mapping_info(port.vif_id, mac, mapping,
-                                   sorted(ips + ips_aap + ips_ext),
-                                   mapping_dict)
+        pending = self._fill_ip_mapping_info(
+            port.vif_id, mac, mapping, sorted(ips + ips_aap + ips_ext),
+            mapping_dict)
+        if es_pending is not None:
+            es_pending.update(pending)
         if has_eg_mapping_alias:
             mapping_dict.pop("policy-space-name", None)
             mapping_dict.pop("endpoint-group-name", None)
@@ -454,7 +546,13 @@ class EndpointFileManager(endpoint_manager_base.EndpointManagerBase):
         if master_port_id:
             file_name = master_port_id + '_' + file_name
 
-        self._write_endpoint_file(file_name, mapping_dict)
+        if pending:
+            # Not written without the SNAT mappings, the port is declared
+            # again once the next hops are ready
+            LOG.debug("Deferring endpoint file %(file)s until SNAT is ready "
+                      "for %(es)s", {'file': file_name, 'es': list(pending)})
+        else:
+            self._write_endpoint_file(file_name, mapping_dict)
         self.vrf_info_to_file(mapping, vif_id=port.vif_id)
 
     def _list_to_range(self, vlans_list):
@@ -515,6 +613,7 @@ class EndpointFileManager(endpoint_manager_base.EndpointManagerBase):
                 # re-created as required; leave MAC as is so that it will
                 # be re-used
                 nh.next_hop_iface = None
+                self._cancel_snat_setup(es)
                 LOG.info(_("Add/update SNAT info: %s"), nh)
 
     def _map_dhcp_info(self, fixed_ips, mapping, mapping_dict):
@@ -589,9 +688,24 @@ class EndpointFileManager(endpoint_manager_base.EndpointManagerBase):
                     (nh.ip6_start, nh.ip6_end) = parse_range(value)
                 elif key == 'ip6_gateway':
                     nh.ip6_gateway = parse_gateway(value)
+            nh.ip6_end = self._limit_snat_range(es_name, nh.ip6_start,
+                                                nh.ip6_end)
             self.ext_seg_next_hop[es_name] = nh
             LOG.debug(_("Found external segment: %s") % nh)
 
+    def _limit_snat_range(self, es_name, ip_start, ip_end):
+        if not ip_start or not ip_end:
+            return ip_end
+        start = netaddr.IPAddress(ip_start)
+        if int(netaddr.IPAddress(ip_end)) - int(start) < MAX_SNAT_RANGE_SIZE:
+            return ip_end
+        limit = str(start + (MAX_SNAT_RANGE_SIZE - 1))
+        LOG.warn(_("SNAT range %(start)s-%(end)s of external segment "
+                   "%(es)s is too large, using %(start)s-%(limit)s"),
+                 {'start': ip_start, 'end': ip_end, 'es': es_name,
+                  'limit': limit})
+        return limit
+
     def _fill_ip_mapping_info(self, port_id, port_mac, gbp_details, ips,
                               mapping):
         fip_fixed_ips = {}
@@ -614,6 +728,7 @@ class EndpointFileManager(endpoint_manager_base.EndpointManagerBase):
         host_snat_ip_es = {hsi['external_segment_name']
                            for hsi in gbp_details.get('host_snat_ips', [])}
         es_using_int_fip = {4: set(), 6: set()}
+        es_pending = set()
         for ipm in gbp_details.get('ip_mapping', []):
             if (not ips or not ipm.get('external_segment_name') or
                     not ipm.get('nat_epg_tenant') or
@@ -629,8 +744,10 @@ class EndpointFileManager(endpoint_manager_base.EndpointManagerBase):
                           "|" + ipm['next_hop_ep_epg'])
                 ipm['next_hop_ep_epg'] = nh_epg
 
-            next_hop_if, next_hop_mac = (
+            next_hop_if, next_hop_mac, pending = (
                 self._get_next_hop_info_for_es(ipm, host_snat_ip_es))
+            if pending:
+                es_pending.add(es)
             if not next_hop_if or not next_hop_mac:
                 continue
             fip_alloc_es = {
@@ -654,11 +771,16 @@ class EndpointFileManager(endpoint_manager_base.EndpointManagerBase):
         old_es = self._get_es_for_port(port_id, port_mac)
         new_es = es_using_int_fip[4] | es_using_int_fip[6]
         self._associate_port_with_es(port_id, port_mac, new_es)
-        self._dissociate_port_from_es(port_id, port_mac, old_es - new_es)
+        # Keep the port on the external segments being set up, its internal
+        # FIPs are used again once their next hop is ready
+        self._dissociate_port_from_es(port_id, port_mac,
+                                      old_es - new_es - es_pending)
 
         for ip_ver in es_using_int_fip.keys():
             fip_alloc = self._get_int_fips(ip_ver, port_id, port_mac)
             for es in fip_alloc.keys():
+                if es in es_pending:
+                    continue
                 if es not in es_using_int_fip[ip_ver]:
                     self._release_int_fip(ip_ver, port_id, port_mac, es)
                 else:
@@ -668,6 +790,7 @@ class EndpointFileManager(endpoint_manager_base.EndpointManagerBase):
         if 'ip-address-mapping' in mapping:
             mapping['ip-address-mapping'].sort(
                 key=lambda x: (x['mapped-ip'], x['floating-ip']))
+        return es_pending
 
     def _get_int_fips(self, ip_ver, port_id, port_mac):
         return self.int_fip_alloc[ip_ver].get((port_id, port_mac), {})
@@ -743,6 +866,7 @@ class EndpointFileManager(endpoint_manager_base.EndpointManagerBase):
             if self.es_port_dict[es]:
                 continue
             self.es_port_dict.pop(es)
+            self._cancel_snat_setup(es)
             if es in self.ext_seg_next_hop:
                 self.ext_seg_next_hop[es].next_hop_iface = None
                 self.ext_seg_next_hop[es].next_hop_mac = None
@@ -756,15 +880,28 @@ class EndpointFileManager(endpoint_manager_base.EndpointManagerBase):
                          {'es': es, 'ex': e})
 
     def _get_next_hop_info_for_es(self, ipm, host_snat_ip_es):
+        """Return (next hop interface, next hop MAC, pending).
+
+        pending is True when the next hop is being set up in the background.
+        """
         es_name = ipm['external_segment_name']
         nh = self.ext_seg_next_hop.get(es_name)
         if not nh or not nh.is_valid():
-            return (None, None)
+            return (None, None, False)
         # if this Ext Seg has auto-allocated SNAT IPs, then
         # make sure we received host SNAT IP for the ES.
         if not nh.from_config and (es_name not in host_snat_ip_es):
-            return (None, None)
+            return (None, None, False)
         # create ep file for endpoint and snat tables
+        if not nh.next_hop_iface and self.snat_provisioner:
+            if nh.setup_failed:
+                return (None, None, False)
+            self.snat_provisioner.provision(
+                es_name, nh.ip_start, nh.ip_end, nh.ip_gateway,
+                nh.ip6_start, nh.ip6_end, nh.ip6_gateway,
+                nh.next_hop_mac, mtu=self.nat_mtu_size)
+            self.snat_ipms[es_name] = ipm
+            return (None, None, True)
         if not nh.next_hop_iface:
             try:
                 (nh.next_hop_iface, nh.next_hop_mac) = (
@@ -781,7 +918,12 @@ class EndpointFileManager(endpoint_manager_base.EndpointManagerBase):
                                 "%(es)s: %(ex)s"),
                               {'es': es_name, 'ex': e})
             self._create_host_endpoint_file(ipm, nh)
-        return (nh.next_hop_iface, nh.next_hop_mac)
+        return (nh.next_hop_iface, nh.next_hop_mac, False)
+
+    def _cancel_snat_setup(self, es_name):
+        if self.snat_provisioner:
+            self.snat_provisioner.cancel(es_name)
+            self.snat_ipms.pop(es_name, None)
 
     def vrf_info_to_file(self, mapping, vif_id=None):
         if not vif_id and not mapping['l3_policy_id'] in self.vrf_dict:
@@ -827,7 +969,7 @@ class EndpointFileManager(endpoint_manager_base.EndpointManagerBase):
         ips = []
         for s, e in [(nh.ip_start, nh.ip_end), (nh.ip6_start, nh.ip6_end)]:
             if s:
-                ips.extend(list(netaddr.iter_iprange(s, e or s)))
+                ips.extend(netaddr.iter_iprange(s, e or s))
         ep_dict = {
             "attributes": {
                 "vm-name": (
@@ -83,3 +83,12 @@ class EndpointManagerBase(object):
 
         :return: access interface name
         """
+
+    def apply_async_updates(self):
+        """ Apply the results of background endpoint work.
+
+        Called periodically by the agent loop. Endpoint managers which defer
+        part of the endpoint declaration complete it here.
+
+        :return: None
+        """
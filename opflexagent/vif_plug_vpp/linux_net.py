@@ -33,18 +33,14 @@ def _create_vpp_vif(dev, iface_id, mac, mtu,
     # on the interface which will be later used as the key for endpoint lookup
     mac_address = vpp_api.mac_to_bytes(mac)
     if interface_type == constants.VPP_VHOSTUSER_CLIENT_INTERFACE_TYPE:
-        sw_if_index = vapi.create_vhost_user_if(
-                        str(vhost_server_path).encode('utf-8'),
-                        0, mac_address, iface_id)
+        server = 0
     else:
-        sw_if_index = vapi.create_vhost_user_if(
-                        str(vhost_server_path).encode('utf-8'),
-                        1, mac_address, iface_id)
+        server = 1
+    # Creation, mtu and admin-up go over a single VPP connection
+    sw_if_index = vapi.create_vhost_user_vif(
+                    str(vhost_server_path).encode('utf-8'),
+                    server, mac_address, iface_id, mtu=mtu)
     LOG.debug("sw_if_index:{}".format(sw_if_index))
-    if mtu:
-        vapi.set_interface_mtu(sw_if_index, mtu)
-    # Default admin state  for port in VPP is down, so do admin-up here
-    vapi.set_interface_state(sw_if_index, 1)
     return sw_if_index
 
 
@@ -61,9 +57,7 @@ def update_vpp_vif_port(dev, mtu=None, interface_type=None, timeout=None):
     if not mtu:
         return
     vapi = VPPApi(LOG, 'nova_os_vif')
-    _, _, sw_if_index = vapi.vhost_details_from_tag(
-        dev.port_profile.interface_id)
-    vapi.set_interface_mtu(sw_if_index, mtu)
+    vapi.set_interface_mtu_by_tag(dev.port_profile.interface_id, mtu)
 
 
 def delete_vpp_vif_port(dev, timeout=None, delete_netdev=True):
@@ -13,7 +13,10 @@
 """VPP API interface"""
 
 import binascii
+import bisect
+import contextlib
 import json
+import os.path
 import time
 
 from opflexagent.vpplib.vpp_papi_provider import VppPapiProvider
@@ -59,6 +62,91 @@ class VppCtxt(object):
         return exc is None
 
 
+class VppSessionCtxt(object):
+    """Context handing out the provider of an already open session.
+
+    Unlike VppCtxt, nothing is connected on enter or torn down on exit,
+    the owner of the session is responsible for the connection.
+    """
+    def __init__(self, vppp):
+        self.vppp = vppp
+
+    def __enter__(self):
+        return self.vppp
+
+    def __exit__(self, exc_type, exc, exc_tb):
+        return exc is None
+
+
+class VppInterfaceCatalog(object):
+    """Indexed view over the interface and vhost-user dumps.
+
+    The dumps are walked once and every lookup is then a dict access,
+    except for socket name prefix matching which is a bisect over the
+    sorted socket basenames. When several entries share a key the first
+    one in dump order wins.
+    """
+
+    def __init__(self, interfaces, vhosts=None):
+        """
+        :param interfaces: decoded sw_interface_dump reply
+        :type interfaces: list
+        :param vhosts: decoded sw_interface_vhost_user_dump reply
+        :type vhosts: list
+        """
+        self.interfaces = interfaces
+        self.vhosts = vhosts or []
+        self.by_name = {}
+        self.by_tag = {}
+        # only vhost-user ('Virtual') interfaces are indexed by mac
+        self.by_mac = {}
+        self.vhost_by_name = {}
+        self.vhost_by_sock = {}
+        self.vhost_by_basename = {}
+        for intf in self.interfaces:
+            self.by_name.setdefault(intf['interface_name'], intf)
+            self.by_tag.setdefault(intf['tag'], intf)
+            if 'Virtual' in intf['interface_name']:
+                self.by_mac.setdefault(intf['l2_address'], intf)
+        for vint in self.vhosts:
+            sock = vint['sock_filename']
+            self.vhost_by_name.setdefault(vint['interface_name'], vint)
+            self.vhost_by_sock.setdefault(sock, vint)
+            self.vhost_by_basename.setdefault(os.path.basename(sock), vint)
+        self._basenames = sorted(self.vhost_by_basename)
+
+    def sock_name(self, interface_name):
+        """
+        Get the socket filename of a vhost-user interface.
+
+        :param interface_name: name of the interface
+        :returns The socket filename, '' if unknown
+        """
+        vint = self.vhost_by_name.get(interface_name)
+        return vint['sock_filename'] if vint else ''
+
+    def vhost_from_sock(self, sock_name):
+        """
+        Find the vhost-user interface of a socket.
+
+        The socket is matched on its full path first, then on its basename
+        and finally on the first basename sock_name is a prefix of, as the
+        name handed out by os-vif is a truncated version of it.
+
+        :param sock_name: socket path, socket basename or prefix of it
+        :returns The vhost interface data, None if not found
+        """
+        vint = (self.vhost_by_sock.get(sock_name) or
+                self.vhost_by_basename.get(sock_name))
+        if vint or not sock_name:
+            return vint
+        idx = bisect.bisect_left(self._basenames, sock_name)
+        if (idx < len(self._basenames) and
+                self._basenames[idx].startswith(sock_name)):
+            return self.vhost_by_basename[self._basenames[idx]]
+        return None
+
+
 class VPPApi(object):
     """General class for the VPP API provider methods/functions."""
 
@@ -72,8 +160,63 @@ class VPPApi(object):
         self.system_state = {}
         self.LOG = log
         self.client_name = client_name
+        self._ctxt = None
+        self._session = None
         self.LOG.debug('')
 
+    @property
+    def connected(self):
+        return self._session is not None
+
+    def connect(self):
+        """
+        Open a connection used by all the following API calls.
+
+        Does nothing if a connection is already open.
+        """
+        if self._ctxt is None:
+            ctxt = VppCtxt(self.client_name, self.LOG)
+            self._session = ctxt.__enter__()
+            self._ctxt = ctxt
+
+    def disconnect(self):
+        """
+        Close the connection opened by connect.
+        """
+        if self._ctxt is not None:
+            ctxt = self._ctxt
+            self._ctxt = None
+            self._session = None
+            ctxt.__exit__(None, None, None)
+
+    def _connection(self):
+        """
+        Get a context for a single API exchange.
+
+        :returns The open session if any, a new connection otherwise
+        """
+        if self._session is not None:
+            return VppSessionCtxt(self._session)
+        return VppCtxt(self.client_name, self.LOG)
+
+    @contextlib.contextmanager
+    def session(self):
+        """
+        Run all the API calls made within the block on one VPP connection.
+
+        Nested sessions reuse the outer connection.
+
+        :returns This VPPApi instance
+        """
+        if self._session is not None:
+            yield self
+            return
+        self.connect()
+        try:
+            yield self
+        finally:
+            self.disconnect()
+
     @staticmethod
     def _fix_tuplelist(tpl):
         """
@@ -293,42 +436,54 @@ class VPPApi(object):
         return jd
 
     @staticmethod
-    def _get_vhost_status(vhost_data, socket_filename):
+    def _get_vhost_status(catalog, socket_filename):
         """
         Handles the vhost sw interface dump reply
 
-        :param vhost_data: The Vhost data, json
-        :type vhost_data: str
+        :param catalog: The interface catalog holding the vhost data
+        :type catalog: VppInterfaceCatalog
         :param socket_filename: The filename of the socket we are looking at
         :returns 0 if the interface is good, -1 if it is not, the virtual
          interface data
         """
 
-        # Get the virtual interface list
-        vints = json.loads(vhost_data)
-
         # Get the interface associated with the socket
-        vint = filter(lambda x: x['sock_filename'] == socket_filename, vints)
+        vint = catalog.vhost_by_sock.get(socket_filename)
 
         # Check and make sure an interface is associated with the socket
-        if len(vint) == 0:
+        if not vint:
             return 1, ''
 
         # Check for a socket error
-        if 'sock_errno' in vint[0]:
-                if vint[0]['sock_errno'] != 0:
+        if 'sock_errno' in vint:
+                if vint['sock_errno'] != 0:
                     return 2, ''
         else:
             return 3, ''
 
         # Check the memory regions
-        if 'num_regions' in vint[0]:
-            if vint[0]['num_regions'] == 0:
+        if 'num_regions' in vint:
+            if vint['num_regions'] == 0:
                 return 4, ''
         else:
             return 5, ''
 
-        return 0, vint[0]
+        return 0, vint
+
+    def _get_catalog(self, vppp, vhost=True):
+        """
+        Dumps the interfaces and builds their catalog
+
+        :param vppp: The VPP API provider
+        :param vhost: Whether the vhost user interfaces are dumped as well
+        :returns The interface catalog
+        """
+        interfaces = json.loads(self._handle_mac(vppp.sw_interface_dump()))
+        vhosts = None
+        if vhost:
+            vhosts = json.loads(
+                self._handle_vhost(vppp.sw_interface_vhost_user_dump()))
+        return VppInterfaceCatalog(interfaces, vhosts)
 
     @staticmethod
     def _get_vhost_set(vhost_data):
@@ -376,10 +531,20 @@ class VPPApi(object):
         :returns The version information
 
         """
-        with VppCtxt(self.client_name, self.LOG) as vppp:
+        with self._connection() as vppp:
             version = self._handle_reply(vppp.show_version())
         return json.loads(version)
 
+    def control_ping(self):
+        """
+        Ping VPP, the cheapest way of checking it is alive.
+
+        :returns The pid of the VPP process, it changes when VPP restarts
+        """
+        with self._connection() as vppp:
+            reply = self._handle_reply(vppp.control_ping())
+        return json.loads(reply)['vpe_pid']
+
     def vhost_status(self, socketname):
         """
         Get's the vhost status given the socket name of the vhost interface.
@@ -392,9 +557,10 @@ class VPPApi(object):
          The second item in the tuple is information about the interface
 
         """
-        with VppCtxt(self.client_name, self.LOG) as vppp:
+        with self._connection() as vppp:
             vhs = self._handle_vhost(vppp.sw_interface_vhost_user_dump())
-            status, vint = self._get_vhost_status(vhs, socketname)
+            catalog = VppInterfaceCatalog([], json.loads(vhs))
+            status, vint = self._get_vhost_status(catalog, socketname)
         return status, vint
 
     def create_vhost_user_if(self, socketname, server, mac_address, tag):
@@ -409,11 +575,35 @@ class VPPApi(object):
         :returns None
         """
         vhu_reply = ''
-        with VppCtxt(self.client_name, self.LOG) as vppp:
+        with self._connection() as vppp:
             vhu_reply = self._handle_reply(vppp.create_vhostuser_socket(
                 socketname, server, mac_address, tag))
         return json.loads(vhu_reply)['sw_if_index']
 
+    def create_vhost_user_vif(self, socketname, server, mac_address, tag,
+                              mtu=None):
+        """
+        Creates a vhost user interface and brings it admin up.
+
+        Creation, mtu and admin state are done over a single connection.
+
+        :param socketname: The socket name of the virtual interface
+        :param server: 1/0 indicates vhost-user server/client side of the
+        socket is being created
+        :param mac_address: Custom mac-address to be assigned to the interface
+        :param tag: An identifier for the port, usually neutron port UUID
+        :param mtu: mtu, left untouched if not set
+        :returns sw_if_index: if_index of the created interface
+        """
+        with self.session():
+            sw_if_index = self.create_vhost_user_if(socketname, server,
+                                                    mac_address, tag)
+            if mtu:
+                self.set_interface_mtu(sw_if_index, mtu)
+            # Default admin state for port in VPP is down
+            self.set_interface_state(sw_if_index, 1)
+        return sw_if_index
+
     def show_vhost_user(self):
         """
         Get the set of all vhost user interfaces.
@@ -421,7 +611,7 @@ class VPPApi(object):
         :param None
         :returns Set of all vhost user interface names
         """
-        with VppCtxt(self.client_name, self.LOG) as vppp:
+        with self._connection() as vppp:
             rep = self._handle_vhost(vppp.sw_interface_vhost_user_dump())
             vh_set = self._get_vhost_set(rep)
         return vh_set
@@ -433,7 +623,7 @@ class VPPApi(object):
         :param None
         :returns Set of all vhost user interface names
         """
-        with VppCtxt(self.client_name, self.LOG) as vppp:
+        with self._connection() as vppp:
             rep = self._handle_vhost(vppp.sw_interface_vhost_user_dump())
             vh_set = self._get_vhost_sock_set(rep)
         return vh_set
@@ -445,7 +635,7 @@ class VPPApi(object):
         :param None
         :returns Set of all vhost user interface mac addresses.
         """
-        with VppCtxt(self.client_name, self.LOG) as vppp:
+        with self._connection() as vppp:
             rep = self._handle_mac(vppp.sw_interface_dump())
             vh_mac = self._get_vhost_mac_set(rep)
         return vh_mac
@@ -459,24 +649,16 @@ class VPPApi(object):
          tuples.
         """
         tag_dict = {}
-        with VppCtxt(self.client_name, self.LOG) as vppp:
-            rep = self._handle_mac(vppp.sw_interface_dump())
-            interfaces = json.loads(rep)
-            rep_vhost = self._handle_vhost(vppp.sw_interface_vhost_user_dump())
-            vints = json.loads(rep_vhost)
-            # Get the interface associated with the socket
-            for interface in interfaces:
-                if interface['interface_name'].startswith('Virtual'):
-                    curr_int = interface['interface_name']
-                    sock_name = ''
-                    for vint in vints:
-                        if vint['interface_name'] == curr_int:
-                            sock_name = vint['sock_filename']
-                            break
-                    tag_dict.update({interface['tag']: sock_name})
-                if interface['interface_name'].startswith('host-'):
-                    tag_dict.update({interface['tag']:
-                        interface['interface_name'][5:]})
+        with self._connection() as vppp:
+            catalog = self._get_catalog(vppp)
+        # Get the interface associated with the socket
+        for interface in catalog.interfaces:
+            if interface['interface_name'].startswith('Virtual'):
+                tag_dict.update({interface['tag']:
+                    catalog.sock_name(interface['interface_name'])})
+            if interface['interface_name'].startswith('host-'):
+                tag_dict.update({interface['tag']:
+                    interface['interface_name'][5:]})
         return tag_dict
 
     def vhost_name_from_mac(self, mac):
@@ -486,26 +668,42 @@ class VPPApi(object):
         :param mac: mac address of the vhost user interface.
         :returns vhost user interface with the given mac address.
         """
-        with VppCtxt(self.client_name, self.LOG) as vppp:
-            rep = self._handle_mac(vppp.sw_interface_dump())
-            # Get the virtual interface list
-            ints = json.loads(rep)
+        with self._connection() as vppp:
+            catalog = self._get_catalog(vppp)
+        vint = catalog.by_mac.get(mac)
+        if not vint:
+            return ''
+        return catalog.sock_name(vint['interface_name'])
 
-            # Get the interface associated with the socket
-            vints = filter(lambda x: 'Virtual' in x['interface_name'], ints)
-            port_name = ''
-            for vint in vints:
-                if vint['l2_address'] == mac:
-                    port_name = vint['interface_name']
-                    break
-            rep = self._handle_vhost(vppp.sw_interface_vhost_user_dump())
-            vints = json.loads(rep)
-            sock_name = ''
-            for v in vints:
-                if v['interface_name'] == port_name:
-                    sock_name = v['sock_filename']
-                    break
-        return sock_name
+    def sw_if_index_from_tag(self, tag):
+        """
+        Get the sw_if_index of an interface given its tag.
+
+        Unlike vhost_details_from_tag, the vhost user dump is skipped.
+
+        :param tag: tag on the interface.
+        :returns sw_if_index, -1 if no interface has the tag.
+        """
+        with self._connection() as vppp:
+            catalog = self._get_catalog(vppp, vhost=False)
+        intf = catalog.by_tag.get(tag)
+        return intf['sw_if_index'] if intf else -1
+
+    def set_interface_mtu_by_tag(self, tag, mtu):
+        """
+        Set mtu on the interface carrying the given tag.
+
+        Lookup and update are done over a single connection.
+
+        :param tag: tag on the interface.
+        :param mtu: mtu
+        :returns sw_if_index, -1 if no interface has the tag.
+        """
+        with self.session():
+            sw_if_index = self.sw_if_index_from_tag(tag)
+            if sw_if_index != -1:
+                self.set_interface_mtu(sw_if_index, mtu)
+        return sw_if_index
 
     def vhost_details_from_tag(self, tag):
         """
@@ -514,31 +712,25 @@ class VPPApi(object):
         :param tag: tag on the vhost user interface.
         :returns vhost user interface, mac address and sw_if_index.
         """
-        with VppCtxt(self.client_name, self.LOG) as vppp:
-            rep = self._handle_mac(vppp.sw_interface_dump())
-            # Get the virtual interface list
-            interfaces = json.loads(rep)
+        with self._connection() as vppp:
+            catalog = self._get_catalog(vppp, vhost=False)
 
             # Get the interface associated with the socket
             port_name = ''
             port_mac = ''
             sock_name = ''
             sw_if_index = -1
-            for intf in interfaces:
-                if intf['tag'] == tag:
-                    port_name = intf['interface_name']
-                    port_mac = intf['l2_address']
-                    sw_if_index = intf['sw_if_index']
-                    break
+            intf = catalog.by_tag.get(tag)
+            if intf:
+                port_name = intf['interface_name']
+                port_mac = intf['l2_address']
+                sw_if_index = intf['sw_if_index']
             if port_name:
                 if port_name.startswith('Virtual'):
                     rep = self._handle_vhost(
                         vppp.sw_interface_vhost_user_dump())
-                    vints = json.loads(rep)
-                    for v in vints:
-                        if v['interface_name'] == port_name:
-                            sock_name = v['sock_filename']
-                            break
+                    catalog = VppInterfaceCatalog([], json.loads(rep))
+                    sock_name = catalog.sock_name(port_name)
                 elif port_name.startswith('host-'):
                     sock_name = port_name[5:]
                 else:
@@ -549,21 +741,17 @@ class VPPApi(object):
         """
         Delete the vhost user interface using the socketfilename.
 
-        :param sock_name: vhost-user socketfilename
+        :param sock_name: vhost-user socketfilename, its basename or a
+         prefix of the basename
         :returns None
         """
-        with VppCtxt(self.client_name, self.LOG) as vppp:
+        with self._connection() as vppp:
             rep = self._handle_vhost(vppp.sw_interface_vhost_user_dump())
-            # Get the virtual interface list
-            vints = json.loads(rep)
-
-            if_index = -1
-            for v in vints:
-                if sock_name in v['sock_filename']:
-                    if_index = v['sw_if_index']
-                    break
-            if if_index != -1:
-                self._handle_reply(vppp.delete_vhostuser_socket(if_index))
+            catalog = VppInterfaceCatalog([], json.loads(rep))
+            vint = catalog.vhost_from_sock(sock_name)
+            if vint:
+                self._handle_reply(
+                    vppp.delete_vhostuser_socket(vint['sw_if_index']))
 
     def set_interface_state(self, sw_if_index, state):
         """
@@ -573,7 +761,7 @@ class VPPApi(object):
         :param state: admin up/down state(1/0)
         :returns None
         """
-        with VppCtxt(self.client_name, self.LOG) as vppp:
+        with self._connection() as vppp:
             self._handle_reply(vppp.set_interface_state(sw_if_index, state))
 
     def create_host_interface(self, lnx_veth_name, mac_address, uuid):
@@ -584,7 +772,7 @@ class VPPApi(object):
         :param lnx_veth_name: name of the veth linux interface
         :returns sw_if_index: if_index of the created interface
         """
-        with VppCtxt(self.client_name, self.LOG) as vppp:
+        with self._connection() as vppp:
             rep = self._handle_reply(vppp.af_packet_create(lnx_veth_name,
                                         mac_address))
             sw_if_index = json.loads(rep)['sw_if_index']
@@ -598,7 +786,7 @@ class VPPApi(object):
         :param lnx_veth_name: name of the veth linux interface
         :returns None
         """
-        with VppCtxt(self.client_name, self.LOG) as vppp:
+        with self._connection() as vppp:
             self._handle_reply(vppp.af_packet_delete(lnx_veth_name))
 
     def set_interface_mtu(self, sw_if_index, mtu):
@@ -609,5 +797,5 @@ class VPPApi(object):
         :param mtu: mtu
         :returns None
         """
-        with VppCtxt(self.client_name, self.LOG) as vppp:
+        with self._connection() as vppp:
             self._handle_reply(vppp.set_interface_mtu(sw_if_index, mtu))
@@ -9,8 +9,11 @@
 #    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
 #    License for the specific language governing permissions and limitations
 #    under the License.
+import bisect
+import collections
 import os
 import signal
+import time
 import traceback
 
 # import logging
@@ -20,6 +23,9 @@ import traceback
 single_line_delim = '--------------------------------------------'
 double_line_delim = '============================================'
 
+# Upper bounds, in seconds, of the API latency histogram buckets
+LATENCY_BUCKETS = (0.0001, 0.0005, 0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1.0)
+
 
 # noinspection PyBroadException
 def fix_string(s):
@@ -46,7 +52,7 @@ class Hook(object):
         @param api_name: name of the API
         @param api_args: tuple containing the API arguments
         """
-        self.LOG.debug("API: %s (%s)" % (api_name, api_args))
+        self.LOG.debug("API: %s (%s)", api_name, api_args)
 
     # noinspection PyTypeChecker
     def after_api(self, api_name, api_args):
@@ -57,7 +63,16 @@ class Hook(object):
         @param api_args: tuple containing the API arguments
         """
 
-        self.LOG.debug("API: %s (%s)" % (api_name, api_args))
+        self.LOG.debug("API: %s (%s)", api_name, api_args)
+
+    def api_error(self, api_name, api_args):
+        """
+        Function called instead of after_api when the API call fails
+
+        @param api_name: name of the API
+        @param api_args: tuple containing the API arguments
+        """
+        pass
 
     def before_cli(self, cli):
         """
@@ -66,7 +81,7 @@ class Hook(object):
 
         @param cli: CLI string
         """
-        self.LOG.debug("CLI: %s" % cli)
+        self.LOG.debug("CLI: %s", cli)
 
     def after_cli(self, cli):
         """
@@ -75,6 +90,91 @@ class Hook(object):
         pass
 
 
+class ApiMetrics(object):
+    """
+    Per API message call counts, error counts and latency histograms
+
+    Collection is off until enable() is called, providers created while
+    it is off use the plain Hook and pay nothing for it.
+    """
+
+    def __init__(self):
+        self.enabled = False
+        self.reset()
+
+    def enable(self):
+        self.enabled = True
+
+    def disable(self):
+        self.enabled = False
+
+    def reset(self):
+        self.calls = collections.defaultdict(int)
+        self.errors = collections.defaultdict(int)
+        self.latency = collections.defaultdict(float)
+        self.histograms = {}
+
+    def record(self, api_name, latency, error=False):
+        """
+        Account for one API call
+
+        @param api_name: name of the API
+        @param latency: time spent in the call, in seconds
+        @param error: whether the call failed
+        """
+        self.calls[api_name] += 1
+        if error:
+            self.errors[api_name] += 1
+        self.latency[api_name] += latency
+        histogram = self.histograms.get(api_name)
+        if histogram is None:
+            histogram = [0] * (len(LATENCY_BUCKETS) + 1)
+            self.histograms[api_name] = histogram
+        histogram[bisect.bisect_left(LATENCY_BUCKETS, latency)] += 1
+
+    def dump(self):
+        """
+        Get a snapshot of the metrics
+
+        @return: dict of API name to its calls, errors, total latency and
+                 latency histogram (bucket upper bound to count)
+        """
+        labels = ['<=%s' % b for b in LATENCY_BUCKETS]
+        labels.append('>%s' % LATENCY_BUCKETS[-1])
+        return dict(
+            (api_name, {'calls': self.calls[api_name],
+                        'errors': self.errors[api_name],
+                        'latency': self.latency[api_name],
+                        'histogram': dict(zip(labels,
+                                              self.histograms[api_name]))})
+            for api_name in self.histograms)
+
+
+# Metrics shared by all the providers of this process
+api_metrics = ApiMetrics()
+
+
+class MetricsHook(Hook):
+    """ Hook which records API call metrics """
+
+    def __init__(self, logger, metrics):
+        super(MetricsHook, self).__init__(logger)
+        self.metrics = metrics
+        self._start = None
+
+    def before_api(self, api_name, api_args):
+        super(MetricsHook, self).before_api(api_name, api_args)
+        self._start = time.time()
+
+    def after_api(self, api_name, api_args):
+        self.metrics.record(api_name, time.time() - self._start)
+        super(MetricsHook, self).after_api(api_name, api_args)
+
+    def api_error(self, api_name, api_args):
+        self.metrics.record(api_name, time.time() - self._start, error=True)
+        super(MetricsHook, self).api_error(api_name, api_args)
+
+
 class VppDiedError(Exception):
     pass
 
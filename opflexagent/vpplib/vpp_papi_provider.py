@@ -11,8 +11,10 @@
 #    under the License.
 from collections import deque
 import fnmatch
-from hook import Hook
 import logging
+from opflexagent.vpplib.hook import api_metrics
+from opflexagent.vpplib.hook import Hook
+from opflexagent.vpplib.hook import MetricsHook
 import os
 import time
 
@@ -66,7 +68,10 @@ class VppPapiProvider(object):
 
     def __init__(self, name, shm_prefix=None, read_timeout=3):
         self.LOG = logging.getLogger(__name__)
-        self.hook = Hook(self.LOG)
+        if api_metrics.enabled:
+            self.hook = MetricsHook(self.LOG, api_metrics)
+        else:
+            self.hook = Hook(self.LOG)
         self.name = name
         self.shm_prefix = shm_prefix
         self._expect_api_retval = self._zero
@@ -167,7 +172,23 @@ class VppPapiProvider(object):
 
         """
         self.hook.before_api(api_fn.__name__, api_args)
-        reply = api_fn(**api_args)
+        try:
+            reply = api_fn(**api_args)
+            self._check_api_retval(reply, expected_retval)
+        except Exception:
+            self.hook.api_error(api_fn.__name__, api_args)
+            raise
+        self.hook.after_api(api_fn.__name__, api_args)
+        return reply
+
+    def _check_api_retval(self, reply, expected_retval):
+        """ Check the return value of an API reply.
+
+        :param reply: reply from the API
+        :param expected_retval: Expected return value
+        :raises UnexpectedApiReturnValueError: on unexpected return value
+
+        """
         if self._expect_api_retval == self._negative:
             if hasattr(reply, 'retval') and reply.retval >= 0:
                 msg = "API call passed unexpectedly: expected negative "\
@@ -186,8 +207,6 @@ class VppPapiProvider(object):
             raise Exception("Internal error, unexpected value for "
                             "self._expect_api_retval %s" %
                             self._expect_api_retval)
-        self.hook.after_api(api_fn.__name__, api_args)
-        return reply
 
     def cli(self, cli):
         """ Execute a CLI, calling the before/after hooks appropriately.
@@ -1609,7 +1628,7 @@ class VppPapiProvider(object):
         return self.api(self.papi.nat64_prefix_dump, {})
 
     def control_ping(self):
-        self.api(self.papi.control_ping)
+        return self.api(self.papi.control_ping, {})
 
     def bfd_udp_add(self, sw_if_index, desired_min_tx, required_min_rx,
                     detect_mult, local_addr, peer_addr, is_ipv6=0,
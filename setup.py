@@ -32,6 +32,8 @@ setuptools.setup(
                 'opflexagent.as_metadata_manager:ep_watcher_main',
             'opflex-state-watcher = '
                 'opflexagent.as_metadata_manager:state_watcher_main',
+            'opflex-md-watcher = '
+                'opflexagent.as_metadata_manager:md_watcher_main',
             'neutron-cisco-apic-host-agent = '
                 'opflexagent.apic_topology:agent_main',
             'opflex-ns-proxy = '